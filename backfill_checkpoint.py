@@ -0,0 +1,159 @@
+import datetime
+import json
+import os
+from time import time
+
+import numpy as np
+
+CHECKPOINT_DIR = "./csvs/backfill_checkpoint"
+BITMAP_FILE = "missing_pairs.npz"
+# Origins whose pairs are all in the database, one id per line.
+COMPLETED_ORIGINS_LOG = "completed_origins.log"
+# One line per batch committed to the database, written after the bitmap of the batch was saved.
+BATCHES_LOG = "batches.log"
+PROGRESS_FILE = "progress.json"
+# Seconds of committed batches used for the recent throughput of the progress file.
+THROUGHPUT_WINDOW = 300
+
+
+def write_atomic(path, write):
+    "Write a file through a temporary file so a crash never leaves a partial one."
+    temporary = f"{path}.tmp"
+    with open(temporary, "wb") as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+
+class BackfillCheckpoint:
+    """
+    Durable progress of the distance backfill. After every batch the BulkWriter commits, the pairs
+    of the batch are marked in the MissingPairs bitmap, the bitmap is saved, the origins that have
+    no missing pairs left are appended to the completed origins log and a commit marker is appended
+    to the batches log. A restart loads the bitmap and the log instead of reading every pair of
+    distancias_mexico, so only the pairs that were never committed are requested again.
+    """
+
+    def __init__(self, missing_pairs, path=CHECKPOINT_DIR):
+        self.missing_pairs = missing_pairs
+        self.path = path
+        self.batches = 0
+        self.committed = 0
+        self.completed_origins = 0
+        self.missing_at_start = missing_pairs.missing()
+        self.start_time = time()
+        self.recent = [(self.start_time, 0)]
+        os.makedirs(path, exist_ok=True)
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    @classmethod
+    def load(cls, location_ids, missing_pairs, path=CHECKPOINT_DIR):
+        """
+        Resume from the checkpoint of the same locations: the saved bitmap plus the origins of the
+        completed log are marked on missing_pairs. Returns None when there is no checkpoint or it
+        was made for other locations.
+        """
+        bitmap_file = os.path.join(path, BITMAP_FILE)
+        if not os.path.isfile(bitmap_file):
+            return None
+        with np.load(bitmap_file) as saved:
+            if not np.array_equal(saved['location_ids'], np.asarray(location_ids, dtype=np.int64)):
+                print(f"The checkpoint in {path} is for other locations, starting over")
+                return None
+            missing_pairs.bits[:] = saved['bits']
+
+        completed = read_completed_origins(path)
+        missing_pairs.mark_origins(completed)
+
+        checkpoint = cls(missing_pairs, path)
+        checkpoint.batches = len(read_batches(path))
+        checkpoint.completed_origins = len(completed)
+        print(
+            f"Resuming from batch {checkpoint.batches} of {path}, {len(completed)} origins are complete "
+            f"and {checkpoint.missing_at_start} pairs are missing")
+        return checkpoint
+
+    def save_bitmap(self):
+        write_atomic(self.file(BITMAP_FILE), lambda f: np.savez(
+            f, location_ids=self.missing_pairs.location_ids, bits=self.missing_pairs.bits))
+
+    def commit(self, rows):
+        "Record a batch of (origin, destination, distance, time) rows committed to the database."
+        origins, destinations = zip(*[(row[0], row[1]) for row in rows])
+        self.missing_pairs.mark(origins, destinations)
+        self.save_bitmap()
+
+        completed = [
+            origin for origin in np.unique(np.minimum(origins, destinations)).tolist()
+            if self.missing_pairs.is_complete(origin)
+        ]
+        if completed:
+            with open(self.file(COMPLETED_ORIGINS_LOG), "a") as f:
+                f.writelines(f"{origin}\n" for origin in completed)
+        self.completed_origins += len(completed)
+
+        self.batches += 1
+        self.committed += len(rows)
+        with open(self.file(BATCHES_LOG), "a") as f:
+            f.write(f"{self.batches},{len(rows)},{datetime.datetime.now().isoformat(timespec='seconds')}\n")
+
+        now = time()
+        self.recent.append((now, self.committed))
+        while len(self.recent) > 2 and now - self.recent[1][0] > THROUGHPUT_WINDOW:
+            self.recent.pop(0)
+
+    def progress(self):
+        "Committed pairs, throughput and ETA of the run."
+        now = time()
+        elapsed = now - self.start_time
+        remaining = max(self.missing_at_start - self.committed, 0)
+        window_start, window_committed = self.recent[0]
+        recent_rate = (self.committed - window_committed) / (now - window_start) if now > window_start else 0
+        rate = self.committed / elapsed if elapsed else 0
+        eta = remaining / recent_rate if recent_rate else None
+        return {
+            'updated': datetime.datetime.now().isoformat(timespec='seconds'),
+            'elapsed': str(datetime.timedelta(seconds=int(elapsed))),
+            'possible_pairs': self.missing_pairs.possible(),
+            'missing_at_start': self.missing_at_start,
+            'committed_pairs': self.committed,
+            'remaining_pairs': remaining,
+            'batches': self.batches,
+            'completed_origins': self.completed_origins,
+            'pairs_per_second': round(rate, 1),
+            'recent_pairs_per_second': round(recent_rate, 1),
+            'eta': str(datetime.timedelta(seconds=int(eta))) if eta is not None else None,
+        }
+
+    def write_progress(self):
+        progress = self.progress()
+        write_atomic(self.file(PROGRESS_FILE), lambda f: f.write(json.dumps(progress, indent=2).encode()))
+        return progress
+
+
+def read_completed_origins(path=CHECKPOINT_DIR):
+    "Origins of the completed origins log, a partial last line of a crash is ignored."
+    filename = os.path.join(path, COMPLETED_ORIGINS_LOG)
+    if not os.path.isfile(filename):
+        return []
+    with open(filename, "r") as f:
+        return [int(line) for line in f if line.endswith("\n") and line.strip()]
+
+
+def read_batches(path=CHECKPOINT_DIR):
+    "Commit markers of the batches log, a partial last line of a crash is ignored."
+    filename = os.path.join(path, BATCHES_LOG)
+    if not os.path.isfile(filename):
+        return []
+    with open(filename, "r") as f:
+        return [line.strip().split(',') for line in f if line.endswith("\n")]
+
+
+def reset_checkpoint(path=CHECKPOINT_DIR):
+    "Remove the checkpoint so the next run reads the existing pairs from the database."
+    for name in (BITMAP_FILE, COMPLETED_ORIGINS_LOG, BATCHES_LOG, PROGRESS_FILE):
+        if os.path.isfile(os.path.join(path, name)):
+            os.remove(os.path.join(path, name))
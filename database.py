@@ -0,0 +1,246 @@
+from contextlib import contextmanager
+import csv
+import io
+import os
+import threading
+import traceback
+from time import time
+
+from psycopg2.pool import ThreadedConnectionPool
+
+DATABASE = {
+    'database': 'assistcargo',
+    'user': '*',
+    'password': '*',
+    'host': 'localhost',
+}
+POOL_MIN_CONNECTIONS = 1
+POOL_MAX_CONNECTIONS = 8
+# Keys sent to the database in every query of get_many.
+BATCH_SIZE = 10000
+
+# Rows buffered by a BulkWriter before they are written, and seconds between flushes.
+BULK_BATCH_SIZE = 50000
+BULK_FLUSH_SECONDS = 30
+
+# Columns and upsert keys of the tables written in bulk.
+DISTANCE_COLUMNS = ('ubicacion_id_origen', 'ubicacion_id_destino', 'distancia', 'tiempo')
+DISTANCE_KEY_COLUMNS = ('ubicacion_id_origen', 'ubicacion_id_destino')
+LOCATION_COLUMNS = ('ubicacion_id', 'direccion', 'localidad', 'latitud', 'longitud')
+LOCATION_KEY_COLUMNS = ('ubicacion_id', )
+# Tables written by a BulkWriter and the key columns of their upsert.
+UPSERT_TABLES = {
+    'distancias_mexico': DISTANCE_KEY_COLUMNS,
+    'ubicaciones_mexico': LOCATION_KEY_COLUMNS,
+    'distancias': DISTANCE_KEY_COLUMNS,
+}
+
+# Hot queries, prepared once per connection that runs them. Every parameter is an array so the same statement
+# serves one key or a whole batch.
+PREPARED_STATEMENTS = {
+    'distance_lookup': (
+        "(bigint[], bigint[])",
+        """SELECT d.ubicacion_id_origen, d.ubicacion_id_destino, d.tiempo, d.distancia
+        FROM distancias_mexico d
+        JOIN unnest($1, $2) AS pairs(origen, destino)
+        ON d.ubicacion_id_origen = pairs.origen AND d.ubicacion_id_destino = pairs.destino""",
+    ),
+}
+
+POOL = None
+POOL_PID = None
+POOL_LOCK = threading.Lock()
+# (connection, statement) pairs already prepared, a statement is prepared the first time it runs.
+PREPARED = set()
+
+
+def get_pool():
+    "Connection pool of the process. A forked worker opens its own, connections can't be shared."
+    global POOL, POOL_PID
+    with POOL_LOCK:
+        if POOL is None or POOL_PID != os.getpid():
+            POOL = ThreadedConnectionPool(POOL_MIN_CONNECTIONS, POOL_MAX_CONNECTIONS, **DATABASE)
+            POOL_PID = os.getpid()
+            PREPARED.clear()
+    return POOL
+
+
+@contextmanager
+def connection(autocommit=False):
+    """
+    Borrow a connection from the pool. The transaction is committed when the block ends and rolled
+    back when it raises, unless the connection is in autocommit mode.
+    """
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        conn.autocommit = autocommit
+        yield conn
+        if not autocommit:
+            conn.commit()
+    except Exception:
+        if not autocommit:
+            conn.rollback()
+        raise
+    finally:
+        conn.autocommit = False
+        pool.putconn(conn)
+
+
+@contextmanager
+def cursor(name=None, autocommit=False):
+    "Cursor on a pooled connection, a named (server-side) cursor when a name is given."
+    with connection(autocommit) as conn:
+        with conn.cursor(name=name) as cur:
+            yield cur
+
+
+def execute_prepared(cur, statement, *columns):
+    """
+    Run a prepared statement with one array per parameter, preparing it on the connection of the
+    cursor the first time. Connections that never run it don't need the tables it reads.
+    """
+    if (id(cur.connection), statement) not in PREPARED:
+        types, query = PREPARED_STATEMENTS[statement]
+        cur.execute(f"PREPARE {statement} {types} AS {query};")
+        PREPARED.add((id(cur.connection), statement))
+    placeholders = ', '.join(['%s'] * len(columns))
+    cur.execute(f"EXECUTE {statement} ({placeholders});", [list(column) for column in columns])
+
+
+def get_many(statement, *columns, batch_size=BATCH_SIZE):
+    """
+    Rows of a prepared lookup for many keys, batch_size keys per query. The keys are given as one
+    sequence per parameter, for example get_many('distance_lookup', origins, destinations).
+    """
+    rows = []
+    with cursor() as cur:
+        for first in range(0, len(columns[0]), batch_size):
+            execute_prepared(cur, statement, *[column[first:first + batch_size] for column in columns])
+            rows.extend(cur.fetchall())
+    return rows
+
+
+class BulkWriter:
+    """
+    Buffers rows of a table and writes them with COPY into a staging table and a single upsert into
+    the table, so duplicated keys update the existing row instead of failing. The buffer is flushed
+    every batch_size rows, when flush_seconds passed since the last flush and when the writer is
+    closed. on_flush, when given, is called with the rows of every flush after they were written.
+
+    The upsert needs a unique constraint on the key columns, added once by add_upsert_key. When a
+    flush fails its rows are put back in the buffer, so the next flush writes them again.
+    """
+
+    def __init__(self, table, columns, key_columns, batch_size=BULK_BATCH_SIZE,
+                 flush_seconds=BULK_FLUSH_SECONDS, on_flush=None):
+        self.table = table
+        self.columns = list(columns)
+        self.key_columns = list(key_columns)
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.on_flush = on_flush
+        self.rows = []
+        self.written = 0
+        self.last_flush = time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type is None:
+            self.close()
+            return
+        # The block already failed, a failing flush shouldn't replace its exception.
+        try:
+            self.close()
+        except Exception:
+            traceback.print_exc()
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size or time() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def add_many(self, rows):
+        for row in rows:
+            self.add(row)
+
+    def upsert_query(self, staging):
+        columns = ', '.join(self.columns)
+        keys = ', '.join(self.key_columns)
+        updates = [column for column in self.columns if column not in self.key_columns]
+        action = (
+            "DO UPDATE SET " + ', '.join(f"{column} = EXCLUDED.{column}" for column in updates)
+            if updates else "DO NOTHING"
+        )
+        # The last row of every key wins, an upsert can't touch the same row twice.
+        return (
+            f"INSERT INTO {self.table} ({columns}) "
+            f"SELECT DISTINCT ON ({keys}) {columns} FROM {staging} ORDER BY {keys}, staging_order DESC "
+            f"ON CONFLICT ({keys}) {action};"
+        )
+
+    def flush(self):
+        self.last_flush = time()
+        if not self.rows:
+            return
+        rows, self.rows = self.rows, []
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for staging_order, row in enumerate(rows):
+            writer.writerow(['' if value is None else value for value in row] + [staging_order])
+        buffer.seek(0)
+
+        staging = f"{self.table}_staging"
+        try:
+            with cursor() as cur:
+                cur.execute(
+                    f"CREATE TEMP TABLE {staging} ON COMMIT DROP AS "
+                    f"SELECT {', '.join(self.columns)}, 0 AS staging_order FROM {self.table} WITH NO DATA;")
+                cur.copy_expert(
+                    f"COPY {staging} ({', '.join(self.columns)}, staging_order) FROM STDIN WITH (FORMAT csv);", buffer)
+                cur.execute(self.upsert_query(staging))
+        except Exception:
+            self.rows = rows + self.rows
+            raise
+
+        self.written += len(rows)
+        if self.on_flush:
+            self.on_flush(rows)
+
+    def close(self):
+        self.flush()
+
+
+def add_upsert_key(table, key_columns):
+    """
+    One-off migration for the upsert of a BulkWriter: delete the duplicated keys of the table,
+    keeping one row of every key, and add a unique constraint on the key columns. Both run in one
+    transaction that locks the table, so it should run while nothing writes to it. A unique index
+    left by an older BulkWriter becomes the constraint, tables that already have it are skipped.
+    """
+    keys = ', '.join(key_columns)
+    constraint = f"{table}_upsert_key"
+    with cursor() as cur:
+        cur.execute("SELECT to_regclass(%s), to_regclass(%s);", (table, constraint))
+        table_exists, index_exists = cur.fetchone()
+        cur.execute("SELECT 1 FROM pg_constraint WHERE conname = %s;", (constraint, ))
+        if not table_exists or cur.fetchone():
+            print(f"{table}: nothing to do")
+            return
+        cur.execute(
+            f"DELETE FROM {table} WHERE ctid IN ("
+            f"SELECT ctid FROM (SELECT ctid, ROW_NUMBER() OVER (PARTITION BY {keys} ORDER BY ctid DESC) AS copy "
+            f"FROM {table}) copies WHERE copy > 1);")
+        duplicates = cur.rowcount
+        cur.execute(
+            f"ALTER TABLE {table} ADD CONSTRAINT {constraint} "
+            + (f"UNIQUE USING INDEX {constraint};" if index_exists else f"UNIQUE ({keys});"))
+    print(f"{table}: deleted {duplicates} duplicated rows and added {constraint}")
+
+
+if __name__ == '__main__':
+    for table, key_columns in UPSERT_TABLES.items():
+        add_upsert_key(table, key_columns)
@@ -0,0 +1,228 @@
+import datetime
+from collections import Counter, defaultdict
+from math import ceil
+
+import numpy as np
+
+from distance_matrix import MISSING_TIME
+from fleet_state import index_vehicle_states
+from pruning import get_pruned_free_units
+
+# Pickups are grouped in slabs of SLAB_MINUTES by start time and every slab is split by origin
+# region into clusters of at most MAX_CLUSTER_TRIPS trips.
+SLAB_MINUTES = 360
+MAX_CLUSTER_TRIPS = 150
+# Candidate vehicles given to a cluster for every trip in it.
+VEHICLES_PER_TRIP = 1.5
+# Travel times at or above this cap count the same when clustering, so unknown pairs don't pull
+# the seeds of the regions.
+TRAVEL_TIME_CAP = 10 * 1440
+
+
+def get_travel_times(distances, origins, destinations):
+    "Travel times between every origin and every destination, capped at TRAVEL_TIME_CAP."
+    origins, destinations = np.meshgrid(
+        np.asarray(origins, dtype=np.int64), np.asarray(destinations, dtype=np.int64), indexing='ij')
+    return np.minimum(distances.times(origins, destinations), TRAVEL_TIME_CAP)
+
+
+def split_regions(data, pickup_nodes, max_trips=MAX_CLUSTER_TRIPS):
+    """
+    Split the pickups of a slab into regions around seed origins picked by farthest travel time,
+    then split the regions that are still bigger than max_trips by start time.
+    """
+    if len(pickup_nodes) <= max_trips:
+        return [pickup_nodes]
+
+    origins = np.array([data['locations'][node]['id'] for node in pickup_nodes], dtype=np.int64)
+    unique_origins = np.unique(origins)
+    travel = get_travel_times(data['distances'], unique_origins, unique_origins)
+
+    seeds = [int(np.argmax(np.bincount(np.searchsorted(unique_origins, origins))))]
+    for _ in range(min(ceil(len(pickup_nodes) / max_trips), len(unique_origins)) - 1):
+        seeds.append(int(np.argmax(travel[:, seeds].min(axis=1))))
+
+    region_of_origin = np.argmin(travel[:, seeds], axis=1)
+    region_of_pickup = region_of_origin[np.searchsorted(unique_origins, origins)]
+
+    clusters = []
+    for region in range(len(seeds)):
+        nodes = [node for node, node_region in zip(pickup_nodes, region_of_pickup) if node_region == region]
+        nodes.sort(key=lambda node: data['locations'][node]['minutes'])
+        for first in range(0, len(nodes), max_trips):
+            clusters.append(nodes[first:first + max_trips])
+    return [cluster for cluster in clusters if cluster]
+
+
+def build_clusters(data, slab_minutes=SLAB_MINUTES, max_trips=MAX_CLUSTER_TRIPS):
+    """
+    Group the pickup nodes of the day in time slabs and origin regions. Returns one list of
+    clusters per slab, in time order, and every cluster is a list of pickup nodes.
+    """
+    slabs = defaultdict(list)
+    for pickup, _ in data['pickups_deliveries']:
+        slabs[data['locations'][pickup]['minutes'] // slab_minutes].append(pickup)
+    return [split_regions(data, slabs[slab], max_trips) for slab in sorted(slabs)]
+
+
+def get_vehicle_states(data):
+    "Location and availability of every unit, taken from the START nodes of the day."
+    return {
+        unit: dict(data['locations'][node])
+        for unit, node in zip(data['starts_definition'], data['starts'])
+    }
+
+
+def assign_vehicles(data, clusters, vehicle_states, vehicles_per_trip=VEHICLES_PER_TRIP):
+    """
+    Give every cluster of a slab its candidate vehicles, each unit to one cluster at most. A unit
+    that originally made trips of a cluster goes to the cluster with most of its trips, the rest of
+    the places are filled first with the units already waiting at the first origin of the cluster,
+    then with the units that can reach it earliest.
+    """
+    units = list(vehicle_states)
+    claimed = {}
+    for cluster_idx, cluster in enumerate(clusters):
+        for unit, count in Counter(data['locations'][node]['unidad'] for node in cluster).items():
+            if unit in vehicle_states and count > claimed.get(unit, (None, 0))[1]:
+                claimed[unit] = (cluster_idx, count)
+
+    vehicles = [[] for _ in clusters]
+    for unit, (cluster_idx, _) in claimed.items():
+        vehicles[cluster_idx].append(unit)
+
+    free_units = [unit for unit in units if unit not in claimed]
+    locations = np.array([vehicle_states[unit]['id'] for unit in free_units], dtype=np.int64)
+    minutes = np.array([vehicle_states[unit]['minutes'] for unit in free_units], dtype=np.int64)
+    taken = np.zeros(len(free_units), dtype=bool)
+    state = index_vehicle_states(free_units, vehicle_states)
+
+    for cluster_idx in sorted(range(len(clusters)), key=lambda idx: -len(clusters[idx])):
+        missing = ceil(vehicles_per_trip * len(clusters[cluster_idx])) - len(vehicles[cluster_idx])
+        if missing <= 0 or taken.all():
+            continue
+        first = min(clusters[cluster_idx], key=lambda node: data['locations'][node]['minutes'])
+        origin = data['locations'][first]
+        for unit in state.free_at_location(origin['id'], origin['minutes']).tolist():
+            idx = state.positions[unit]
+            if missing > 0 and not taken[idx]:
+                taken[idx] = True
+                vehicles[cluster_idx].append(free_units[idx])
+                missing -= 1
+        if missing <= 0 or taken.all():
+            continue
+        arrival = minutes + get_travel_times(
+            data['distances'], locations, [origin['id']])[:, 0]
+        arrival[taken] = MISSING_TIME
+        for idx in np.argsort(arrival, kind='stable')[:missing]:
+            if not taken[idx]:
+                taken[idx] = True
+                vehicles[cluster_idx].append(free_units[idx])
+
+    return vehicles
+
+
+def build_sub_data(data, pickup_nodes, units, vehicle_states):
+    "Data model of a cluster with the same layout as create_data_model."
+    pickup_nodes = sorted(pickup_nodes, key=lambda node: data['locations'][node]['minutes'])
+    locations = {0: defaultdict(int)}
+    pickups = []
+    demands = [0]
+    for pickup in pickup_nodes:
+        counter = len(locations)
+        locations[counter] = data['locations'][pickup]
+        locations[counter + 1] = data['locations'][pickup + 1]
+        pickups.append((counter, counter + 1))
+        demands.extend([1, -1])
+
+    starts = []
+    for unit in units:
+        starts.append(len(locations))
+        locations[len(locations)] = vehicle_states[unit]
+        demands.append(0)
+
+    location_ids = {location['id'] for node, location in locations.items() if node}
+    original_units = {data['locations'][node]['unidad'] for node in pickup_nodes}
+    return {
+        'date': data['date'],
+        'starts_definition': list(units),
+        'demands': demands,
+        'locations': locations,
+        'distances': data['distances'].subset(sorted(location_ids)),
+        'starts': starts,
+        'pickups_deliveries': pickups,
+        'ends': [0 for _ in range(len(starts))],
+        'num_vehicles': len(starts),
+        'key': data['key'],
+        'old_trip_info': (len(original_units), len(pickup_nodes)),
+        'warm_start_routes': {},
+    }
+
+
+def update_vehicle_states(data, vehicle_states, free_units):
+    "Move the units of a solved cluster to where and when they are free."
+    for unit, free_unit in free_units.items():
+        vehicle_states[unit] = dict(
+            vehicle_states[unit],
+            id=free_unit['location'],
+            minutes=int((free_unit['time'] - data['date']) / datetime.timedelta(minutes=1)),
+        )
+
+
+def merge_results(data, cluster_results, vehicle_states):
+    """
+    Merge the results of the clusters into the output of print_solution. cluster_results holds a
+    (name, sub_data, result) tuple per cluster in slab order. Trips are grouped by unit and an empty
+    trip is stitched in between the last location of a unit in one cluster and its first location
+    in the next one.
+    """
+    unit_trips = defaultdict(list)
+    routes = defaultdict(list)
+    schedules = defaultdict(list)
+    print_lines = []
+    for name, sub_data, result in cluster_results:
+        print_lines.append(
+            f"\nCluster {name}: {sub_data['old_trip_info'][1]} trips, {sub_data['num_vehicles']} vehicles\n")
+        print_lines.extend(result.get('print_lines', []))
+        for trip in result.get('trips', {}).values():
+            previous = unit_trips[trip['unidad']]
+            if previous and previous[-1]['cluster'] != name:
+                previous.append({
+                    'origen': previous[-1]['destino'],
+                    'destino': trip['origen'],
+                    'unidad': trip['unidad'],
+                    'inicio_datetime': previous[-1]['fin_datetime'],
+                    'fin_datetime': trip['inicio_datetime'],
+                    'carga': False,
+                    'cluster': name,
+                })
+            previous.append(dict(trip, cluster=name))
+        for unit, trip_ids in result.get('routes', {}).items():
+            routes[unit].extend(trip_ids)
+        for unit, schedule in result.get('schedule', {}).items():
+            schedules[unit].extend(schedule)
+
+    trips = {}
+    for unit in data['starts_definition']:
+        for trip in unit_trips.get(unit, []):
+            trip.pop('cluster')
+            trips[len(trips)] = trip
+
+    free_units = {
+        unit: {
+            'time': data['date'] + datetime.timedelta(minutes=int(state['minutes'])),
+            'location': state['id'],
+        }
+        for unit, state in vehicle_states.items()
+    }
+    free_units.update(get_pruned_free_units(data))
+
+    vehicles_used = sum(1 for trip_ids in routes.values() if trip_ids)
+    print_lines.append(f'\nAmount of trucks used by optimizer: {vehicles_used}\n\n')
+    return {
+        'print_lines': print_lines,
+        'trips': trips,
+        'free_units': free_units,
+        'routes': {unit: routes.get(unit, []) for unit in data['starts_definition']},
+        'schedule': {unit: schedules.get(unit, []) for unit in data['starts_definition']},
+    }
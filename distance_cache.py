@@ -0,0 +1,164 @@
+from collections import OrderedDict
+import threading
+
+import numpy as np
+
+from distance_matrix import MISSING_KM, MISSING_TIME, DistanceMatrix
+
+# Rows the matrices of the known pairs start with, they double every time they run out of rows.
+BLOCK_LOCATIONS = 256
+
+
+class DistanceCache:
+    """
+    Process level cache of distance matrices keyed by location set. The pairs already fetched are
+    kept in memory so a new location set only fetches the pairs of the locations that were never
+    seen, and the last matrices built are kept in LRU order.
+
+    Every known location has a row of the matrices of the known pairs. The matrices grow
+    geometrically up to max_locations rows, past them the least recently used locations are evicted
+    and their rows are taken by the new ones.
+
+    fetch_pairs(new_ids, all_ids) should return origin, destination, time and km sequences with the
+    pairs between the new locations and every location, and optionally a sequence flagging the
+    pairs that were estimated.
+    """
+
+    def __init__(self, fetch_pairs, max_matrices=16, max_locations=5000):
+        self.fetch_pairs = fetch_pairs
+        self.max_matrices = max_matrices
+        self.max_locations = max_locations
+        self.matrices = OrderedDict()
+        # Location id of every row of the known pairs, -1 for rows that are free.
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.last_used = np.zeros(0, dtype=np.int64)
+        self.time_matrix = np.zeros((0, 0), dtype=np.float64)
+        self.km_matrix = np.zeros((0, 0), dtype=np.float32)
+        self.estimated = np.zeros((0, 0), dtype=bool)
+        self.sorted_ids = np.zeros(0, dtype=np.int64)
+        self.sorted_rows = np.zeros(0, dtype=np.int64)
+        # Every get counts as an access, the rows of a location keep the access that last used it.
+        self.accesses = 0
+        self.hits = 0
+        self.misses = 0
+        self.fetched_locations = 0
+        self.evicted_locations = 0
+        self.lock = threading.Lock()
+
+    def get(self, location_ids):
+        "Matrix of the location set. Safe to call from the prefetch thread of a pipelined run."
+        with self.lock:
+            return self._get(frozenset(location_ids))
+
+    def _get(self, key):
+        self.accesses += 1
+        if key in self.matrices:
+            self.hits += 1
+            self.matrices.move_to_end(key)
+            rows = self.rows(self.matrices[key].ids)
+            self.last_used[rows[rows >= 0]] = self.accesses
+            return self.matrices[key]
+
+        self.misses += 1
+        location_ids = np.array(sorted(key), dtype=np.int64)
+        rows = self.rows(location_ids)
+        new_ids = location_ids[rows < 0]
+        if len(new_ids):
+            self.add_locations(new_ids, rows[rows >= 0])
+            rows = self.rows(location_ids)
+        self.last_used[rows] = self.accesses
+
+        matrix = DistanceMatrix(location_ids)
+        block = np.ix_(rows, rows)
+        matrix.time_matrix[:] = self.time_matrix[block]
+        matrix.km_matrix[:] = self.km_matrix[block]
+        matrix.estimated[:] = self.estimated[block]
+        matrix.pairs = matrix.count_pairs()
+
+        self.matrices[key] = matrix
+        if len(self.matrices) > self.max_matrices:
+            self.matrices.popitem(last=False)
+        return matrix
+
+    def rows(self, location_ids):
+        "Rows of the location ids in the matrices of the known pairs, -1 for unknown locations."
+        location_ids = np.asarray(location_ids, dtype=np.int64)
+        if not len(self.sorted_ids):
+            return np.full(location_ids.shape, -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.sorted_ids, location_ids), len(self.sorted_ids) - 1)
+        return np.where(self.sorted_ids[positions] == location_ids, self.sorted_rows[positions], -1)
+
+    def add_locations(self, new_ids, kept_rows):
+        """
+        Fetch the pairs of the new locations and give them a row, evicting or growing as needed.
+        The rows are only taken once the fetch succeeded, so a failed fetch is retried on the next
+        get instead of leaving the locations known without pairs.
+        """
+        self.evict(len(new_ids), kept_rows)
+        all_ids = np.union1d(self.ids[self.ids >= 0], new_ids)
+        pairs = self.fetch_pairs(new_ids.tolist(), all_ids.tolist())
+
+        if np.count_nonzero(self.ids < 0) < len(new_ids):
+            self.grow(np.count_nonzero(self.ids >= 0) + len(new_ids))
+        new_rows = np.flatnonzero(self.ids < 0)[:len(new_ids)]
+        self.ids[new_rows] = new_ids
+        self.time_matrix[new_rows, new_rows] = 0
+        self.km_matrix[new_rows, new_rows] = 0
+        used = np.flatnonzero(self.ids >= 0)
+        order = np.argsort(self.ids[used])
+        self.sorted_ids, self.sorted_rows = self.ids[used][order], used[order]
+
+        self.store_pairs(*pairs)
+        self.fetched_locations += len(new_ids)
+
+    def evict(self, count, kept_rows):
+        "Free the rows of the least recently used locations that are over max_locations."
+        used = np.flatnonzero(self.ids >= 0)
+        excess = len(used) + count - self.max_locations
+        if excess <= 0:
+            return
+        candidates = used[~np.isin(used, kept_rows)]
+        evicted = candidates[np.argsort(self.last_used[candidates], kind='stable')[:excess]]
+        self.ids[evicted] = -1
+        for matrix, missing in ((self.time_matrix, MISSING_TIME), (self.km_matrix, MISSING_KM), (self.estimated, False)):
+            matrix[evicted, :] = missing
+            matrix[:, evicted] = missing
+        self.evicted_locations += len(evicted)
+
+    def grow(self, needed):
+        "Double the rows of the matrices of the known pairs, to at least needed rows."
+        size = len(self.ids)
+        capacity = max(needed, min(max(2 * size, BLOCK_LOCATIONS), self.max_locations))
+        for name, missing in (('time_matrix', MISSING_TIME), ('km_matrix', MISSING_KM), ('estimated', False)):
+            matrix = getattr(self, name)
+            grown = np.full((capacity, capacity), missing, dtype=matrix.dtype)
+            grown[:size, :size] = matrix
+            setattr(self, name, grown)
+        self.ids = np.concatenate([self.ids, np.full(capacity - size, -1, dtype=np.int64)])
+        self.last_used = np.concatenate([self.last_used, np.zeros(capacity - size, dtype=np.int64)])
+
+    def store_pairs(self, origins, destinations, times, kilometers, estimated=()):
+        origins = self.rows(origins)
+        destinations = self.rows(destinations)
+        known = (origins >= 0) & (destinations >= 0)
+        origins, destinations = origins[known], destinations[known]
+        times = np.asarray(times, dtype=np.float64)[known]
+        kilometers = np.asarray(kilometers, dtype=np.float32)[known]
+        estimated = np.asarray(estimated, dtype=bool)[known] if len(estimated) else False
+
+        self.time_matrix[origins, destinations] = times
+        self.time_matrix[destinations, origins] = times
+        self.km_matrix[origins, destinations] = kilometers
+        self.km_matrix[destinations, origins] = kilometers
+        self.estimated[origins, destinations] = estimated
+        self.estimated[destinations, origins] = estimated
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'fetched_locations': self.fetched_locations,
+            'evicted_locations': self.evicted_locations,
+            'known_locations': len(self.sorted_ids),
+            'estimated_pairs': int(np.triu(self.estimated, 1).sum()),
+        }
@@ -0,0 +1,105 @@
+import numpy as np
+
+MISSING_TIME = 99999999999999
+MISSING_KM = np.nan
+
+
+class DistanceMatrix:
+    """
+    Dense travel time and kilometers between a set of locations. Location ids are mapped once to
+    indices of the arrays, the matrices are filled symmetrically and pairs that aren't known hold
+    MISSING_TIME (time) and MISSING_KM (kilometers). A location to itself is 0. Pairs that were
+    estimated instead of calculated are flagged in the estimated matrix.
+    """
+
+    def __init__(self, location_ids, origins=(), destinations=(), times=(), kilometers=(), estimated=()):
+        self.ids = np.unique(np.asarray(location_ids, dtype=np.int64))
+        self.index = {location_id: idx for idx, location_id in enumerate(self.ids.tolist())}
+
+        size = len(self.ids)
+        self.time_matrix = np.full((size, size), MISSING_TIME, dtype=np.float64)
+        self.km_matrix = np.full((size, size), MISSING_KM, dtype=np.float32)
+        np.fill_diagonal(self.time_matrix, 0)
+        np.fill_diagonal(self.km_matrix, 0)
+        self.estimated = np.zeros((size, size), dtype=bool)
+
+        origins = self.indices(origins)
+        destinations = self.indices(destinations)
+        known = (origins >= 0) & (destinations >= 0)
+        origins, destinations = origins[known], destinations[known]
+        times = np.asarray(times, dtype=np.float64)[known]
+        kilometers = np.asarray(kilometers, dtype=np.float32)[known]
+        estimated = np.asarray(estimated, dtype=bool) if len(estimated) else np.zeros(len(known), dtype=bool)
+        estimated = estimated[known]
+
+        self.time_matrix[origins, destinations] = times
+        self.time_matrix[destinations, origins] = times
+        self.km_matrix[origins, destinations] = kilometers
+        self.km_matrix[destinations, origins] = kilometers
+        self.estimated[origins, destinations] = estimated
+        self.estimated[destinations, origins] = estimated
+        self.pairs = self.count_pairs()
+
+    def __bool__(self):
+        return self.pairs > 0
+
+    def __contains__(self, location_id):
+        return location_id in self.index
+
+    def subset(self, location_ids):
+        "DistanceMatrix of some of the locations, copied from this one."
+        matrix = DistanceMatrix(location_ids)
+        indices = self.indices(matrix.ids)
+        known = indices >= 0
+        matrix.time_matrix[np.ix_(known, known)] = self.time_matrix[np.ix_(indices[known], indices[known])]
+        matrix.km_matrix[np.ix_(known, known)] = self.km_matrix[np.ix_(indices[known], indices[known])]
+        matrix.estimated[np.ix_(known, known)] = self.estimated[np.ix_(indices[known], indices[known])]
+        np.fill_diagonal(matrix.time_matrix, 0)
+        np.fill_diagonal(matrix.km_matrix, 0)
+        matrix.pairs = matrix.count_pairs()
+        return matrix
+
+    def count_pairs(self):
+        "Amount of location pairs with a known time, every pair counted once."
+        return int(np.triu(self.time_matrix != MISSING_TIME, 1).sum())
+
+    def estimated_pairs(self):
+        "Amount of pairs whose time and kilometers are estimates."
+        return int(np.triu(self.estimated, 1).sum())
+
+    def indices(self, location_ids):
+        "Array indices of the location ids, -1 for locations that are not in the matrix."
+        location_ids = np.asarray(location_ids, dtype=np.int64)
+        if not len(self.ids):
+            return np.full(location_ids.shape, -1, dtype=np.int64)
+        positions = np.searchsorted(self.ids, location_ids)
+        positions = np.minimum(positions, len(self.ids) - 1)
+        return np.where(self.ids[positions] == location_ids, positions, -1)
+
+    def time(self, origin, destination):
+        try:
+            return self.time_matrix[self.index[origin], self.index[destination]]
+        except KeyError:
+            return MISSING_TIME
+
+    def km(self, origin, destination):
+        try:
+            return self.km_matrix[self.index[origin], self.index[destination]]
+        except KeyError:
+            return MISSING_KM
+
+    def times(self, origins, destinations):
+        "Travel times for every origin, destination pair of two arrays."
+        return self._lookup(self.time_matrix, MISSING_TIME, origins, destinations)
+
+    def kms(self, origins, destinations):
+        "Kilometers for every origin, destination pair of two arrays."
+        return self._lookup(self.km_matrix, MISSING_KM, origins, destinations)
+
+    def _lookup(self, matrix, missing, origins, destinations):
+        origins = self.indices(origins)
+        destinations = self.indices(destinations)
+        known = (origins >= 0) & (destinations >= 0)
+        values = np.full(origins.shape, missing, dtype=matrix.dtype)
+        values[known] = matrix[origins[known], destinations[known]]
+        return values
@@ -0,0 +1,193 @@
+import json
+import os
+import threading
+
+import numpy as np
+
+import database
+
+STORE_DIR = "./csvs/distance_store"
+MISSING_MINUTES = np.iinfo(np.uint16).max
+MISSING_KM = np.nan
+
+DISTANCE_STORE = None
+DISTANCE_STORE_LOCK = threading.Lock()
+
+
+def pair_offsets(first, second):
+    """
+    Offsets of the (first, second) index pairs in the triangular arrays. Pairs are stored by the
+    larger index, so all the pairs of a location are appended after the ones of the locations that
+    were added before it and adding a location never moves existing values.
+    """
+    first = np.asarray(first, dtype=np.int64)
+    second = np.asarray(second, dtype=np.int64)
+    lower = np.minimum(first, second)
+    upper = np.maximum(first, second)
+    return upper * (upper - 1) // 2 + lower
+
+
+class DistanceStore:
+    """
+    Upper-triangular distance store memory-mapped from disk. The header (ids.npy) maps every
+    location id to its index in insertion order, minutes.bin holds the travel time in minutes as
+    uint16 and km.bin the kilometers as float32 for every pair of indices. Pairs that weren't
+    calculated hold MISSING_MINUTES and MISSING_KM.
+    """
+
+    def __init__(self, path=STORE_DIR, mode='r'):
+        self.path = path
+        self.mode = mode
+        self.ids = np.load(os.path.join(path, "ids.npy"))
+        self._index_ids()
+        self._map_arrays()
+
+    def _index_ids(self):
+        self.order = np.argsort(self.ids, kind='stable')
+        self.sorted_ids = self.ids[self.order]
+
+    def _map_arrays(self):
+        size = len(self.ids) * (len(self.ids) - 1) // 2
+        if size:
+            self.minutes = np.memmap(os.path.join(self.path, "minutes.bin"),
+                                     dtype=np.uint16, mode=self.mode, shape=(size, ))
+            self.km = np.memmap(os.path.join(self.path, "km.bin"),
+                                dtype=np.float32, mode=self.mode, shape=(size, ))
+        else:
+            self.minutes = np.zeros(0, dtype=np.uint16)
+            self.km = np.zeros(0, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def indices(self, location_ids):
+        "Indices of the location ids, -1 for locations that are not in the store."
+        location_ids = np.asarray(location_ids, dtype=np.int64)
+        if not len(self.ids):
+            return np.full(location_ids.shape, -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.sorted_ids, location_ids), len(self.ids) - 1)
+        return np.where(self.sorted_ids[positions] == location_ids, self.order[positions], -1)
+
+    def submatrix(self, location_ids):
+        """
+        Minutes and kilometers between every pair of the location ids. Only the pages holding the
+        requested pairs are read from disk.
+        """
+        return self.block(location_ids, location_ids)
+
+    def block(self, origin_ids, destination_ids):
+        "Minutes and kilometers from every origin to every destination, 0 from a location to itself."
+        origin_ids = np.asarray(origin_ids, dtype=np.int64)
+        destination_ids = np.asarray(destination_ids, dtype=np.int64)
+        first, second = np.meshgrid(
+            self.indices(origin_ids), self.indices(destination_ids), indexing='ij')
+        known = (first >= 0) & (second >= 0) & (first != second)
+
+        offsets = pair_offsets(first[known], second[known])
+        minutes = np.full(first.shape, MISSING_MINUTES, dtype=np.uint16)
+        km = np.full(first.shape, MISSING_KM, dtype=np.float32)
+        minutes[known] = self.minutes[offsets]
+        km[known] = self.km[offsets]
+
+        same = origin_ids[:, None] == destination_ids[None, :]
+        minutes[same] = 0
+        km[same] = 0
+        return minutes, km
+
+    def add_locations(self, location_ids):
+        "Append the locations that are not in the store yet. Existing pairs are not moved."
+        location_ids = np.unique(np.asarray(location_ids, dtype=np.int64))
+        new_ids = location_ids[self.indices(location_ids) < 0]
+        if not len(new_ids):
+            return
+
+        old_size = len(self.ids) * (len(self.ids) - 1) // 2
+        self.ids = np.concatenate([self.ids, new_ids.astype(self.ids.dtype)])
+        new_size = len(self.ids) * (len(self.ids) - 1) // 2
+
+        self.flush()
+        for name, dtype, missing in (('minutes.bin', np.uint16, MISSING_MINUTES), ('km.bin', np.float32, MISSING_KM)):
+            with open(os.path.join(self.path, name), "ab") as f:
+                np.full(new_size - old_size, missing, dtype=dtype).tofile(f)
+
+        write_header(self.path, self.ids)
+        self._index_ids()
+        self._map_arrays()
+
+    def set_pairs(self, origins, destinations, minutes, km):
+        """
+        Patch the pairs in place, appending the locations that are not in the store yet. Pairs of a
+        location to itself are ignored, they have no offset of their own.
+        """
+        self.add_locations(np.concatenate([np.asarray(origins), np.asarray(destinations)]))
+        origins = self.indices(origins)
+        destinations = self.indices(destinations)
+        different = origins != destinations
+        offsets = pair_offsets(origins[different], destinations[different])
+        self.minutes[offsets] = np.clip(np.asarray(minutes)[different], 0, MISSING_MINUTES - 1)
+        self.km[offsets] = np.asarray(km)[different]
+
+    def flush(self):
+        for values in (self.minutes, self.km):
+            if isinstance(values, np.memmap):
+                values.flush()
+
+
+def write_header(path, ids):
+    "Write the id header atomically, the arrays are always extended before it."
+    with open(os.path.join(path, "ids.tmp.npy"), "wb") as f:
+        np.save(f, ids)
+    os.replace(os.path.join(path, "ids.tmp.npy"), os.path.join(path, "ids.npy"))
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump({'locations': len(ids)}, f)
+
+
+def create_distance_store(location_ids, path=STORE_DIR):
+    "Create an empty store with every pair of the locations missing."
+    os.makedirs(path, exist_ok=True)
+    for name in ('minutes.bin', 'km.bin'):
+        open(os.path.join(path, name), "wb").close()
+    write_header(path, np.zeros(0, dtype=np.int32))
+
+    store = DistanceStore(path, mode='r+')
+    store.add_locations(location_ids)
+    return store
+
+
+def open_distance_store(path=STORE_DIR):
+    "Open the store once per process, None when it wasn't built."
+    global DISTANCE_STORE
+    with DISTANCE_STORE_LOCK:
+        if DISTANCE_STORE is None and os.path.isfile(os.path.join(path, "ids.npy")):
+            DISTANCE_STORE = DistanceStore(path)
+    return DISTANCE_STORE
+
+
+def build_distance_store(path=STORE_DIR, batch_size=100000):
+    "Build the store from the ubicaciones_mexico and distancias_mexico tables."
+    with database.connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT ubicacion_id FROM ubicaciones_mexico;")
+            location_ids = [item[0] for item in cursor.fetchall()]
+
+        store = create_distance_store(location_ids, path)
+
+        with connection.cursor(name='distance_store') as cursor:
+            cursor.itersize = batch_size
+            cursor.execute(
+                "SELECT ubicacion_id_origen, ubicacion_id_destino, tiempo, distancia FROM distancias_mexico;")
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                origins, destinations, times, distances = zip(*rows)
+                store.set_pairs(origins, destinations, np.asarray(times, dtype=np.int64),
+                                np.asarray(distances, dtype=np.float32))
+
+    store.flush()
+    return store
+
+
+if __name__ == '__main__':
+    store = build_distance_store()
+    print(f"Stored distances between {len(store)} locations in {STORE_DIR}")
@@ -1,15 +1,14 @@
 import csv
-import psycopg2
 import traceback
 
+import database
+
 def get_location_distances():
     distancias = None
     try:
-        conn = psycopg2.connect(database='assistcargo', user='*', password='*', host='localhost')
-        cur = conn.cursor()
-
-        cur.execute("SELECT ubicacion_id_origen, ubicacion_id_destino, tiempo FROM distancias;")
-        distancias = cur.fetchall()
+        with database.cursor() as cur:
+            cur.execute("SELECT ubicacion_id_origen, ubicacion_id_destino, tiempo FROM distancias;")
+            distancias = cur.fetchall()
     except Exception:
         traceback.print_exc()
 
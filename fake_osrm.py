@@ -0,0 +1,118 @@
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+from math import asin, cos, radians, sin, sqrt
+import random
+from threading import Thread
+from time import sleep
+from urllib.parse import parse_qs, urlsplit
+
+TABLE_PATH = '/table/v1/driving/'
+EARTH_RADIUS = 6371000
+# Road distance over the straight line distance and average speed of the fake routes.
+ROAD_FACTOR = 1.3
+SPEED_KMH = 60
+# Coordinates accepted per request, like the default --max-table-size of osrm-routed.
+MAX_TABLE_SIZE = 100
+
+
+def haversine(lat_1, long_1, lat_2, long_2):
+    "Straight line distance in meters."
+    lat_1, long_1, lat_2, long_2 = map(radians, (lat_1, long_1, lat_2, long_2))
+    a = sin((lat_2 - lat_1) / 2) ** 2 + cos(lat_1) * cos(lat_2) * sin((long_2 - long_1) / 2) ** 2
+    return 2 * EARTH_RADIUS * asin(sqrt(a))
+
+
+def build_table(coordinates, sources, destinations):
+    "Distances in meters and durations in seconds from every source to every destination."
+    distances = [
+        [round(haversine(coordinates[source][1], coordinates[source][0],
+                         coordinates[destination][1], coordinates[destination][0]) * ROAD_FACTOR, 1)
+         for destination in destinations]
+        for source in sources
+    ]
+    durations = [[round(distance / (SPEED_KMH / 3.6), 1) for distance in row] for row in distances]
+    return distances, durations
+
+
+class FakeOsrmHandler(BaseHTTPRequestHandler):
+    """
+    Answers /table/v1/driving/{long,lat;...}?sources=...&destinations=... like an OSRM server would, with distances
+    and durations derived from the coordinates so every run returns the same values. The server can
+    delay and fail a share of the requests to exercise the retries of a client.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if not url.path.startswith(TABLE_PATH):
+            return self.respond(404, {'code': 'InvalidUrl'})
+
+        if self.server.delay:
+            sleep(self.server.delay)
+        if self.server.failure_rate and random.random() < self.server.failure_rate:
+            return self.respond(503, {'code': 'Unavailable'})
+
+        try:
+            coordinates = [
+                tuple(float(value) for value in coordinate.split(','))
+                for coordinate in url.path[len(TABLE_PATH):].split(';')
+            ]
+            query = parse_qs(url.query)
+            sources, destinations = (
+                list(range(len(coordinates))) if indices == 'all' else [int(index) for index in indices.split(';')]
+                for indices in (query.get('sources', ['all'])[0], query.get('destinations', ['all'])[0])
+            )
+            if max(sources + destinations) >= len(coordinates):
+                raise ValueError
+        except ValueError:
+            return self.respond(400, {'code': 'InvalidQuery'})
+        if len(coordinates) > self.server.max_table_size:
+            return self.respond(400, {'code': 'TooBig'})
+
+        distances, durations = build_table(coordinates, sources, destinations)
+        self.respond(200, {'code': 'Ok', 'distances': distances, 'durations': durations})
+
+    def respond(self, status, body):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fake_osrm(port=0, delay=0, failure_rate=0, max_table_size=MAX_TABLE_SIZE):
+    "Serve the fake OSRM in a background thread. Returns the server, server.server_port has the port."
+    server = ThreadingHTTPServer(('localhost', port), FakeOsrmHandler)
+    server.daemon_threads = True
+    server.delay = delay
+    server.failure_rate = failure_rate
+    server.max_table_size = max_table_size
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def table_url(port):
+    return f'http://localhost:{port}{TABLE_PATH}{{locations}}?annotations=distance,duration'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--port', type=int, help='Port to listen on', action='store', default=5000)
+    parser.add_argument('-d', '--delay', type=float, help='Seconds to wait before answering', action='store', default=0)
+    parser.add_argument('-f', '--failure_rate', type=float, help='Share of requests answered with a 503', action='store', default=0)
+    parser.add_argument('-t', '--max_table_size', type=int, help='Coordinates accepted per request', action='store', default=MAX_TABLE_SIZE)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('localhost', args.port), FakeOsrmHandler)
+    server.daemon_threads = True
+    server.delay = args.delay
+    server.failure_rate = args.failure_rate
+    server.max_table_size = args.max_table_size
+    print(f"Fake OSRM listening on {table_url(args.port)}")
+    server.serve_forever()
@@ -0,0 +1,158 @@
+import csv
+import datetime
+import os
+
+import numpy as np
+
+from trips_cache import datetime_to_minutes, minutes_to_datetime
+
+FLEET_STATE_DIR = "optimizer_results"
+# Days solved between snapshots of the fleet state in a month run.
+SNAPSHOT_DAYS = 7
+
+FLEET_STATES = {}
+
+
+class FleetState:
+    """
+    Where and when every unit of a unit type is free, held in arrays of unit id, free-at minute
+    (minutes since the epoch, like the trip cache) and location. The state is updated in place from
+    the free units of every solution and only written to disk by snapshot. Units free at a location
+    are answered from an index sorted by location and free-at minute, rebuilt after updates.
+    """
+
+    def __init__(self, key, unit_ids=(), free_at=(), locations=()):
+        self.key = key
+        self.unit_ids = np.asarray(unit_ids, dtype=np.int64)
+        self.free_at = np.asarray(free_at, dtype=np.int64)
+        self.locations = np.asarray(locations, dtype=np.int64)
+        self.positions = {unit: position for position, unit in enumerate(self.unit_ids.tolist())}
+        self.index = None
+
+    def __len__(self):
+        return len(self.unit_ids)
+
+    def update(self, free_units):
+        "Set the free time and location of the units of a solution, adding the units not seen before."
+        new_units = [int(unit) for unit in free_units if int(unit) not in self.positions]
+        if new_units:
+            self.positions.update({unit: len(self.unit_ids) + idx for idx, unit in enumerate(new_units)})
+            self.unit_ids = np.concatenate([self.unit_ids, np.asarray(new_units, dtype=np.int64)])
+            self.free_at = np.concatenate([self.free_at, np.zeros(len(new_units), dtype=np.int64)])
+            self.locations = np.concatenate([self.locations, np.zeros(len(new_units), dtype=np.int64)])
+
+        positions = np.array([self.positions[int(unit)] for unit in free_units], dtype=np.int64)
+        self.free_at[positions] = [datetime_to_minutes(unit['time']) for unit in free_units.values()]
+        self.locations[positions] = [int(unit['location']) for unit in free_units.values()]
+        self.index = None
+
+    def build_index(self):
+        order = np.lexsort((self.free_at, self.locations))
+        self.index = (order, self.locations[order], self.free_at[order])
+
+    def free_at_location(self, location_id, minute):
+        "Ids of the units that are free at the location at or before the minute, earliest free first."
+        if self.index is None:
+            self.build_index()
+        order, locations, free_at = self.index
+        first = np.searchsorted(locations, location_id, side='left')
+        last = np.searchsorted(locations, location_id, side='right')
+        last = first + np.searchsorted(free_at[first:last], minute, side='right')
+        return self.unit_ids[order[first:last]]
+
+    def starts(self, range_start, working_hours_start):
+        """
+        START node data of every unit for a day starting at range_start: where the unit is, the
+        minutes of the day at which it is free (0 when it was already free) and the earliest start
+        within working hours.
+        """
+        range_start = datetime_to_minutes(range_start)
+        day_delta = self.free_at // 1440 - range_start // 1440
+        minutes = np.maximum(self.free_at - range_start, 0)
+        start_range = np.maximum(working_hours_start + day_delta * 1440, minutes)
+        return {
+            unit: {
+                'id': location,
+                'minutes': unit_minutes,
+                'start_range': unit_start_range,
+                'end_range': 9999999,
+                'initial': True,
+            }
+            for unit, location, unit_minutes, unit_start_range in zip(
+                self.unit_ids.tolist(), self.locations.tolist(), minutes.tolist(), start_range.tolist())
+        }
+
+    def free_units(self):
+        "The state as the free units of a solution."
+        return {
+            unit: {'time': minutes_to_datetime(free_at), 'location': location}
+            for unit, free_at, location in zip(self.unit_ids.tolist(), self.free_at.tolist(), self.locations.tolist())
+        }
+
+    def snapshot(self, path=FLEET_STATE_DIR):
+        """
+        Write the state and the free units csv of the unit type. Both files are written to a
+        temporary file first and replaced at once, a crash never leaves a partial state.
+        """
+        state_file = os.path.join(path, f"fleet_state_{self.key}.npz")
+        with open(f"{state_file}.tmp", "wb") as f:
+            np.savez(f, unit_ids=self.unit_ids, free_at=self.free_at, locations=self.locations)
+        os.replace(f"{state_file}.tmp", state_file)
+
+        csv_file = os.path.join(path, f"free_units_{self.key}.csv")
+        with open(f"{csv_file}.tmp", "w", newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['unit_id', 'free_time', 'location'])
+            writer.writerows(zip(
+                self.unit_ids.tolist(), [minutes_to_datetime(minute) for minute in self.free_at.tolist()],
+                self.locations.tolist()))
+        os.replace(f"{csv_file}.tmp", csv_file)
+
+
+def index_vehicle_states(units, vehicle_states):
+    """
+    State of the units taken from the vehicle states of a day, to query the units waiting at a
+    location. The free-at minutes are the minutes of the day of the states, the position of every
+    unit in the arrays is its position in units.
+    """
+    return FleetState(
+        None, units, [vehicle_states[unit]['minutes'] for unit in units],
+        [vehicle_states[unit]['id'] for unit in units])
+
+
+def read_fleet_state(key, path=FLEET_STATE_DIR):
+    """
+    State of the unit type from its last snapshot, or from the free units csv of an older run. An
+    empty state when there is neither.
+    """
+    state_file = os.path.join(path, f"fleet_state_{key}.npz")
+    if os.path.isfile(state_file):
+        with np.load(state_file) as saved:
+            return FleetState(key, saved['unit_ids'], saved['free_at'], saved['locations'])
+
+    try:
+        with open(os.path.join(path, f"free_units_{key}.csv"), "r", encoding="ISO-8859-1") as f:
+            units_list = list(csv.DictReader(f))
+    except OSError:
+        return FleetState(key)
+    return FleetState(
+        key,
+        [int(unit['unit_id']) for unit in units_list],
+        [datetime_to_minutes(datetime.datetime.strptime(unit['free_time'], "%Y-%m-%d %H:%M:%S"))
+         for unit in units_list],
+        [int(unit['location']) for unit in units_list],
+    )
+
+
+def get_fleet_state(key):
+    "Load the state of a unit type once per process, every later day uses the one in memory."
+    if key not in FLEET_STATES:
+        FLEET_STATES[key] = read_fleet_state(key)
+    return FLEET_STATES[key]
+
+
+def snapshot_fleet_states():
+    "Snapshot the state of every unit type loaded in this process that has units."
+    for state in FLEET_STATES.values():
+        if len(state):
+            state.snapshot()
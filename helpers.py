@@ -1,172 +1,78 @@
 import csv
-import datetime
 from math import ceil
 import os
-import psycopg2
+import threading
 import traceback
-import re
 from collections import defaultdict
 
-HOUR_REGEX = r"\d{1,2}:\d{1,2}:\d{1,2}\s[ap].m."
+import numpy as np
+
+import database
+from distance_cache import DistanceCache
+from distance_store import MISSING_MINUTES, open_distance_store
+from fleet_state import get_fleet_state
+from location_registry import get_location_registry
+from travel_time_estimator import get_estimator, save_estimated_pairs
+from trips_cache import INVALID_MINUTES, datetime_to_minutes, load_trip_index, minutes_to_datetime
+
 WORKING_HOURS_START = 420
 WORKING_HOURS_END = 1080
+# Fill the pairs that were never calculated with estimates from the coordinates instead of
+# leaving them as infeasible arcs. The estimated pairs are listed in the estimated pairs csv of
+# travel_time_estimator for a later backfill.
+ESTIMATE_MISSING_DISTANCES = False
+
+TRIP_INDEX = None
+DISTANCE_CACHE = None
+# The prefetch thread of a pipelined run and the main thread can both be the first to load them.
+LOAD_LOCK = threading.Lock()
 
 
 def build_locations_set(trips, key):
     "Build set of locations that will be used in the optimization using the trips from the database."
-    units_list = []
-    if key:
-        try:
-            with open(f"optimizer_results/free_units_{key}.csv", "r", encoding="ISO-8859-1") as f:
-                reader = csv.DictReader(f)
-                units_list = list(reader)
-        except Exception:
-            pass
-
-    locations = set([trip['origen'] for trip in trips.values()]) | set(
-        [trip['destino'] for trip in trips.values()]) | set([u['location'] for u in units_list])
-    ubicaciones = []
-    try:
-        conn = psycopg2.connect(
-            database='assistcargo', user='*', password='*', host='localhost')
-        cur = conn.cursor()
-
-        cur.execute(
-            """
-            SELECT ubicacion_id
-            FROM ubicaciones_mexico
-            WHERE ubicacion_id = ANY(%s);
-            """,
-            (list(locations), )
-        )
-        ubicaciones_disponibles = cur.fetchall()
-        ubicaciones = [a[0] for a in ubicaciones_disponibles]
-    except Exception:
-        traceback.print_exc()
-
-    return ubicaciones
-
-
-def filter_trips_range(trips, key=None):
-    """"
-    Filter the trips that occur on the date range and discard others. Also discard trips that don't
-    have a clear way of calculating start and end date.
-    """
+    unit_locations = get_fleet_state(key).locations if key else np.zeros(0, dtype=np.int64)
 
-    filtered_trips = {}
-    for trip_id, data in trips.items():
-        try:
-            hora_inicio_re = re.fullmatch(HOUR_REGEX, data['hora_inicio'])
-            hora_fin_re = re.fullmatch(HOUR_REGEX, data['hora_fin'])
-
-            if not (hora_inicio_re and hora_fin_re):
-                continue
-
-            hora_inicio = data['hora_inicio'].upper().replace(
-                ':', ' ').replace('.', '')
-            hora_fin = data['hora_fin'].upper().replace(
-                ':', ' ').replace('.', '')
-            hora_inicio = datetime.datetime.strptime(
-                hora_inicio, "%I %M %S %p")
-            hora_fin = datetime.datetime.strptime(hora_fin, "%I %M %S %p")
-
-            inicio = datetime.datetime(
-                int(data['fecha_inicio'][:4]),
-                int(data['fecha_inicio'][4:6]),
-                int(data['fecha_inicio'][6:]),
-                hora_inicio.hour,
-                hora_inicio.minute,
-            )
-            fin = datetime.datetime(
-                int(data['fecha_fin'][:4]),
-                int(data['fecha_fin'][4:6]),
-                int(data['fecha_fin'][6:]),
-                hora_fin.hour,
-                hora_fin.minute,
-            )
-
-            if inicio < DATE_RANGE_START or inicio >= DATE_RANGE_END:
-                continue
-
-            filtered_trips[trip_id] = {
-                'origen': data['origen'],
-                'destino': data['destino'],
-                'inicio_datetime': inicio,
-                'fin_datetime': fin,
-                'unidad': data['unidad'],
-                'tipo_unidad': data['tipo_unidad']
-            }
-        except Exception:
-            traceback.print_exc()
-            continue
+    locations = np.unique(np.concatenate([trips['origen'], trips['destino'], unit_locations]))
 
-    locations = build_locations_set(filtered_trips, key)
+    return locations[get_location_registry().contains(locations)].tolist()
 
-    filtered_trips = {
-        k: v for k, v in filtered_trips.items()
-        if v['origen'] in locations and v['destino'] in locations
-    }
 
-    return filtered_trips, locations
+def select_trips(trips, mask):
+    "Keep the rows of the trips arrays where mask is true."
+    return {column: values[mask] for column, values in trips.items()}
 
 
-def calculate_start_end_datetime(trips):
-    "Calculate the start and end datetimes in minutes from the start of the date range for one trip."
-    trips_dict = {}
-    for trip_id, data in trips.items():
+def filter_trips_range(trips, range_start, key=None):
+    """"
+    Filter the trips of the date range (already sliced by the trip index) and discard trips that
+    don't have a clear way of calculating start and end date or whose locations are not available.
+    Also calculate the start and end datetimes in minutes from the start of the date range. Every
+    step works on whole columns instead of one trip at a time.
+    """
+    trips = select_trips(
+        trips, (trips['inicio'] != INVALID_MINUTES) & (trips['fin'] != INVALID_MINUTES))
 
-        initial_timedelta = data['inicio_datetime'] - DATE_RANGE_START
-        initial_minutes = initial_timedelta.days * \
-            24 * 60 + initial_timedelta.seconds // 60
+    locations = build_locations_set(trips, key)
 
-        end_timedelta = data['fin_datetime'] - DATE_RANGE_START
-        end_minutes = end_timedelta.days * 24 * 60 + end_timedelta.seconds // 60
+    trips = select_trips(
+        trips, np.isin(trips['origen'], locations) & np.isin(trips['destino'], locations))
 
-        trips_dict[trip_id] = {
-            'origen': data['origen'],
-            'destino': data['destino'],
-            'inicio_datetime': data['inicio_datetime'],
-            'fin_datetime': data['fin_datetime'],
-            'inicio_minutes': initial_minutes,
-            'fin_minutes': end_minutes,
-            'unidad': data['unidad'],
-            'tipo_unidad': data['tipo_unidad'],
-        }
+    range_start = datetime_to_minutes(range_start)
+    trips['inicio_minutes'] = trips['inicio'] - range_start
+    trips['fin_minutes'] = trips['fin'] - range_start
+    trips['day_delta'] = trips['inicio'] // 1440 - range_start // 1440
 
-    return trips_dict
+    return trips, locations
 
 
-def read_units_locations(key):
-    starts_data = {}
-    units_list = []
-    if key:
-        try:
-            with open(f"optimizer_results/free_units_{key}.csv", "r", encoding="ISO-8859-1") as f:
-                reader = csv.DictReader(f)
-                units_list = list(reader)
-        except Exception:
-            return {}
-
-    for unit in units_list:
-        free_time = datetime.datetime.strptime(
-            unit['free_time'], "%Y-%m-%d %H:%M:%S")
-        starting_delta = int((free_time.date() - DATE_RANGE_START.date()).days)
-        initial_minutes = 0
-        if free_time > DATE_RANGE_START:
-            initial_timedelta = free_time - DATE_RANGE_START
-            initial_minutes = initial_timedelta.days * \
-                24 * 60 + initial_timedelta.seconds // 60
-        starts_data[unit['unit_id']] = {
-            'id': unit['location'],
-            'minutes': initial_minutes,
-            'start_range': max(WORKING_HOURS_START + (starting_delta * 1440), initial_minutes),
-            'end_range': 9999999,
-            'initial': True,
-        }
-    return starts_data
+def read_units_locations(key, range_start):
+    "START data of the units of the unit type, from the fleet state kept in memory."
+    if not key:
+        return {}
+    return get_fleet_state(key).starts(range_start, WORKING_HOURS_START)
 
 
-def build_locations(trips, distances, key=None):
+def build_locations(trips, distances, range_start, key=None):
     """
     Calculate locations dictionary with incremental ids. Also build pickup and deliveries tuples.
     The locations dictionary should look something like this:
@@ -189,32 +95,35 @@ def build_locations(trips, distances, key=None):
     counter = 1
     pickups = []
 
-    sorted_trips = sorted(
-        trips.values(), key=lambda trip: trip['inicio_minutes'])
+    order = np.argsort(trips['inicio_minutes'], kind='stable')
+    sorted_trips = zip(*[
+        trips[column][order].tolist()
+        for column in ('viaje_id', 'origen', 'destino', 'inicio_minutes', 'fin_minutes', 'day_delta', 'unidad')
+    ])
 
-    starts_data = read_units_locations(key)
+    starts_data = read_units_locations(key, range_start)
     starts = []
     starts_definition = []
     demands = [0]
 
-    for values in sorted_trips:
-        starting_delta = int(
-            (values['inicio_datetime'].date() - DATE_RANGE_START.date()).days)
+    for viaje_id, origen, destino, inicio_minutes, fin_minutes, starting_delta, unidad in sorted_trips:
         locations[counter] = {
-            'id': values['origen'],
-            'minutes': values['inicio_minutes'],
-            'start_range': min(WORKING_HOURS_START + (starting_delta * 1440), values['inicio_minutes']),
-            'end_range': max(WORKING_HOURS_END + (starting_delta * 1440), values['inicio_minutes']),
+            'id': origen,
+            'viaje_id': viaje_id,
+            'unidad': unidad,
+            'minutes': inicio_minutes,
+            'start_range': min(WORKING_HOURS_START + (starting_delta * 1440), inicio_minutes),
+            'end_range': max(WORKING_HOURS_END + (starting_delta * 1440), inicio_minutes),
             'day_delta': starting_delta,
             'type': 'PICKUP'
         }
-        destination_delta = ceil(distances[min(values['origen'], values['destino'])][max(
-            values['origen'], values['destino'])] / 1440)
+        destination_delta = ceil(distances.time(origen, destino) / 1440)
         destination_delta = (destination_delta + 1) * 2
         locations[counter + 1] = {
-            'id': values['destino'],
-            'minutes_start': values['inicio_minutes'],
-            'minutes': values['fin_minutes'],
+            'id': destino,
+            'viaje_id': viaje_id,
+            'minutes_start': inicio_minutes,
+            'minutes': fin_minutes,
             'start_range': int(WORKING_HOURS_START + (starting_delta * 1440)),
             'end_range': int(WORKING_HOURS_END + (destination_delta * 1440)),
             'remove_ranges': [(WORKING_HOURS_END + (1440 * a) + 1, WORKING_HOURS_START + (a + 1) * 1440 - 1) for a in range(0, destination_delta)],
@@ -224,16 +133,16 @@ def build_locations(trips, distances, key=None):
         demands.extend([1, -1])
         counter += 2
 
-        if not starts_data.get(values['unidad']):
-            starts_data[values['unidad']] = {
-                'id': values['origen'],
-                'minutes': values['inicio_minutes'],
-                'start_range': min(WORKING_HOURS_START + (starting_delta * 1440), values['inicio_minutes']),
+        if not starts_data.get(unidad):
+            starts_data[unidad] = {
+                'id': origen,
+                'minutes': inicio_minutes,
+                'start_range': min(WORKING_HOURS_START + (starting_delta * 1440), inicio_minutes),
                 'end_range': 9999999,
             }
-        elif starts_data[values['unidad']].get('initial'):
-            starts_data[values['unidad']]['initial'] = True
-            starts_data[values['unidad']]['id'] = values['origen']
+        elif starts_data[unidad].get('initial'):
+            starts_data[unidad]['initial'] = True
+            starts_data[unidad]['id'] = origen
 
     for unidad, unidad_data in starts_data.items():
         locations[counter] = {
@@ -252,105 +161,206 @@ def build_locations(trips, distances, key=None):
     return locations, pickups, starts, demands, starts_definition
 
 
-def get_location_distances(locations_set):
+def get_stored_distances(store, new_ids, all_ids):
+    "Read the known pairs from the new locations to every location from the distance store."
+    new_ids = np.asarray(new_ids, dtype=np.int64)
+    all_ids = np.asarray(all_ids, dtype=np.int64)
+    minutes, kilometers = store.block(new_ids, all_ids)
+    origins, destinations = np.nonzero(
+        (minutes != MISSING_MINUTES) & (new_ids[:, None] != all_ids[None, :]))
+    return (
+        new_ids[origins],
+        all_ids[destinations],
+        minutes[origins, destinations],
+        kilometers[origins, destinations],
+    )
+
+
+def pair_keys(origins, destinations):
+    "One integer per unordered pair of location ids."
+    origins = np.asarray(origins, dtype=np.int64)
+    destinations = np.asarray(destinations, dtype=np.int64)
+    return np.minimum(origins, destinations) * (1 << 32) + np.maximum(origins, destinations)
+
+
+def get_pair_keys(new_ids, all_ids):
     """
-    The distances dictionary should look something like this:
-        {
-            30000: {
-                30001: ... # Distance in time.
-                30002: ...
-            },
-            30001: {
-                30002: ...
-            },
-            ...
-        }
+    Origins and destinations of the pairs between the new locations and every location, in both
+    directions, for the prepared distance lookup. Every pair is given once.
+    """
+    new_ids = np.asarray(new_ids, dtype=np.int64)
+    all_ids = np.asarray(all_ids, dtype=np.int64)
+    origins, destinations = np.meshgrid(new_ids, all_ids, indexing='ij')
+    different = origins != destinations
+    origins, destinations = origins[different], destinations[different]
+    keys = np.unique(np.concatenate([
+        origins * (1 << 32) + destinations,
+        destinations * (1 << 32) + origins,
+    ]))
+    return (keys >> 32).tolist(), (keys & ((1 << 32) - 1)).tolist()
+
+
+def estimate_missing_distances(new_ids, all_ids, origins, destinations):
     """
-    distancias = None
-
-    try:
-        conn = psycopg2.connect(
-            database='assistcargo', user='*', password='*', host='localhost')
-        cur = conn.cursor()
-
-        cur.execute(
-            """SELECT ubicacion_id_origen, ubicacion_id_destino, tiempo, distancia
-            FROM distancias_mexico
-            WHERE ubicacion_id_origen = ANY(%s) AND ubicacion_id_destino = ANY(%s);
-            """,
-            (locations_set, locations_set)
-        )
-        distancias = cur.fetchall()
-    except Exception:
-        traceback.print_exc()
-
-    if distancias:
-        # Armar diccionario con distancias reemplazando los tiempos de 0 por tiempos altos
-        dist_dict = defaultdict(dict)
-        km_dict = defaultdict(dict)
-        for orig, dest, time, distancia in distancias:
-            dist_dict[orig][dest] = int(time) * 1.6 if time != 0 else 99999
-            km_dict[orig][dest] = float(distancia)
-        return dict(dist_dict), dict(km_dict)
+    Estimate the pairs between the new locations and every location that are not among the fetched
+    pairs. Pairs of locations without coordinates are left out. Every estimated pair is appended to
+    the estimated pairs csv so it can be backfilled.
+    """
+    new_ids = np.unique(np.asarray(new_ids, dtype=np.int64))
+    all_ids = np.unique(np.asarray(all_ids, dtype=np.int64))
+    missing_origins, missing_destinations = np.meshgrid(new_ids, all_ids, indexing='ij')
+    # A pair of two new locations is estimated once, from the smaller id.
+    wanted = (missing_origins != missing_destinations) & ~(
+        np.isin(missing_destinations, new_ids) & (missing_destinations < missing_origins))
+    missing_origins, missing_destinations = missing_origins[wanted], missing_destinations[wanted]
+
+    fetched = np.isin(pair_keys(missing_origins, missing_destinations), pair_keys(origins, destinations))
+    missing_origins, missing_destinations = missing_origins[~fetched], missing_destinations[~fetched]
+
+    kilometers, minutes = get_estimator().estimate_pairs(missing_origins, missing_destinations)
+    estimated = np.isfinite(minutes)
+    missing_origins, missing_destinations = missing_origins[estimated], missing_destinations[estimated]
+    minutes, kilometers = minutes[estimated], kilometers[estimated]
+
+    save_estimated_pairs(missing_origins, missing_destinations, minutes, kilometers)
+    return missing_origins, missing_destinations, np.round(minutes), kilometers
+
+
+def fetch_location_distances(new_ids, all_ids):
+    """
+    Fetch the pairs between the new locations and every location from the distance store, or from
+    the database when the store wasn't built. Pairs that are not stored or have a time of 0 are
+    estimated from the coordinates and flagged, or get high times when estimates are disabled.
+    Times are the stored or estimated value plus a 60%.
+    """
+    store = open_distance_store()
+    if store is not None:
+        origins, destinations, times, kilometers = get_stored_distances(store, new_ids, all_ids)
     else:
-        return {}, {}
+        distancias = []
+        try:
+            distancias = database.get_many('distance_lookup', *get_pair_keys(new_ids, all_ids))
+        except Exception:
+            traceback.print_exc()
 
+        origins, destinations, times, kilometers = zip(*distancias) if distancias else ((), (), (), ())
 
-def remove_invalid_trips(trips, distances):
-    valid_trips = {}
+    origins = np.asarray(origins, dtype=np.int64)
+    destinations = np.asarray(destinations, dtype=np.int64)
+    times = np.asarray(times, dtype=np.float64)
+    kilometers = np.asarray(kilometers, dtype=np.float32)
+    estimated = np.zeros(len(origins), dtype=bool)
+
+    if ESTIMATE_MISSING_DISTANCES:
+        calculated = times != 0
+        origins, destinations, times, kilometers = (
+            origins[calculated], destinations[calculated], times[calculated], kilometers[calculated])
+        estimates = estimate_missing_distances(new_ids, all_ids, origins, destinations)
+        estimated = np.concatenate([np.zeros(len(origins), dtype=bool), np.ones(len(estimates[0]), dtype=bool)])
+        origins, destinations, times, kilometers = (
+            np.concatenate([values, estimate]) for values, estimate in
+            zip((origins, destinations, times, kilometers), estimates))
+
+    times = np.where((times != 0) | estimated, times.astype(np.int64) * 1.6, 99999)
 
-    for trip_id, values in trips.items():
-        min_location = min(values['origen'], values['destino'])
-        max_location = max(values['origen'], values['destino'])
-        calculated_distance = distances[min_location][max_location]
-        real_time = int(
-            (values['fin_datetime'] - values['inicio_datetime']).total_seconds() // 60)
+    return origins, destinations, times, kilometers.astype(np.float32), estimated
 
-        if real_time >= calculated_distance * 0.5 and real_time < calculated_distance * 2:
-            valid_trips[trip_id] = values
 
-    return valid_trips
+def get_distance_cache():
+    "Keep one distance cache per process so consecutive days only fetch their new locations."
+    global DISTANCE_CACHE
+    with LOAD_LOCK:
+        if DISTANCE_CACHE is None:
+            DISTANCE_CACHE = DistanceCache(fetch_location_distances)
+    return DISTANCE_CACHE
 
 
-def get_trips_per_unit_type(trips):
+def get_location_distances(locations_set):
+    "Build the DistanceMatrix of the locations, fetching only the locations not seen before."
+    return get_distance_cache().get(locations_set)
+
+
+def remove_invalid_trips(trips, distances):
+    "Discard the trips whose real duration is not between 0.5 and 2 times the calculated one."
+    calculated_distance = distances.times(trips['origen'], trips['destino'])
+    real_time = trips['fin'] - trips['inicio']
+
+    return select_trips(
+        trips, (real_time >= calculated_distance * 0.5) & (real_time < calculated_distance * 2))
 
-    trips_per_unit_type = defaultdict(dict)
 
-    for trip_id, trip_data in trips.items():
-        trips_per_unit_type[trip_data['tipo_unidad']][trip_id] = trip_data
+def get_trip_index():
+    "Load the trip index once per process, every day of a run is a range query on it."
+    global TRIP_INDEX
+    with LOAD_LOCK:
+        if TRIP_INDEX is None:
+            TRIP_INDEX = load_trip_index()
+    return TRIP_INDEX
 
-    return dict(trips_per_unit_type)
+
+def get_trips_from_rows(rows):
+    """
+    Take the rows of the trips cache as arrays. The trips dictionary should look something like this:
+        {
+            'viaje_id': array([...]),
+            'origen': array([...]),
+            'destino': array([...]),
+            'inicio': array([...]), # Minutes since the epoch.
+            'fin': array([...]),
+            'unidad': array([44284, ...]),
+        }
+    Unit ids are numeric strings in the cache and are taken as ints, like in the fleet state.
+    """
+    cache = get_trip_index().cache
+    rows = np.asarray(rows)
+    return {
+        'viaje_id': cache['viaje_id'][rows],
+        'origen': cache['origen'][rows],
+        'destino': cache['destino'][rows],
+        'inicio': cache['inicio'][rows],
+        'fin': cache['fin'][rows],
+        'unidad': np.asarray(cache['unidades']).astype(np.int64)[cache['unidad'][rows]],
+    }
+
+
+def get_trip_dicts(trips):
+    "Convert the trips arrays into the dictionary of trips used by save_routes."
+    return {
+        str(viaje_id): {
+            'origen': origen,
+            'destino': destino,
+            'inicio_datetime': minutes_to_datetime(inicio),
+            'fin_datetime': minutes_to_datetime(fin),
+            'unidad': unidad,
+        }
+        for viaje_id, origen, destino, inicio, fin, unidad in zip(*[
+            trips[column].tolist()
+            for column in ('viaje_id', 'origen', 'destino', 'inicio', 'fin', 'unidad')
+        ])
+    }
 
 
 def get_lat_long(id):
-    try:
-        conn = psycopg2.connect(
-            database='assistcargo', user='*', password='*', host='localhost')
-        cur = conn.cursor()
-
-        cur.execute(
-            """
-            SELECT latitud, longitud
-            FROM ubicaciones_mexico
-            WHERE ubicacion_id = %s;
-            """,
-            (id, )
-        )
-        data = cur.fetchall()
-        return data[0][0], data[0][1]
-    except Exception:
-        traceback.print_exc()
-
-
-def save_routes(trips, distances, kilometers, filename="trips.csv", tipo_unidad=None):
+    latitudes, longitudes = get_location_registry().coordinates([id])
+    return float(latitudes[0]), float(longitudes[0])
+
+
+def get_coordinates(location_ids):
+    "Latitude and longitude of every location id, None for the ones that are not in the registry."
+    latitudes, longitudes = get_location_registry().coordinates(location_ids)
+    return [
+        (None, None) if np.isnan(latitude) else (latitude, longitude)
+        for latitude, longitude in zip(latitudes.tolist(), longitudes.tolist())
+    ]
+
+
+def save_routes(trips, distances, filename="trips.csv", tipo_unidad=None):
     trip_list = []
+    origins = get_coordinates([trip['origen'] for trip in trips.values()])
+    destinations = get_coordinates([trip['destino'] for trip in trips.values()])
 
-    for trip in trips.values():
-        origin_lat, origin_long = get_lat_long(trip['origen'])
-        dest_lat, dest_long = get_lat_long(trip['destino'])
-        min_location = min(trip['origen'], trip['destino'])
-        max_location = max(trip['origen'], trip['destino'])
-        if min_location == max_location:
+    for trip, (origin_lat, origin_long), (dest_lat, dest_long) in zip(trips.values(), origins, destinations):
+        if trip['origen'] == trip['destino']:
             continue
         trip_list.append({
             'origin_id': trip['origen'],
@@ -364,8 +374,8 @@ def save_routes(trips, distances, kilometers, filename="trips.csv", tipo_unidad=
             'real_start': trip['inicio_datetime'],
             'real_end': trip['fin_datetime'],
             'real_minutes': int((trip['fin_datetime'] - trip['inicio_datetime']).total_seconds() // 60),
-            'calculated_minutes': distances[min_location][max_location],
-            'calculated_kms': kilometers[min_location][max_location],
+            'calculated_minutes': float(distances.time(trip['origen'], trip['destino'])),
+            'calculated_kms': float(distances.km(trip['origen'], trip['destino'])),
             'carga': 1 if trip.get('carga') else 0,
         })
 
@@ -380,103 +390,86 @@ def save_routes(trips, distances, kilometers, filename="trips.csv", tipo_unidad=
             dict_writer.writerows(trip_list)
 
 
-def read_trips(start, end, return_trips=False):
-    global DATE_RANGE_START
-    global DATE_RANGE_END
+def read_day_trips(start, end):
+    "Slice the trips of every unit type starting in the date range from the trip index."
+    rows_per_type = get_trip_index().day_rows(
+        datetime_to_minutes(start), datetime_to_minutes(end))
+    return {
+        key: get_trips_from_rows(rows) for key, rows in rows_per_type.items()
+    }
 
-    DATE_RANGE_START = start
-    DATE_RANGE_END = end
 
-    with open("./csvs/mexico.csv", "r", encoding="ISO-8859-1") as f:
-        reader = csv.DictReader(f)
-        trip_list = list(reader)
+def prefetch_trips(start, end):
+    """
+    Read the trips of the date range and load the distances between their locations into the
+    distance cache. Nothing here depends on the free units of previous days, so it can run while
+    another day is being optimized.
+    """
+    trips_per_unit_type = read_day_trips(start, end)
+    for trips in trips_per_unit_type.values():
+        _, locations_set = filter_trips_range(trips, start)
+        get_location_distances(locations_set)
+    return trips_per_unit_type
 
-    trips = {}
-    for trip in trip_list:
-        if not (trip['TIEMPOINICIOREALID'] and trip['TIEMPOFINID'] and trip['HR_COMPLETO'] and trip['HF_COMPLETO']):
-            continue
 
-        trips[trip['VIAJEID']] = {
-            'origen': int(trip['UBICACIONORIGENID']),
-            'destino': int(trip['UBICACIONDESTINOID']),
-            'fecha_inicio': trip['TIEMPOINICIOREALID'],
-            'fecha_fin': trip['TIEMPOFINID'],
-            'hora_inicio': trip['HR_COMPLETO'],
-            'hora_fin': trip['HF_COMPLETO'],
-            'unidad': trip['UNIDADID'],
-            'tipo_unidad_id': trip['TIPOUNIDADID'],
-            'tipo_unidad': trip['TIPOUNIDAD']
-        }
-
-    trips_per_unit_type = get_trips_per_unit_type(trips)
+def read_trips(start, end, return_trips=False, trips_per_unit_type=None):
+    if trips_per_unit_type is None:
+        trips_per_unit_type = read_day_trips(start, end)
 
     if return_trips:
-        trips, locations_set = filter_trips_range(trips)
+        trips = {
+            column: np.concatenate([unit_type_trips[column] for unit_type_trips in trips_per_unit_type.values()])
+            for column in ('viaje_id', 'origen', 'destino', 'inicio', 'fin', 'unidad')
+        }
 
-        trips = calculate_start_end_datetime(trips)
+        trips, locations_set = filter_trips_range(trips, start)
 
-        distances, kilometers = get_location_distances(locations_set)
+        distances = get_location_distances(locations_set)
 
         trips = remove_invalid_trips(trips, distances)
 
         locations, pickups, starts, demands, starts_definition = build_locations(
-            trips, distances)
+            trips, distances, start)
 
         print("Amount of trucks originally used:")
-        print(len({d['unidad'] for d in trips.values()}))
+        print(len(np.unique(trips['unidad'])))
         print("Amount of trips to optimize:")
-        print(len(trips))
+        print(len(trips['viaje_id']))
 
-        return trips, distances, kilometers
+        return get_trip_dicts(trips), distances
     # import ipdb
     for key in trips_per_unit_type:
         # ipdb.set_trace()
         trips, locations_set = filter_trips_range(
-            trips_per_unit_type[key], key)
-
-        trips = calculate_start_end_datetime(trips)
+            trips_per_unit_type[key], start, key)
 
-        distances, kilometers = get_location_distances(locations_set)
+        distances = get_location_distances(locations_set)
 
         if not distances:
             continue
 
         trips = remove_invalid_trips(trips, distances)
 
-        if not trips:
+        if not len(trips['viaje_id']):
             continue
 
         locations, pickups, starts, demands, starts_definition = build_locations(
-            trips, distances, key)
+            trips, distances, start, key)
+
+        old_trip_info = (len(np.unique(trips['unidad'])), len(trips['viaje_id']))
 
         print(f"Amount of {key} trucks originally used:")
-        print(len({d['unidad'] for d in trips.values()}))
+        print(old_trip_info[0])
         print("Amount of trips to optimize:")
-        print(len(trips))
+        print(old_trip_info[1])
 
         # if key == 'Thorton':
-        #     save_routes(trips, distances, kilometers,
+        #     save_routes(get_trip_dicts(trips), distances,
         #                 f'optimizer_results/result_original.csv', key)
 
-        yield locations, pickups, starts, demands, distances, kilometers, starts_definition, key, (len({d['unidad'] for d in trips.values()}), len(trips))
-
-
-def save_units_use(units_use, filename="free_units.csv"):
-    units_list = []
-
-    for unit, data in units_use.items():
-        units_list.append({
-            'unit_id': unit,
-            'free_time': data['time'],
-            'location': data['location'],
-        })
-
-    with open(filename, 'w', newline='') as output_file:
-        dict_writer = csv.DictWriter(output_file, units_list[0].keys())
-        dict_writer.writeheader()
-        dict_writer.writerows(units_list)
+        yield locations, pickups, starts, demands, distances, starts_definition, key, old_trip_info
 
 
 if __name__ == '__main__':
-    trips, distances, kilometers = read_trips(return_trips=True)
-    save_routes(trips, distances, kilometers)
+    trips, distances = read_trips(return_trips=True)
+    save_routes(trips, distances)
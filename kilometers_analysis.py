@@ -1,61 +1,49 @@
-import requests
 import csv
 import datetime
-import psycopg2
+import os
 
+import numpy as np
 
-CONN = conn = psycopg2.connect(
-    database='assistcargo', user='*', password='*', host='localhost')
+import database
+from distance_store import MISSING_MINUTES, open_distance_store
+from results_store import load_results
+from travel_time_estimator import get_estimator
 
-API_KEY = '*'
-DISTANCE_URL = 'http://router.project-osrm.org/table/v1/driving/{locations}?annotations=distance&sources=0'
-url = "https://maps.googleapis.com/maps/api/distancematrix/json?origins={origins}&destinations={destinations}&key={api_key}"
+RESULTS_CHUNKS = "./optimizer_results_thorton/results"
 
 
-def calcular_distancias(origin, destination):
-    full_string = f"{origin['long']},{origin['lat']};{destination['long']},{destination['lat']}"
+def estimate_distance(origin_data, destination_data):
+    "Kilometers and minutes estimated from the coordinates of the trip, 0 without coordinates."
     try:
-        formated_url = DISTANCE_URL.format(locations=full_string)
-        formated_url = url.format(
-            origins=f"{origin['lat']},{origin['long']}", destinations=f"{destination['lat']},{destination['long']}", api_key=API_KEY)
-        result = requests.get(formated_url)
-        result_json = result.json()
-        # print(result_json)
-        distance = round(
-            result_json['rows'][0]['elements'][0]['distance']['value'] / 1000, 2)
-        time = int(
-            result_json['rows'][0]['elements'][0]['duration']['value'] / 60) * 2
-        return distance, time
-
-    except Exception as e:
-        # print(e)
+        kilometers, minutes = get_estimator().estimate(
+            float(origin_data['lat']), float(origin_data['long']),
+            float(destination_data['lat']), float(destination_data['long']))
+    except (TypeError, ValueError):
         return 0, 0
+    if np.isnan(minutes):
+        return 0, 0
+    return round(float(kilometers), 2), float(round(minutes))
 
 
 def get_distance(origin, destination, origin_data, destination_data):
     distancia = None
-    global CONN
+    store = open_distance_store()
+    if store is not None:
+        minutes, kilometers = store.submatrix([int(origin), int(destination)])
+        if minutes[0, 1] != MISSING_MINUTES:
+            return float(kilometers[0, 1]), float(minutes[0, 1])
+
     try:
-        cur = CONN.cursor()
-
-        cur.execute(
-            """SELECT distancia, tiempo
-            FROM distancias_mexico
-            WHERE ubicacion_id_origen = (%s) AND ubicacion_id_destino = (%s);
-            """,
-            (min(origin, destination), max(origin, destination))
-        )
-        distancia = cur.fetchone()
+        rows = database.get_many(
+            'distance_lookup', [min(int(origin), int(destination))], [max(int(origin), int(destination))])
+        distancia = rows[0] if rows else None
     except Exception:
-        return 0
+        pass
 
     if distancia:
-        return float(distancia[0]), float(distancia[1])
+        return float(distancia[3]), float(distancia[2])
     else:
-        distancia, tiempo = calcular_distancias(origin_data, destination_data)
-        if distancia == 0 or tiempo == 0:
-            return 0, 0
-        return distancia, tiempo
+        return estimate_distance(origin_data, destination_data)
 
 
 with open("./optimizer_results_thorton/result_original.csv", "r", encoding="ISO-8859-1") as f:
@@ -109,54 +97,64 @@ print(int(total_kilometers))
 print('\nTiempo con camiones vacíos original')
 print(int(total_time / 60))
 
-with open("./optimizer_results_thorton/result.csv", "r", encoding="ISO-8859-1") as f:
-    reader = csv.DictReader(f)
-    optimizer_trip_list = list(reader)
-
-optimizer_trip_list = sorted(optimizer_trip_list, key=lambda x: datetime.datetime.strptime(
-    x['real_start'], "%Y-%m-%d %H:%M:%S"))
-
-total_kilometers = 0
-total_time = 0
-unidades_locations = {}
-
-for trip in optimizer_trip_list:
-    if trip['unidad'] not in unidades_locations:
-        unidades_locations[trip['unidad']] = {
-            'ubicacion': trip['dest_id'],
-            'data': {
-                'lat': trip['dest_lat'],
-                'long': trip['dest_long'],
+if os.path.isdir(RESULTS_CHUNKS):
+    # Same sum as below on the columns of the results chunks: every leg without load except the
+    # first leg of each unit.
+    results = load_results(RESULTS_CHUNKS)
+    order = np.argsort(results['real_start'], kind='stable')
+    empty = results['carga'][order] == 0
+    empty[np.unique(results['unidad'][order], return_index=True)[1]] = False
+    total_kilometers = float(results['calculated_kms'][order][empty].sum(dtype=np.float64))
+    total_time = float(results['calculated_minutes'][order][empty].sum(dtype=np.float64))
+else:
+    with open("./optimizer_results_thorton/result.csv", "r", encoding="ISO-8859-1") as f:
+        reader = csv.DictReader(f)
+        optimizer_trip_list = list(reader)
+
+    optimizer_trip_list = sorted(optimizer_trip_list, key=lambda x: datetime.datetime.strptime(
+        x['real_start'], "%Y-%m-%d %H:%M:%S"))
+
+    total_kilometers = 0
+    total_time = 0
+    unidades_locations = {}
+
+    for trip in optimizer_trip_list:
+        if trip['unidad'] not in unidades_locations:
+            unidades_locations[trip['unidad']] = {
+                'ubicacion': trip['dest_id'],
+                'data': {
+                    'lat': trip['dest_lat'],
+                    'long': trip['dest_long'],
+                }
             }
-        }
-    elif int(trip['carga']) == 0:
-        total_kilometers += float(trip['calculated_kms'])
-        total_time += float(trip['calculated_minutes'])
-        unidades_locations[trip['unidad']] = {
-            'ubicacion': trip['dest_id'],
-            'data': {
-                'lat': trip['dest_lat'],
-                'long': trip['dest_long'],
+        elif int(trip['carga']) == 0:
+            total_kilometers += float(trip['calculated_kms'])
+            total_time += float(trip['calculated_minutes'])
+            unidades_locations[trip['unidad']] = {
+                'ubicacion': trip['dest_id'],
+                'data': {
+                    'lat': trip['dest_lat'],
+                    'long': trip['dest_long'],
+                }
             }
-        }
-    else:
-        # distance = get_distance(
-        #     unidades_locations[trip['unidad']]['ubicacion'],
-        #     trip['dest_id'],
-        #     unidades_locations[trip['unidad']]['data'],
-        #     {
-        #         'lat': trip['dest_lat'],
-        #         'long': trip['dest_long'],
-        #     }
-        # )
-        # total_kilometers += distance
-        unidades_locations[trip['unidad']] = {
-            'ubicacion': trip['dest_id'],
-            'data': {
-                'lat': trip['dest_lat'],
-                'long': trip['dest_long'],
+        else:
+            # distance = get_distance(
+            #     unidades_locations[trip['unidad']]['ubicacion'],
+            #     trip['dest_id'],
+            #     unidades_locations[trip['unidad']]['data'],
+            #     {
+            #         'lat': trip['dest_lat'],
+            #         'long': trip['dest_long'],
+            #     }
+            # )
+            # total_kilometers += distance
+            unidades_locations[trip['unidad']] = {
+                'ubicacion': trip['dest_id'],
+                'data': {
+                    'lat': trip['dest_lat'],
+                    'long': trip['dest_long'],
+                }
             }
-        }
 
 print('\n\nKilometros con camiones vacíos optimizador')
 print(int(total_kilometers))
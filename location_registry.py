@@ -0,0 +1,109 @@
+import csv
+import threading
+import traceback
+
+import numpy as np
+
+import database
+
+LOCATIONS_CSV = "./csvs/ubicaciones_mexico.csv"
+
+LOCATION_REGISTRY = None
+LOCATION_REGISTRY_LOCK = threading.Lock()
+
+
+def valid_coordinates(latitudes, longitudes):
+    "Same rules as locations_database.check_valid_coords, for whole arrays."
+    return (
+        np.isfinite(latitudes) & np.isfinite(longitudes)
+        & ~((latitudes == 0) & (longitudes == 0))
+        & (np.abs(latitudes) <= 90) & (np.abs(longitudes) <= 180)
+    )
+
+
+class LocationRegistry:
+    """
+    Every location of ubicaciones_mexico held in sorted arrays of id, latitude, longitude and
+    validity, so membership and coordinates of many locations are answered with one binary search
+    instead of a query per location. Only locations with valid coordinates are members, like the
+    rows stored in the database.
+    """
+
+    def __init__(self, location_ids, latitudes, longitudes):
+        location_ids = np.asarray(location_ids, dtype=np.int64)
+        order = np.argsort(location_ids, kind='stable')
+        self.ids = location_ids[order]
+        self.latitudes = np.asarray(latitudes, dtype=np.float64)[order]
+        self.longitudes = np.asarray(longitudes, dtype=np.float64)[order]
+        self.valid = valid_coordinates(self.latitudes, self.longitudes)
+
+    def __len__(self):
+        return int(self.valid.sum())
+
+    def __contains__(self, location_id):
+        return bool(self.contains([location_id])[0])
+
+    def indices(self, location_ids):
+        "Indices of the location ids, -1 for locations that are not in the registry."
+        location_ids = np.asarray(location_ids, dtype=np.int64)
+        if not len(self.ids):
+            return np.full(location_ids.shape, -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.ids, location_ids), len(self.ids) - 1)
+        return np.where(self.ids[positions] == location_ids, positions, -1)
+
+    def contains(self, location_ids):
+        "Mask of the location ids that are known and have valid coordinates."
+        indices = self.indices(location_ids)
+        return (indices >= 0) & self.valid[np.maximum(indices, 0)]
+
+    def coordinates(self, location_ids):
+        "Latitudes and longitudes of the location ids, nan for locations that are not members."
+        indices = self.indices(location_ids)
+        known = self.contains(location_ids)
+        latitudes = np.full(indices.shape, np.nan)
+        longitudes = np.full(indices.shape, np.nan)
+        latitudes[known] = self.latitudes[indices[known]]
+        longitudes[known] = self.longitudes[indices[known]]
+        return latitudes, longitudes
+
+
+def parse_coordinate(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def read_locations_database():
+    with database.cursor() as cursor:
+        cursor.execute("SELECT ubicacion_id, latitud, longitud FROM ubicaciones_mexico;")
+        rows = cursor.fetchall()
+    return LocationRegistry(
+        [row[0] for row in rows],
+        [parse_coordinate(row[1]) for row in rows],
+        [parse_coordinate(row[2]) for row in rows],
+    )
+
+
+def read_locations_csv(source=LOCATIONS_CSV):
+    with open(source, "r") as f:
+        rows = list(csv.DictReader(f))
+    return LocationRegistry(
+        [int(row['UbicacionID']) for row in rows],
+        [parse_coordinate(row['Latitud']) for row in rows],
+        [parse_coordinate(row['Longitud']) for row in rows],
+    )
+
+
+def get_location_registry():
+    "Load the registry once per process, from the database or from the csv when it isn't reachable."
+    global LOCATION_REGISTRY
+    with LOCATION_REGISTRY_LOCK:
+        if LOCATION_REGISTRY is None:
+            try:
+                LOCATION_REGISTRY = read_locations_database()
+            except Exception:
+                traceback.print_exc()
+                print(f"Reading locations from {LOCATIONS_CSV}")
+                LOCATION_REGISTRY = read_locations_csv()
+    return LOCATION_REGISTRY
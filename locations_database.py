@@ -1,31 +1,33 @@
 import argparse
 import asyncio
-from collections import defaultdict
 import csv
 from datetime import timedelta, datetime
-from itertools import combinations, cycle
 from multiprocessing import Process, Value, Queue
-import psycopg2
+import os
 import re
-import requests
-import sys
 from time import time
 import traceback
 
+import numpy as np
+
+from backfill_checkpoint import BackfillCheckpoint, reset_checkpoint
+import database
+from distance_store import STORE_DIR, DistanceStore, pair_offsets
+from osrm_client import CONCURRENCY, OsrmTableClient
+from tile_planner import MAX_TABLE_COORDINATES, plan_tiles, tile_rows, tile_size
+
 API_KEY = '*'
-# DISTANCE_URL_0 = 'http://router.project-osrm.org/table/v1/driving/{locations}?annotations=distance,duration&sources=0'
-DISTANCE_URL_1 = 'https://odd-baboon-63.loca.lt/table/v1/driving/{locations}?annotations=distance,duration&sources=0'
+# The sources and destinations of every tile are added to the url by the OSRM client.
+# DISTANCE_URL_0 = 'http://router.project-osrm.org/table/v1/driving/{locations}?annotations=distance,duration'
+DISTANCE_URL_1 = 'https://odd-baboon-63.loca.lt/table/v1/driving/{locations}?annotations=distance,duration'
 DATE_RANGE_START = datetime(2021, 2, 1, 0)
 DATE_RANGE_END = datetime(2021, 2, 15, 0)
 HOUR_REGEX = r"\d{1,2}:\d{1,2}:\d{1,2}\s[ap].m."
+# Pairs the OSRM client couldn't fetch, to be retried in a later run.
+FAILED_PAIRS_CSV = "./csvs/failed_distances.csv"
 
 total_database_inserts_counter = 0
 
-def batch(iterable, n=1):
-    l = len(iterable)
-    for ndx in range(0, l, n):
-        yield iterable[ndx:min(ndx + n, l)]
-
 def check_valid_coords(lat, long):
     if not (lat and long):
         return False
@@ -47,45 +49,38 @@ def check_valid_coords(lat, long):
 
     return True
 
-def store_distance_results(origin, destinations, distance_results, time_results, queue):
-    distance_results = [round(i / 1000, 2) if i else 0 for i in distance_results ]
-    time_results = [i // 60 if i else 0 for i in time_results]
-
-    for idx, destination in enumerate(destinations):
-        queue.put((min([origin, destination]), max([origin, destination]), distance_results[idx+1], time_results[idx+1]))
-
-def query_distances(origin, destinations, info_dict, queue):
-    origin_string = f"{info_dict[origin]['longitude']},{info_dict[origin]['latitude']}"
-    destination_strings = ';'.join([f"{info_dict[i]['longitude']},{info_dict[i]['latitude']}" for i in destinations])
-    full_string = f"{origin_string};{destination_strings}"
-    try:
-        formated_url = DISTANCE_URL_1.format(locations=full_string)
-        result = None
-        result = requests.get(formated_url)
-        if result.ok:
-            result_json = result.json()
-
-            store_distance_results(origin, destinations, result_json['distances'][0], result_json['durations'][0], queue)
-
-    except Exception:
-        traceback.print_exc()
-        if result:
-            print(result.status_code)
-            print(result.raw)
-        sys.exit(1)
-
-def calculate_remaining_distances(location_set=None):
+def store_distance_results(sources, destinations, distance_results, time_results, missing, queue):
+    "Queue the missing pairs of a tile response, the rest of the tile is already stored."
+    for row in tile_rows(sources, destinations, distance_results, time_results, missing):
+        queue.put(row)
+
+def save_failed_pairs(failed, missing_pairs, filename=FAILED_PAIRS_CSV):
+    "Append the missing pairs of the failed tiles to the failed pairs csv."
+    if not failed:
+        return
+    write_header = not os.path.isfile(filename)
+    with open(filename, 'a', newline='') as output_file:
+        writer = csv.writer(output_file)
+        if write_header:
+            writer.writerow(['origin', 'destination', 'error'])
+        for sources, destinations, error in failed:
+            rows, columns = np.nonzero(missing_pairs.missing_between(sources, destinations))
+            writer.writerows((sources[row], destinations[column], error) for row, column in zip(rows, columns))
+
+def calculate_remaining_distances(location_set=None, resume=True):
+    """
+    Locations and missing pairs of the backfill. The missing pairs are loaded from the checkpoint of
+    a previous run of the same locations, or read from distancias_mexico when there is none.
+    """
     print('Querying locations...\n')
 
-    with psycopg2.connect(database='assistcargo', user='*', password='*', host='localhost') as connection:
-        connection.autocommit = True
-        with connection.cursor() as cursor:
-            if location_set:
-                cursor.execute("SELECT * FROM ubicaciones_mexico WHERE ubicacion_id IN %s;", (tuple(location_set), ))
-                locations = cursor.fetchall()
-            else:
-                cursor.execute("SELECT * FROM ubicaciones_mexico;")
-                locations = cursor.fetchall()
+    with database.cursor() as cursor:
+        if location_set:
+            cursor.execute("SELECT * FROM ubicaciones_mexico WHERE ubicacion_id IN %s;", (tuple(location_set), ))
+            locations = cursor.fetchall()
+        else:
+            cursor.execute("SELECT * FROM ubicaciones_mexico;")
+            locations = cursor.fetchall()
 
     locations = {
         item[0]: {
@@ -95,30 +90,103 @@ def calculate_remaining_distances(location_set=None):
         for item in locations
     }
 
-    location_ids = sorted(locations.keys())
-
-    possible_comb = set(combinations(location_ids, 2))
+    missing_pairs = MissingPairs(sorted(locations.keys()))
+    checkpoint = BackfillCheckpoint.load(missing_pairs.location_ids, missing_pairs) if resume else None
+    if checkpoint is None:
+        reset_checkpoint()
+        missing_pairs.mark_existing()
+        checkpoint = BackfillCheckpoint(missing_pairs)
+        checkpoint.save_bitmap()
 
-    with psycopg2.connect(database='assistcargo', user='*', password='*', host='localhost') as connection:
-        connection.autocommit = True
-        with connection.cursor() as cursor:
-            cursor.execute("SELECT ubicacion_id_origen, ubicacion_id_destino FROM distancias_mexico")
-            existing_comb = cursor.fetchall()
+    return locations, missing_pairs, checkpoint, missing_pairs.missing(), missing_pairs.possible()
 
-    remaining_combinations = possible_comb - set(existing_comb)
 
-    distances_to_calculate = defaultdict(list)
-
-    for item in remaining_combinations:
-        distances_to_calculate[item[0]].append(item[1])
+class MissingPairs:
+    """
+    Bitmap of the pairs of locations that are already in distancias_mexico. Pair (i, j) of the
+    sorted location indices is bit i + j * (j - 1) / 2, the same triangular layout as the distance
+    store, so ~5.6k locations take 2MB instead of sets of millions of tuples. The missing pairs are
+    yielded per origin, the lower location of every pair, with its higher destinations.
+    """
 
-    return locations, dict(distances_to_calculate), len(remaining_combinations), len(possible_comb)
-
-def insert_location_entry(cursor, location_id, address, locality, latitude, longitude):
-    cursor.execute(
-        "INSERT INTO ubicaciones_mexico (ubicacion_id, direccion, localidad, latitud, longitud) VALUES (%s, %s, %s, %s, %s);",
-        (location_id, address, locality, latitude, longitude),
-    )
+    def __init__(self, location_ids):
+        self.location_ids = np.asarray(location_ids, dtype=np.int64)
+        self.bits = np.zeros((self.possible() + 7) // 8, dtype=np.uint8)
+
+    def possible(self):
+        return len(self.location_ids) * (len(self.location_ids) - 1) // 2
+
+    def missing(self):
+        return self.possible() - int(np.unpackbits(self.bits).sum())
+
+    def indices(self, location_ids):
+        location_ids = np.asarray(location_ids, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.location_ids, location_ids), max(len(self.location_ids) - 1, 0))
+        return np.where(self.location_ids[positions] == location_ids, positions, -1)
+
+    def mark(self, origins, destinations):
+        "Mark the pairs as existing, pairs of unknown locations or of a location to itself are ignored."
+        origins = self.indices(origins)
+        destinations = self.indices(destinations)
+        known = (origins >= 0) & (destinations >= 0) & (origins != destinations)
+        offsets = pair_offsets(origins[known], destinations[known])
+        np.bitwise_or.at(self.bits, offsets >> 3, (1 << (offsets & 7)).astype(np.uint8))
+
+    def mark_existing(self, batch_size=100000, table='distancias_mexico'):
+        "Stream the existing pairs from the database with a server-side cursor."
+        if not len(self.location_ids):
+            return
+        with database.cursor(name='existing_pairs') as cursor:
+            cursor.itersize = batch_size
+            cursor.execute(f"SELECT ubicacion_id_origen, ubicacion_id_destino FROM {table};")
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                origins, destinations = zip(*rows)
+                self.mark(origins, destinations)
+
+    def mark_origins(self, origins):
+        "Mark every pair of the origins with the locations after them as existing."
+        for origin_index in self.indices(origins).tolist():
+            if origin_index >= 0:
+                higher = np.arange(origin_index + 1, len(self.location_ids), dtype=np.int64)
+                offsets = pair_offsets(origin_index, higher)
+                np.bitwise_or.at(self.bits, offsets >> 3, (1 << (offsets & 7)).astype(np.uint8))
+
+    def is_complete(self, origin):
+        "Whether the origin has no missing pairs with the locations after it."
+        origin_index = int(self.indices([origin])[0])
+        return origin_index >= 0 and not len(self.destinations(origin_index))
+
+    def destinations(self, origin_index):
+        "Location ids of the missing pairs between a location and the ones after it."
+        higher = np.arange(origin_index + 1, len(self.location_ids), dtype=np.int64)
+        offsets = pair_offsets(origin_index, higher)
+        existing = (self.bits[offsets >> 3] >> (offsets & 7).astype(np.uint8)) & 1
+        return self.location_ids[higher[existing == 0]]
+
+    def missing_block(self, source_indices, destination_indices):
+        """
+        Mask of the missing pairs from every source index to every later destination index, so a
+        tile where both locations of a pair are sources and destinations has the pair once.
+        """
+        first, second = np.meshgrid(source_indices, destination_indices, indexing='ij')
+        offsets = pair_offsets(first, second)
+        existing = (self.bits[offsets >> 3] >> (offsets & 7).astype(np.uint8)) & 1
+        return (existing == 0) & (second > first)
+
+    def missing_between(self, source_ids, destination_ids):
+        "Mask of the missing pairs from every source id to every destination id."
+        return self.missing_block(self.indices(source_ids), self.indices(destination_ids))
+
+    def iter_tiles(self, size, worker=0, workers=1):
+        "Yield (sources, destinations) location ids of the tiles of missing pairs of one of the workers."
+        for sources, destinations in plan_tiles(len(self.location_ids), size, self.missing_block, worker, workers):
+            yield self.location_ids[sources].tolist(), self.location_ids[destinations].tolist()
+
+def insert_location_entry(writer, location_id, address, locality, latitude, longitude):
+    writer.add((location_id, address, locality, latitude, longitude))
 
 def read_and_store_locations():
     print('Reading csv...')
@@ -141,90 +209,120 @@ def read_and_store_locations():
     print('Storing locations')
 
     try:
-        with psycopg2.connect(database='assistcargo', user='*', password='*', host='localhost') as connection:
-            connection.autocommit = True
-            with connection.cursor() as cursor:
-                for location_id, data in locations.items():
-                    insert_location_entry(
-                        cursor,
-                        location_id,
-                        data['address'],
-                        data['locality'],
-                        data['latitude'],
-                        data['longitude'],
-                    )
+        with database.BulkWriter('ubicaciones_mexico', database.LOCATION_COLUMNS, database.LOCATION_KEY_COLUMNS) as writer:
+            for location_id, data in locations.items():
+                insert_location_entry(
+                    writer,
+                    location_id,
+                    data['address'],
+                    data['locality'],
+                    data['latitude'],
+                    data['longitude'],
+                )
     except Exception:
         traceback.print_exc()
 
     print('Done storing locations')
 
-def calculate_distances(distances_to_calculate, locations, counter, queue):
+def calculate_distances(missing_pairs, worker, workers, locations, counter, queue, url=DISTANCE_URL_1,
+                        concurrency=CONCURRENCY, table_size=MAX_TABLE_COORDINATES):
+    """
+    Worker process: fetch the tiles of missing distances of every workers-th tile with the
+    asynchronous OSRM client and queue the missing pairs of every response.
+    """
+    jobs = missing_pairs.iter_tiles(tile_size(table_size), worker, workers)
+
+    def on_result(sources, destinations, distance_results, time_results):
+        missing = missing_pairs.missing_between(sources, destinations)
+        store_distance_results(sources, destinations, distance_results, time_results, missing, queue)
+        with counter.get_lock():
+            counter.value -= int(missing.sum())
+
+    client = OsrmTableClient(url, concurrency=concurrency)
+    asyncio.run(client.run(jobs, locations, on_result))
 
-    for location_id, destination_locations in distances_to_calculate.items():
-        for dist_to_calculate in batch(destination_locations, 200):
-            query_distances(location_id, dist_to_calculate, locations, queue)
-            counter.value -= len(dist_to_calculate)
+    save_failed_pairs(client.failed, missing_pairs)
+    failed_pairs = sum(
+        int(missing_pairs.missing_between(sources, destinations).sum()) for sources, destinations, _ in client.failed)
+    with counter.get_lock():
+        counter.value -= failed_pairs
+    print(f"Worker done: {client.stats()}")
 
-async def logging(total_process, total_possible_combinations, counter, queue, start_time):
+async def logging(total_process, total_possible_combinations, counter, queue, start_time, checkpoint):
     global total_database_inserts_counter
     while True:
         queue_size = total_process - counter.value - total_database_inserts_counter
         current_time = str(timedelta(seconds=time() - start_time))
+        progress = checkpoint.write_progress()
         print(
             f"Remaining calculations: {counter.value}\n"
             f"Total Percentage done: {str(round((total_possible_combinations - counter.value) * 100 / total_possible_combinations, 2))}%\n"
             f"Run Percentage done: {str(round((total_process - counter.value) * 100 / total_process, 2))}%\n"
             f"Queue size: {queue_size}\n"
+            f"Committed: {progress['committed_pairs']} pairs in {progress['batches']} batches, "
+            f"{progress['recent_pairs_per_second']} pairs per second, ETA {progress['eta']}\n"
             f"Elapsed time: {current_time}\n"
         )
         await asyncio.sleep(30)
         if counter.value == 0 and queue.empty():
+                checkpoint.write_progress()
                 break
 
-def calculate_keys_for_workers(num_workers, distances_to_calculate):
-    num_split = list(range(num_workers))
-    distances_for_workers = [dict() for _ in num_split]
-    number_pool = cycle(num_split)
+def patch_distance_store(store, rows):
+    "Patch the rows written to distancias_mexico into the distance store."
+    origins, destinations, distances, times = zip(*rows)
+    store.set_pairs(origins, destinations, times, distances)
+    store.flush()
 
-    for key, value in distances_to_calculate.items():
-        distances_for_workers[next(number_pool)][key] = value
 
-    return distances_for_workers
+def on_batch_committed(store, checkpoint, rows):
+    "Patch the distance store and record the batch in the checkpoint once it is in the database."
+    if store is not None:
+        patch_distance_store(store, rows)
+    checkpoint.commit(rows)
 
-async def database_store(remaining_counter, queue):
+
+async def database_store(remaining_counter, queue, checkpoint):
     global total_database_inserts_counter
     internal_counter = 0
     start_time = time()
 
-    while True:
-        with psycopg2.connect(database='assistcargo', user='*', password='*', host='localhost') as connection:
-            connection.autocommit = True
-            with connection.cursor() as cursor:
-                try:
-                    item = queue.get(block=True, timeout=60)
-                    total_database_inserts_counter += 1
-                except Exception:
-                    internal_counter = 10000
-                    item = None
-                    if remaining_counter.value == 0:
-                        break
-                if item:
-                    cursor.execute(
-                        "INSERT INTO distancias_mexico (ubicacion_id_origen, ubicacion_id_destino, distancia, tiempo) VALUES (%s, %s, %s, %s);",
-                        item,
-                    )
-                    internal_counter += 1
-                current_time = time()
-                if internal_counter == 10000 or current_time - start_time >= 30:
-                    await asyncio.sleep(0)
-                    internal_counter = 0
-                    start_time = time()
-
-
-async def main(total_process, total_possible_combinations, remaining, queue, start_time):
+    # New pairs are also patched into the distance store when it was built.
+    store = None
+    if os.path.isfile(os.path.join(STORE_DIR, "ids.npy")):
+        store = DistanceStore(STORE_DIR, mode='r+')
+
+    # Rows are copied to the database in batches, duplicated pairs update the existing row. Every
+    # committed batch is recorded in the checkpoint so a restart doesn't request it again.
+    writer = database.BulkWriter(
+        'distancias_mexico', database.DISTANCE_COLUMNS, database.DISTANCE_KEY_COLUMNS,
+        on_flush=lambda rows: on_batch_committed(store, checkpoint, rows),
+    )
+    with writer:
+        while True:
+            try:
+                item = queue.get(block=True, timeout=60)
+                total_database_inserts_counter += 1
+            except Exception:
+                internal_counter = 10000
+                item = None
+                writer.flush()
+                if remaining_counter.value == 0:
+                    break
+            if item:
+                writer.add(item)
+                internal_counter += 1
+            current_time = time()
+            if internal_counter == 10000 or current_time - start_time >= 30:
+                await asyncio.sleep(0)
+                internal_counter = 0
+                start_time = time()
+
+
+async def main(total_process, total_possible_combinations, remaining, queue, start_time, checkpoint):
     await asyncio.gather(
-        logging(total_process, total_possible_combinations, remaining, queue, start_time),
-        database_store(remaining, queue)
+        logging(total_process, total_possible_combinations, remaining, queue, start_time, checkpoint),
+        database_store(remaining, queue, checkpoint)
     )
     print("100% Done calculating distances")
 
@@ -290,6 +388,10 @@ if __name__ == '__main__':
     parser.add_argument('-cd', '--custom_distances', action='store_true', help='Distances from a time frame')
     parser.add_argument('-d', '--distances', action='store_true', help='Calculate and store distances')
     parser.add_argument('-w', '--workers', type=int, help='Number of workers', action='store', default=1)
+    parser.add_argument('-u', '--url', help='OSRM table url, with {locations} in place of the coordinates', action='store', default=DISTANCE_URL_1)
+    parser.add_argument('-c', '--concurrency', type=int, help='Requests in flight per worker', action='store', default=CONCURRENCY)
+    parser.add_argument('-t', '--table_size', type=int, help='Coordinates per OSRM table request', action='store', default=MAX_TABLE_COORDINATES)
+    parser.add_argument('-r', '--restart', action='store_true', help='Ignore the checkpoint and read the existing pairs from the database')
     args = parser.parse_args()
 
     if args.locations:
@@ -302,18 +404,21 @@ if __name__ == '__main__':
 
     if args.distances:
         print(f'Calculating distances with {args.workers} workers')
-        locations, distances_to_calculate, total_process, total_possible_combinations = calculate_remaining_distances(custom_locations)
+        locations, missing_pairs, checkpoint, total_process, total_possible_combinations = calculate_remaining_distances(
+            custom_locations, resume=not args.restart)
+        if total_process == 0:
+            print("100% Done calculating distances")
+            checkpoint.write_progress()
+            raise SystemExit
 
         remaining = Value('i', total_process)
         queue = Queue()
 
-        distances_for_workers = calculate_keys_for_workers(args.workers, distances_to_calculate)
-
-        workers = [Process(target=calculate_distances, args=(distances_for_workers[i], locations, remaining, queue)) for i in range(args.workers)]
+        workers = [Process(target=calculate_distances, args=(missing_pairs, i, args.workers, locations, remaining, queue, args.url, args.concurrency, args.table_size)) for i in range(args.workers)]
 
         for worker in workers:
             worker.start()
 
         start_time = time()
 
-        asyncio.run(main(total_process, total_possible_combinations, remaining, queue, start_time))
+        asyncio.run(main(total_process, total_possible_combinations, remaining, queue, start_time, checkpoint))
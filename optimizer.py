@@ -1,42 +1,87 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 import datetime
+import json
+from queue import Queue
+from threading import Thread
+from time import time
 
+import numpy as np
 from ortools.constraint_solver import routing_enums_pb2
 from ortools.constraint_solver import pywrapcp
 
-from helpers import read_trips, save_routes, save_units_use
-
-
+from decomposition import (
+    MAX_CLUSTER_TRIPS, assign_vehicles, build_clusters, build_sub_data, get_vehicle_states, merge_results,
+    update_vehicle_states)
+from distance_matrix import MISSING_TIME
+from fleet_state import SNAPSHOT_DAYS, get_fleet_state, snapshot_fleet_states
+from helpers import get_distance_cache, prefetch_trips, read_trips, save_routes
+from pruning import get_pruned_free_units, prune_vehicles, remove_infeasible_arcs
+from replan import assign_new_trips, build_replan_data, get_frozen_result, get_known_data
+from results_store import result_columns, save_results_chunk
+from rolling_horizon import commit_first_day, get_route_prefix, get_window_warm_start
+from search_limits import ConvergenceMonitor
+
+
+# Report line of every routing search status. The numbers are taken from the RoutingSearchStatus
+# enum of the installed OR-Tools, they changed between versions.
+SOLVER_STATUS_DESCRIPTIONS = {
+    'ROUTING_NOT_SOLVED': 'Problem not solved yet.',
+    'ROUTING_SUCCESS': 'Problem solved successfully.',
+    'ROUTING_PARTIAL_SUCCESS_LOCAL_OPTIMUM_NOT_REACHED': 'Solution found, the search stopped before a local optimum.',
+    'ROUTING_FAIL': 'No solution found to the problem.',
+    'ROUTING_FAIL_TIMEOUT': 'Time limit reached before finding a solution.',
+    'ROUTING_INVALID': 'Model, model parameters, or flags are not valid.',
+    'ROUTING_INFEASIBLE': 'Problem proven to be infeasible.',
+    'ROUTING_OPTIMAL': 'Problem solved to optimality.',
+}
 SOLVER_STATUS_MAP = {
-    0: 'ROUTING_NOT_SOLVED: Problem not solved yet.\n\n',
-    1: 'ROUTING_SUCCESS: Problem solved successfully.\n\n',
-    2: 'ROUTING_FAIL: No solution found to the problem.\n\n',
-    3: 'ROUTING_FAIL_TIMEOUT: Time limit reached before finding a solution.\n\n',
-    4: 'ROUTING_INVALID: Model, model parameters, or flags are not valid.\n\n',
+    status.number: f"{status.name}: {SOLVER_STATUS_DESCRIPTIONS.get(status.name, 'Unknown status.')}\n\n"
+    for status in routing_enums_pb2.RoutingSearchStatus.DESCRIPTOR.enum_types_by_name['Value'].values
 }
 
-distance_matrix = None
-kilometers_matrix = None
-starts_definition = None
-
 DATE_RANGE_START = datetime.datetime(2021, 2, 1, 0)
 DATE_RANGE_END = datetime.datetime(2021, 2, 28, 0)
 
-
-def create_data_model():
+# 'matrix' registers precomputed arc costs with the solver, 'callback' evaluates every arc in Python.
+TRANSIT_MODE = 'matrix'
+# Days loaded ahead and results waiting to be written in a pipelined run.
+PIPELINE_QUEUE_SIZE = 1
+# None builds the first solution with PATH_CHEAPEST_ARC, 'historical' starts from the real units
+# of the trips and 'previous' from the routes saved by a previous run of the same day.
+WARM_START = None
+# Seconds of search at which the best objective found is reported.
+SOLUTION_CHECKPOINTS = [1, 5, 15, 30, 60, 120]
+# 'fixed' searches for TIME_LIMIT seconds, 'adaptive' stops once the objective stopped improving
+# (see search_limits).
+STOPPING_MODE = 'fixed'
+TIME_LIMIT = 60 * 2
+# Remove the arcs that no solution can use from the model before the solve (see pruning). With
+# ARC_PRUNING_BASELINE every pruned model is also solved without pruning to compare the search rates.
+ARC_PRUNING = False
+ARC_PRUNING_BASELINE = False
+# Worker processes solving the clusters of a slab when a day is decomposed (see decomposition).
+DECOMPOSITION_WORKERS = 4
+# Also write the results of every day as compressed typed columns, see results_store.
+COLUMNAR_RESULTS = False
+# Minute of the day at which a simulated re-plan happens, None to solve every day once. The
+# re-plan searches for REPLAN_TIME_LIMIT seconds.
+REPLAN_CUTOFF = None
+REPLAN_TIME_LIMIT = 10
+# Days solved together by the rolling horizon, None to solve every day on its own.
+ROLLING_HORIZON = None
+
+
+def create_data_model(start, end, trips_per_unit_type=None):
     """Stores the data for the problem."""
-    global current_date
-    for trips_data in read_trips(current_date, current_date + datetime.timedelta(days=1)):
+    for trips_data in read_trips(start, end, trips_per_unit_type=trips_per_unit_type):
         try:
-            locations, pickups, starts, demands, distances, kilometers, starts_data, key, old_trip_info = trips_data
+            locations, pickups, starts, demands, distances, starts_data, key, old_trip_info = trips_data
         except Exception:
             return None
-        global distance_matrix
-        distance_matrix = distances
-        global kilometers_matrix
-        kilometers_matrix = kilometers
-        global starts_definition
-        starts_definition = starts_data
         data = {}
+        data['date'] = start
+        data['starts_definition'] = starts_data
         data['demands'] = demands
         data['locations'] = locations
         data['distances'] = distances
@@ -49,8 +94,13 @@ def create_data_model():
         yield data
 
 
-def print_solution(data, manager, routing, solution, file_counter):
-    """Prints solution on console."""
+def print_solution(data, manager, routing, solution):
+    """
+    Prints solution on console and returns the routes, trips and free units of the solution, and
+    the earliest pickup and delivery minutes of the trips of every unit in route order.
+    """
+    starts_definition = data['starts_definition']
+    current_date = data['date']
     print(f'Objective: {solution.ObjectiveValue()}\n\n')
     time_dimension = routing.GetDimensionOrDie('Time')
     total_time = 0
@@ -58,6 +108,8 @@ def print_solution(data, manager, routing, solution, file_counter):
     total_trips_counter = 0
     trips = {}
     free_units = {}
+    routes = {}
+    schedules = {}
     print_lines = []
     for vehicle_id in range(data['num_vehicles']):
         index = routing.Start(vehicle_id)
@@ -65,6 +117,7 @@ def print_solution(data, manager, routing, solution, file_counter):
             vehicle_id + 1, starts_definition[vehicle_id])
         counter = 0
         vehicles_locations = []
+        earliest_minutes = []
         unused_vehicle_time = None
         while not routing.IsEnd(index):
             time_var = time_dimension.CumulVar(index)
@@ -88,6 +141,7 @@ def print_solution(data, manager, routing, solution, file_counter):
                         manager.IndexToNode(index),
                     )
                 )
+                earliest_minutes.append(int(solution.Min(time_var)))
             else:
                 unused_vehicle_time = (
                     data['locations'][manager.IndexToNode(index)]['id'],
@@ -96,6 +150,19 @@ def print_solution(data, manager, routing, solution, file_counter):
             index = solution.Value(routing.NextVar(index))
             counter += 1
 
+        routes[starts_definition[vehicle_id]] = [
+            data['locations'][node]['viaje_id'] for _, _, node in vehicles_locations
+            if data['locations'][node]['type'] == 'PICKUP'
+        ]
+        # Every pickup is followed by its delivery, so the next location is the end of the trip. The
+        # earliest times are used, the rest of the route is still feasible from them.
+        schedules[starts_definition[vehicle_id]] = [
+            [data['locations'][node]['viaje_id'], pickup_minute, delivery_minute]
+            for (_, _, node), pickup_minute, delivery_minute in zip(
+                vehicles_locations, earliest_minutes, earliest_minutes[1:])
+            if data['locations'][node]['type'] == 'PICKUP'
+        ]
+
         for i in range(len(vehicles_locations) - 1):
             trips[total_trips_counter] = {
                 'origen': vehicles_locations[i][0],
@@ -126,6 +193,8 @@ def print_solution(data, manager, routing, solution, file_counter):
             print_lines.append(plan_output)
         total_time += solution.Min(time_var)
 
+    free_units.update(get_pruned_free_units(data))
+
     print('\nTotal time of all routes: {} minutes'.format(total_time))
     print(f'\nAmount of trucks used by optimizer: {vehicles_used}')
     print('\n\n')
@@ -135,16 +204,177 @@ def print_solution(data, manager, routing, solution, file_counter):
     print_lines.append(
         f'\nAmount of trucks used by optimizer: {vehicles_used}\n\n')
 
-    with open(f'optimizer_results/{str(file_counter)}.txt', 'a') as f:
-        f.writelines(print_lines)
+    return {
+        'print_lines': print_lines,
+        'trips': trips,
+        'free_units': free_units,
+        'routes': routes,
+        'schedule': schedules,
+    }
 
-    save_routes(trips, distance_matrix, kilometers_matrix,
-                f'optimizer_results/result.csv', data["key"])
-    save_units_use(
-        free_units, f'optimizer_results/free_units_{data["key"]}.csv')
 
+def save_solution(data, result, file_counter, columnar=COLUMNAR_RESULTS):
+    """
+    Writes the solver report and the solution of one unit type to the results of the day, and to a
+    columnar chunk of the day when columnar is set.
+    """
+    with open(f'optimizer_results/{str(file_counter)}.txt', 'a') as f:
+        f.writelines(result['report_lines'])
+        f.writelines(result.get('print_lines', []))
 
-def optimize(data, counter):
+    if 'trips' not in result:
+        return
+
+    save_routes(result['trips'], data['distances'],
+                f'optimizer_results/result.csv', data["key"])
+    with open(f'optimizer_results/routes_{data["key"]}_{str(file_counter)}.json', 'w') as f:
+        json.dump(result['routes'], f)
+    if columnar:
+        save_results_chunk(result_columns(result['trips'], data['distances']), data['key'], data['date'])
+
+
+def update_fleet_state(data, result):
+    """Moves the units of the unit type to where and when the solution leaves them free."""
+    if 'free_units' in result:
+        get_fleet_state(data['key']).update(result['free_units'])
+
+
+def snapshot_checkpoint(day_counter):
+    """Writes the fleet state of every unit type every SNAPSHOT_DAYS days."""
+    if (day_counter + 1) % SNAPSHOT_DAYS == 0:
+        snapshot_fleet_states()
+
+
+def read_previous_routes(key, file_counter):
+    """Reads the routes saved by a previous run of the same day and unit type."""
+    try:
+        with open(f'optimizer_results/routes_{key}_{str(file_counter)}.json', 'r') as f:
+            return {int(unit): trip_ids for unit, trip_ids in json.load(f).items()}
+    except (OSError, ValueError):
+        return {}
+
+
+def get_initial_routes(data, manager, warm_start_routes):
+    """
+    Convert the routes of a plan into routing indices for every vehicle. The plan routes look
+    something like this:
+        {
+            44284: [201333, 209912, ...], # Trip ids of the unit in order.
+            ...
+        }
+    Trips that are not in the plan stay with the unit that originally made them. The trips of the
+    plan keep their order, every other trip goes before the first trip of the route that starts
+    later, and every pickup is followed by its delivery. The routes are repaired with
+    repair_initial_routes, returns the routing indices and the amount of trips moved and left out.
+    """
+    pickup_nodes = {
+        location['viaje_id']: node for node, location in data['locations'].items()
+        if location.get('type') == 'PICKUP'
+    }
+    vehicles = {unit: vehicle_id for vehicle_id, unit in enumerate(data['starts_definition'])}
+    routes = [[] for _ in range(data['num_vehicles'])]
+    unplanned = [[] for _ in range(data['num_vehicles'])]
+    assigned = set()
+
+    for unit, trip_ids in warm_start_routes.items():
+        if unit not in vehicles:
+            continue
+        for trip_id in trip_ids:
+            node = pickup_nodes.get(trip_id)
+            if node is not None and node not in assigned:
+                routes[vehicles[unit]].append(node)
+                assigned.add(node)
+
+    for node in pickup_nodes.values():
+        if node not in assigned and data['locations'][node]['unidad'] in vehicles:
+            unplanned[vehicles[data['locations'][node]['unidad']]].append(node)
+
+    for route, nodes in zip(routes, unplanned):
+        for node in sorted(nodes, key=lambda node: data['locations'][node]['minutes']):
+            position = next((
+                position for position, route_node in enumerate(route)
+                if data['locations'][route_node]['minutes'] > data['locations'][node]['minutes']
+            ), len(route))
+            route.insert(position, node)
+
+    routes, moved, left_out = repair_initial_routes(data, routes)
+    return [
+        [manager.NodeToIndex(route_node) for node in route for route_node in (node, node + 1)]
+        for route in routes
+    ], moved, left_out
+
+
+def repair_initial_routes(data, routes):
+    """
+    The solver rejects initial routes with a single pickup out of its time window, so every route
+    is cut at the first pickup its unit can't make in time. The cut trips are given to idle units
+    that reach them, like the new trips of a re-plan. A cut trip that no idle unit reaches goes to
+    the first route that still makes every pickup with the trip inserted by start time, and is left
+    out when there is none. Returns the routes and the amount of trips moved and left out.
+    """
+    vehicle_states = get_vehicle_states(data)
+    units = data['starts_definition']
+    minutes = lambda node: data['locations'][node]['minutes']
+    cut = []
+    for vehicle_id, route in enumerate(routes):
+        prefix = get_route_prefix(data, vehicle_states[units[vehicle_id]], route)
+        cut.extend(route[len(prefix):])
+        routes[vehicle_id] = list(prefix)
+    if not cut:
+        return routes, 0, 0
+
+    pickup_nodes = {data['locations'][node]['viaje_id']: node for node in cut}
+    unit_routes = {unit: [data['locations'][node]['viaje_id'] for node in route] for unit, route in zip(units, routes)}
+    assign_new_trips(data, cut, vehicle_states, unit_routes)
+    placed = set()
+    for vehicle_id, unit in enumerate(units):
+        if not routes[vehicle_id] and unit_routes[unit]:
+            routes[vehicle_id] = [pickup_nodes[trip_id] for trip_id in unit_routes[unit]]
+            placed.update(routes[vehicle_id])
+
+    left_out = 0
+    for node in sorted((node for node in cut if node not in placed), key=minutes):
+        for vehicle_id, route in enumerate(routes):
+            position = next((position for position, route_node in enumerate(route)
+                             if minutes(route_node) > minutes(node)), len(route))
+            candidate = route[:position] + [node] + route[position:]
+            if len(get_route_prefix(data, vehicle_states[units[vehicle_id]], candidate)) == len(candidate):
+                routes[vehicle_id] = candidate
+                break
+        else:
+            left_out += 1
+    return routes, len(cut) - left_out, left_out
+
+
+def build_transit_matrix(data):
+    """
+    Calculate the integer time cost between every pair of nodes. Arcs from and to the dummy depot,
+    from a node to itself and between nodes of the same location cost 0.
+    """
+    node_ids = np.array([data['locations'][node]['id']
+                        for node in range(len(data['locations']))], dtype=np.int64)
+    distance_matrix = data['distances']
+    indices = distance_matrix.indices(node_ids)
+    known = indices >= 0
+
+    matrix = np.full((len(node_ids), len(node_ids)), MISSING_TIME, dtype=np.int64)
+    matrix[np.ix_(known, known)] = distance_matrix.time_matrix[np.ix_(
+        indices[known], indices[known])].astype(np.int64)
+    matrix[node_ids[:, None] == node_ids[None, :]] = 0
+    matrix[0, :] = 0
+    matrix[:, 0] = 0
+
+    return matrix
+
+
+def optimize(data, transit_mode=TRANSIT_MODE, warm_start=WARM_START, stopping=STOPPING_MODE,
+             arc_pruning=ARC_PRUNING, time_limit=None, pruning_baseline=ARC_PRUNING_BASELINE):
+    """
+    Build and solve the routing model of one unit type. Returns the solver report lines and, when a
+    solution was found, the output of print_solution. Everything returned can be pickled, so the
+    solve can run in a worker process. A fixed search takes time_limit seconds, TIME_LIMIT when
+    not given.
+    """
 
     # Create the routing index manager.
     manager = pywrapcp.RoutingIndexManager(len(data['locations']),
@@ -156,6 +386,7 @@ def optimize(data, counter):
 
     # Define time cost of each arc.
     def time_callback(from_index, to_index):
+        """Returns the travel time between the two nodes."""
         from_node = manager.IndexToNode(from_index)
         to_node = manager.IndexToNode(to_index)
 
@@ -167,15 +398,19 @@ def optimize(data, counter):
 
         if from_location == to_location:
             return 0
-        try:
-            distance = distance_matrix[min(from_location, to_location)][max(
-                from_location, to_location)]
-        except Exception:
-            distance = 99999999999999
 
-        return distance
+        return int(data['distances'].time(from_location, to_location))
 
-    transit_callback_index = routing.RegisterTransitCallback(time_callback)
+    transit_matrix = None
+    if transit_mode == 'matrix' or arc_pruning:
+        transit_matrix = build_transit_matrix(data)
+
+    if transit_mode == 'matrix':
+        transit_callback_index = routing.RegisterTransitMatrix(
+            transit_matrix.tolist())
+    else:
+        transit_callback_index = routing.RegisterTransitCallback(
+            time_callback)
     routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
 
     # Add Distance constraint.
@@ -196,8 +431,12 @@ def optimize(data, counter):
         from_node = manager.IndexToNode(from_index)
         return data['demands'][from_node]
 
-    demand_callback_index = routing.RegisterUnaryTransitCallback(
-        demand_callback)
+    if transit_mode == 'matrix':
+        demand_callback_index = routing.RegisterUnaryTransitVector(
+            data['demands'])
+    else:
+        demand_callback_index = routing.RegisterUnaryTransitCallback(
+            demand_callback)
     routing.AddDimensionWithVehicleCapacity(
         demand_callback_index,
         0,  # null capacity slack
@@ -272,41 +511,433 @@ def optimize(data, counter):
     # search_parameters.local_search_metaheuristic = (routing_enums_pb2.LocalSearchMetaheuristic.AUTOMATIC)
     search_parameters.local_search_metaheuristic = (
         routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH)
-    search_parameters.time_limit.seconds = 60 * 2
+    search_parameters.time_limit.seconds = time_limit or TIME_LIMIT
+
+    arc_report = ""
+    if arc_pruning:
+        removed_arcs, total_arcs = remove_infeasible_arcs(data, manager, routing, transit_matrix)
+        arc_report = (
+            f"Arc pruning: removed {removed_arcs} of {total_arcs} arcs "
+            f"({round(100 * removed_arcs / max(total_arcs, 1), 2)}%)\n\n"
+        )
+
+    monitor = None
+    if stopping == 'adaptive':
+        monitor = ConvergenceMonitor(routing, len(data['locations']))
+        search_parameters.time_limit.seconds = monitor.ceiling
+        routing.AddAtSolutionCallback(monitor.on_solution)
+        routing.AddSearchMonitor(routing.solver().CustomLimit(monitor.should_stop))
 
     print("Initializing solving process...")
 
+    solutions = []
+    routing.AddAtSolutionCallback(
+        lambda: solutions.append((time() - solve_start, routing.CostVar().Max())))
+
     # Solve the problem.
-    solution = routing.SolveWithParameters(search_parameters)
+    solve_start = time()
+    if monitor:
+        monitor.start()
+    if warm_start:
+        routing.CloseModelWithParameters(search_parameters)
+        initial_routes, moved_trips, left_out_trips = get_initial_routes(
+            data, manager, data.get('warm_start_routes', {}))
+        warm_start_report = f"{warm_start} ({moved_trips} trips moved, {left_out_trips} left out)"
+        initial_solution = routing.ReadAssignmentFromRoutes(initial_routes, True)
+        if not initial_solution:
+            # A rejected assignment leaves the closed model unusable, so it is built again and
+            # solved from scratch.
+            result = optimize(data, transit_mode, None, stopping, arc_pruning, time_limit, pruning_baseline)
+            result['report_lines'][-1] = result['report_lines'][-1].replace(
+                "Warm start: none", f"Warm start: {warm_start_report}, initial routes rejected", 1)
+            return result
+        solution = routing.SolveFromAssignmentWithParameters(
+            initial_solution, search_parameters)
+    else:
+        solution = routing.SolveWithParameters(search_parameters)
+    solve_time = time() - solve_start
+
+    if monitor and monitor.stop_reason:
+        stop_reason = monitor.stop_reason
+    elif solve_time >= search_parameters.time_limit.seconds:
+        stop_reason = f"time limit of {search_parameters.time_limit.seconds} seconds reached"
+    else:
+        stop_reason = "search completed"
+
+    checkpoints = ', '.join(
+        f"{checkpoint}s: {min((objective for elapsed, objective in solutions if elapsed <= checkpoint), default='-')}"
+        for checkpoint in SOLUTION_CHECKPOINTS
+    )
+    search_report = (
+        f"Warm start: {warm_start_report if warm_start else 'none'}\n\n"
+        f"Time to first solution: {round(solutions[0][0], 2) if solutions else '-'} seconds\n\n"
+        f"Objective at checkpoints: {checkpoints}\n\n"
+    )
 
-    with open(f'optimizer_results/{str(counter)}.txt', 'a') as f:
-        f.write(
-            f"Amount of {data['key']} trucks originally used: {data['old_trip_info'][0]}\n\n")
-        f.write(f"Amount of trips to optimize: {data['old_trip_info'][1]}\n\n")
-        f.write(SOLVER_STATUS_MAP[routing.status()])
+    solver = routing.solver()
+    search_rate = solver.AcceptedNeighbors() / max(solve_time, 1e-9)
+    search_report += arc_report
+    search_report += (
+        f"Search ({transit_mode}): {solver.AcceptedNeighbors()} accepted neighbors, "
+        f"{solver.Branches()} branches in {round(solve_time, 2)} seconds "
+        f"({round(search_rate, 2)} neighbors per second)\n\n"
+    )
+    if arc_pruning and pruning_baseline:
+        baseline = optimize(data, transit_mode, warm_start, stopping, False, time_limit)
+        search_report += (
+            f"Without arc pruning: {round(baseline['search_rate'], 2)} neighbors per second, "
+            f"{round(100 * (search_rate / max(baseline['search_rate'], 1e-9) - 1), 2):+}% with pruning\n\n"
+        )
+    print(search_report)
+
+    status_line = SOLVER_STATUS_MAP.get(routing.status(), f"ROUTING_STATUS_{routing.status()}: Unknown status.\n\n")
+    result = {
+        'report_lines': [
+            f"Amount of {data['key']} trucks originally used: {data['old_trip_info'][0]}\n\n",
+            f"Amount of trips to optimize: {data['old_trip_info'][1]}\n\n",
+        ] + ([data['pruning_report']] if 'pruning_report' in data else []) + [
+            status_line,
+            f"Stopped ({stopping}): {stop_reason}\n\n",
+            search_report,
+        ],
+        'search_rate': search_rate,
+    }
 
     print('\n')
-    print(SOLVER_STATUS_MAP[routing.status()])
+    print(status_line)
+    print(f"Stopped ({stopping}): {stop_reason}")
     print('\n')
     # Print solution on console.
     if solution:
-        print_solution(data, manager, routing, solution, counter)
+        result.update(print_solution(data, manager, routing, solution))
+
+    return result
+
+
+def optimize_decomposed(data, transit_mode=TRANSIT_MODE, stopping=STOPPING_MODE, arc_pruning=ARC_PRUNING,
+                        workers=DECOMPOSITION_WORKERS, pruning_baseline=ARC_PRUNING_BASELINE):
+    """
+    Split the day in clusters of trips by start time and origin region, solve the clusters of every
+    time slab in parallel worker processes and merge the routes. Units move to where they are free
+    after every slab, so a unit can keep working in a cluster of a later slab. Days with at most
+    MAX_CLUSTER_TRIPS trips are solved as a whole, whatever their time span.
+    """
+    if len(data['pickups_deliveries']) <= MAX_CLUSTER_TRIPS:
+        return optimize(data, transit_mode, None, stopping, arc_pruning, pruning_baseline=pruning_baseline)
+
+    slabs = build_clusters(data)
+
+    vehicle_states = get_vehicle_states(data)
+    cluster_results = []
+    report_lines = []
+    with ProcessPoolExecutor(max_workers=workers) as cluster_pool:
+        for slab_idx, clusters in enumerate(slabs):
+            vehicles = assign_vehicles(data, clusters, vehicle_states)
+            sub_datas = [
+                (f"{slab_idx + 1}.{cluster_idx + 1}", cluster, build_sub_data(data, cluster, units, vehicle_states))
+                for cluster_idx, (cluster, units) in enumerate(zip(clusters, vehicles))
+            ]
+            futures = [
+                cluster_pool.submit(
+                    optimize, sub_data, transit_mode, None, stopping, arc_pruning, pruning_baseline=pruning_baseline)
+                for _, _, sub_data in sub_datas
+            ]
+            unsolved = []
+            for (name, cluster, sub_data), future in zip(sub_datas, futures):
+                result = future.result()
+                report_lines.append(
+                    f"Cluster {name} ({sub_data['old_trip_info'][1]} trips, {sub_data['num_vehicles']} vehicles): "
+                    + ''.join(result['report_lines'][2:]))
+                if 'trips' not in result:
+                    unsolved.append((name, cluster))
+                    continue
+                update_vehicle_states(data, vehicle_states, result['free_units'])
+                cluster_results.append((name, sub_data, result))
+
+            # A cluster without a solution is solved again with every unit as a candidate, the units of
+            # the other clusters of the slab start where their routes end.
+            for name, cluster in unsolved:
+                sub_data = build_sub_data(data, cluster, list(vehicle_states), vehicle_states)
+                result = optimize(
+                    sub_data, transit_mode, None, stopping, arc_pruning, pruning_baseline=pruning_baseline)
+                report_lines.append(
+                    f"Cluster {name} retried with every unit ({sub_data['num_vehicles']} vehicles): "
+                    + ''.join(result['report_lines'][2:]))
+                if 'trips' not in result:
+                    report_lines.append(f"Cluster {name}: {sub_data['old_trip_info'][1]} trips not assigned\n\n")
+                    continue
+                update_vehicle_states(data, vehicle_states, result['free_units'])
+                cluster_results.append((name, sub_data, result))
+
+    result = {
+        'report_lines': [
+            f"Amount of {data['key']} trucks originally used: {data['old_trip_info'][0]}\n\n",
+            f"Amount of trips to optimize: {data['old_trip_info'][1]}\n\n",
+        ] + ([data['pruning_report']] if 'pruning_report' in data else []) + [
+            f"Decomposed in {sum(len(clusters) for clusters in slabs)} clusters over {len(slabs)} time slabs\n\n",
+        ] + report_lines,
+    }
+    result.update(merge_results(data, cluster_results, vehicle_states))
+    return result
+
+
+def optimize_replan(data, plan, cutoff, transit_mode=TRANSIT_MODE, arc_pruning=ARC_PRUNING,
+                    time_limit=REPLAN_TIME_LIMIT, pruning_baseline=ARC_PRUNING_BASELINE):
+    """
+    Re-optimize a day that is in progress at the cutoff minute. The trips of the plan that start
+    before the cutoff are kept as a fixed prefix of the routes and only the remaining trips, with
+    the ones the plan doesn't know, are solved again, warm started from the plan. When the re-plan
+    finds no solution the plan is kept.
+    """
+    replan_start = time()
+    replan_data, frozen, vehicle_states = build_replan_data(data, plan, cutoff)
+    frozen_result = get_frozen_result(plan, frozen)
+    frozen_data = {
+        'old_trip_info': (len(frozen_result['routes']), sum(len(trips) for trips in frozen.values())),
+        'num_vehicles': len(frozen_result['routes']),
+    }
+
+    result = optimize(
+        replan_data, transit_mode, 'plan', 'fixed', arc_pruning, time_limit, pruning_baseline=pruning_baseline)
+    report_lines = [
+        f"Amount of {data['key']} trucks originally used: {data['old_trip_info'][0]}\n\n",
+        f"Amount of trips to optimize: {data['old_trip_info'][1]}\n\n",
+        f"Re-plan at minute {cutoff}: {frozen_data['old_trip_info'][1]} trips of {frozen_data['num_vehicles']} "
+        f"units frozen, {replan_data['old_trip_info'][1]} trips re-planned with {replan_data['num_vehicles']} "
+        f"vehicles, {len(replan_data['locations'])} of {len(data['locations'])} nodes, "
+        f"{round(time() - replan_start, 2)} seconds\n\n",
+    ] + result['report_lines'][2:]
+
+    if 'trips' not in result:
+        report_lines.append("Re-plan found no solution, keeping the plan\n\n")
+        return dict(plan, report_lines=report_lines)
+
+    update_vehicle_states(data, vehicle_states, result['free_units'])
+    replanned = {'report_lines': report_lines}
+    replanned.update(merge_results(
+        data, [('frozen prefix', frozen_data, frozen_result), ('re-plan', replan_data, result)], vehicle_states))
+    return replanned
+
+
+def optimize_with_replan(data, cutoff, transit_mode=TRANSIT_MODE, stopping=STOPPING_MODE, decompose=False,
+                         arc_pruning=ARC_PRUNING, pruning_baseline=ARC_PRUNING_BASELINE):
+    """
+    Simulate a day that changes while it is in progress: the trips known before the day are
+    planned, then the day is re-planned at the cutoff with the trips that became known since.
+    """
+    known_data, new_trip_ids = get_known_data(data, cutoff)
+    plan_start = time()
+    if decompose:
+        plan = optimize_decomposed(known_data, transit_mode, stopping, arc_pruning, pruning_baseline=pruning_baseline)
+    else:
+        plan = optimize(known_data, transit_mode, None, stopping, arc_pruning, pruning_baseline=pruning_baseline)
+    plan_report = (
+        f"Initial plan ({known_data['old_trip_info'][1]} trips known, {len(new_trip_ids)} added at the re-plan, "
+        f"{round(time() - plan_start, 2)} seconds): " + ''.join(plan['report_lines'][2:])
+    )
+    if 'trips' not in plan:
+        plan['report_lines'] = plan['report_lines'][:2] + [plan_report]
+        return plan
+
+    result = optimize_replan(data, plan, cutoff, transit_mode, arc_pruning, pruning_baseline=pruning_baseline)
+    result['report_lines'].insert(2, plan_report)
+    return result
+
+
+def optimize_window(data, previous_routes, transit_mode=TRANSIT_MODE, stopping=STOPPING_MODE,
+                    arc_pruning=ARC_PRUNING, pruning_baseline=ARC_PRUNING_BASELINE):
+    """
+    Solve a window of the rolling horizon, warm started from the routes the previous window left,
+    and commit only its first day. Returns the result of the first day and the routes left for the
+    next window.
+    """
+    data['warm_start_routes'], carried = get_window_warm_start(data, previous_routes)
+    window = optimize(
+        data, transit_mode, 'rolling' if previous_routes else None, stopping, arc_pruning,
+        pruning_baseline=pruning_baseline)
+    if 'trips' not in window:
+        return window, {}
+
+    committed, vehicle_states, remaining_routes = commit_first_day(data, window)
+    first_day = {
+        'old_trip_info': (len(committed['routes']), sum(len(trip_ids) for trip_ids in committed['routes'].values())),
+        'num_vehicles': len(committed['routes']),
+    }
+    result = {
+        'report_lines': window['report_lines'][:2] + [
+            f"Rolling window of {len(data['locations'])} nodes: {carried} trips with routes from the previous "
+            f"window, {first_day['old_trip_info'][1]} trips of the first day committed\n\n",
+        ] + window['report_lines'][2:],
+    }
+    result.update(merge_results(data, [('first day', first_day, committed)], vehicle_states))
+    return result, remaining_routes
 
 
 def date_generator():
-    global current_date
     current_date = DATE_RANGE_START
     while current_date < DATE_RANGE_END:
         yield current_date, current_date + datetime.timedelta(days=1)
         current_date = current_date + datetime.timedelta(days=1)
 
 
-if __name__ == "__main__":
+def set_warm_start_routes(data, warm_start, file_counter):
+    """Adds the routes of the previous run to the data when warm starting from it."""
+    data['warm_start_routes'] = {}
+    if warm_start == 'previous':
+        data['warm_start_routes'] = read_previous_routes(data['key'], file_counter)
+
+
+def run_month(transit_mode=TRANSIT_MODE, warm_start=WARM_START, stopping=STOPPING_MODE, decompose=False,
+              prune=False, arc_pruning=ARC_PRUNING, replan_cutoff=REPLAN_CUTOFF, columnar=COLUMNAR_RESULTS,
+              pruning_baseline=ARC_PRUNING_BASELINE):
     counter = 0
-    for _ in date_generator():
-        for data in create_data_model():
+    for start, end in date_generator():
+        for data in create_data_model(start, end):
             # continue
             if data and data['key'] == 'Thorton':
-                optimize(data, counter)
+                if prune:
+                    data = prune_vehicles(data)
+                if replan_cutoff is not None:
+                    result = optimize_with_replan(
+                        data, replan_cutoff, transit_mode, stopping, decompose, arc_pruning,
+                        pruning_baseline=pruning_baseline)
+                elif decompose:
+                    result = optimize_decomposed(
+                        data, transit_mode, stopping, arc_pruning, pruning_baseline=pruning_baseline)
+                else:
+                    set_warm_start_routes(data, warm_start, counter)
+                    result = optimize(
+                        data, transit_mode, warm_start, stopping, arc_pruning, pruning_baseline=pruning_baseline)
+                update_fleet_state(data, result)
+                save_solution(data, result, counter, columnar)
+        snapshot_checkpoint(counter)
+        counter += 1
+        print("Done")
+    snapshot_fleet_states()
+
+
+def run_rolling(transit_mode=TRANSIT_MODE, stopping=STOPPING_MODE, horizon=ROLLING_HORIZON, prune=False,
+                arc_pruning=ARC_PRUNING, columnar=COLUMNAR_RESULTS, pruning_baseline=ARC_PRUNING_BASELINE):
+    """
+    Solve windows of horizon days that slide one day at a time, so trips that end after midnight
+    are planned together with the trips of the next days. Only the first day of every window is
+    saved and moves the fleet state. The next window is warm started from the routes of the rest
+    of the days and the distance cache only fetches the locations of the day that entered it.
+    """
+    counter = 0
+    previous_routes = {}
+    for start, _ in date_generator():
+        end = min(start + datetime.timedelta(days=horizon), DATE_RANGE_END)
+        for data in create_data_model(start, end):
+            if data and data['key'] == 'Thorton':
+                if prune:
+                    data = prune_vehicles(data)
+                result, previous_routes[data['key']] = optimize_window(
+                    data, previous_routes.get(data['key'], {}), transit_mode, stopping, arc_pruning,
+                    pruning_baseline=pruning_baseline)
+                update_fleet_state(data, result)
+                save_solution(data, result, counter, columnar)
+        snapshot_checkpoint(counter)
         counter += 1
         print("Done")
+    snapshot_fleet_states()
+
+
+def prefetch_days(days_queue):
+    """Reads the trips and loads the distances of the next days while the current one is solving."""
+    for start, end in date_generator():
+        days_queue.put((start, end, prefetch_trips(start, end)))
+    days_queue.put(None)
+
+
+def write_results(results_queue):
+    """Writes the results of the solved days while the next ones are solving."""
+    while True:
+        item = results_queue.get()
+        if item is None:
+            break
+        save_solution(*item)
+
+
+def run_month_pipelined(transit_mode=TRANSIT_MODE, warm_start=WARM_START, stopping=STOPPING_MODE,
+                        decompose=False, prune=False, arc_pruning=ARC_PRUNING,
+                        replan_cutoff=REPLAN_CUTOFF, columnar=COLUMNAR_RESULTS, queue_size=PIPELINE_QUEUE_SIZE,
+                        pruning_baseline=ARC_PRUNING_BASELINE):
+    """
+    Same run as run_month, but the trips and distances of the next day are loaded and the results
+    of the previous one are written while the solver works on the current day. The solve runs in a
+    worker process because the solver holds the GIL. The only hand-off between days is the fleet
+    state of each unit type, which is updated before the next day of that type is built.
+    """
+    days_queue = Queue(maxsize=queue_size)
+    results_queue = Queue(maxsize=queue_size)
+    prefetcher = Thread(target=prefetch_days, args=(days_queue, ), daemon=True)
+    writer = Thread(target=write_results, args=(results_queue, ))
+    prefetcher.start()
+    writer.start()
+
+    counter = 0
+    with ProcessPoolExecutor(max_workers=1) as solver_pool:
+        while True:
+            day = days_queue.get()
+            if day is None:
+                break
+            start, end, trips_per_unit_type = day
+            for data in create_data_model(start, end, trips_per_unit_type):
+                if data and data['key'] == 'Thorton':
+                    if prune:
+                        data = prune_vehicles(data)
+                    if replan_cutoff is not None and decompose:
+                        result = optimize_with_replan(
+                            data, replan_cutoff, transit_mode, stopping, decompose, arc_pruning,
+                            pruning_baseline=pruning_baseline)
+                    elif replan_cutoff is not None:
+                        result = solver_pool.submit(
+                            optimize_with_replan, data, replan_cutoff, transit_mode, stopping, decompose,
+                            arc_pruning, pruning_baseline=pruning_baseline).result()
+                    elif decompose:
+                        result = optimize_decomposed(
+                            data, transit_mode, stopping, arc_pruning, pruning_baseline=pruning_baseline)
+                    else:
+                        set_warm_start_routes(data, warm_start, counter)
+                        result = solver_pool.submit(
+                            optimize, data, transit_mode, warm_start, stopping, arc_pruning,
+                            pruning_baseline=pruning_baseline).result()
+                    update_fleet_state(data, result)
+                    results_queue.put((data, result, counter, columnar))
+            snapshot_checkpoint(counter)
+            counter += 1
+            print("Done")
+
+    results_queue.put(None)
+    writer.join()
+    snapshot_fleet_states()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t', '--transit_mode', choices=['matrix', 'callback'], help='How arc costs are evaluated by the solver', action='store', default=TRANSIT_MODE)
+    parser.add_argument('-l', '--pipelined', action='store_true', help='Load the next day and write the previous one while the current day is solving')
+    parser.add_argument('-w', '--warm_start', choices=['historical', 'previous'], help='Start the search from the real routes or from a previous run', action='store', default=WARM_START)
+    parser.add_argument('-p', '--stopping', choices=['fixed', 'adaptive'], help='Search for a fixed time or until the objective stops improving', action='store', default=STOPPING_MODE)
+    parser.add_argument('-d', '--decompose', action='store_true', help='Solve big days as clusters of trips by start time and region')
+    parser.add_argument('-r', '--prune', action='store_true', help='Drop the vehicles that are not among the best candidates of any trip')
+    parser.add_argument('-a', '--arc_pruning', action='store_true', help='Remove the arcs that break a time window or the capacity before the solve')
+    parser.add_argument('-b', '--pruning_baseline', action='store_true', help='Also solve every pruned model without arc pruning and report both search rates')
+    parser.add_argument('-c', '--replan_cutoff', type=int, help='Minute of the day at which every day is re-planned with the trips added since the plan', action='store', default=REPLAN_CUTOFF)
+    parser.add_argument('-o', '--horizon', type=int, help='Solve windows of this many days and commit only the first day of each', action='store', default=ROLLING_HORIZON)
+    parser.add_argument('-k', '--columnar', action='store_true', help='Also write the results of every day as compressed typed columns')
+    args = parser.parse_args()
+
+    if args.horizon:
+        run_rolling(args.transit_mode, args.stopping, args.horizon, args.prune, args.arc_pruning, args.columnar,
+                    pruning_baseline=args.pruning_baseline)
+    elif args.pipelined:
+        run_month_pipelined(args.transit_mode, args.warm_start, args.stopping, args.decompose, args.prune,
+                            args.arc_pruning, args.replan_cutoff, args.columnar,
+                            pruning_baseline=args.pruning_baseline)
+    else:
+        run_month(args.transit_mode, args.warm_start, args.stopping, args.decompose, args.prune,
+                  args.arc_pruning, args.replan_cutoff, args.columnar, pruning_baseline=args.pruning_baseline)
+
+    print(f"Distance cache: {get_distance_cache().stats()}")
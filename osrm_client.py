@@ -0,0 +1,153 @@
+import argparse
+import asyncio
+import random
+from time import time
+
+import aiohttp
+
+from fake_osrm import start_fake_osrm, table_url
+from tile_planner import MAX_TABLE_COORDINATES, plan_tiles, tile_size, tile_url
+
+# Requests in flight at the same time, seconds before a request is abandoned and retries of a
+# request before its pairs are recorded as failed.
+CONCURRENCY = 16
+REQUEST_TIMEOUT = 30
+RETRIES = 5
+# Exponential backoff between retries, the wait is a random share of the step so clients that
+# failed together don't retry together.
+BACKOFF_SECONDS = 0.5
+MAX_BACKOFF_SECONDS = 30
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class OsrmTableClient:
+    """
+    Asynchronous client of the OSRM table service. Every job is a tile of sources and destinations
+    and is answered with the distance and duration matrices from every source to every destination.
+    At most `concurrency` requests are in flight and they share keep-alive connections. Requests
+    that time out or fail with a retryable status are retried with jittered exponential backoff,
+    and jobs that still fail are kept in `failed` instead of stopping the run.
+    """
+
+    def __init__(self, url, concurrency=CONCURRENCY, timeout=REQUEST_TIMEOUT, retries=RETRIES,
+                 backoff=BACKOFF_SECONDS, max_backoff=MAX_BACKOFF_SECONDS):
+        self.url = url
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failed = []
+        self.requests = 0
+        self.retried = 0
+        self.pairs = 0
+
+    def backoff_delay(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    async def fetch(self, session, sources, destinations, coordinates):
+        "Distance and duration matrices from the sources to the destinations, None when the job failed."
+        url = tile_url(self.url, sources, destinations, coordinates)
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.retried += 1
+                await asyncio.sleep(self.backoff_delay(attempt - 1))
+            self.requests += 1
+            try:
+                async with session.get(url) as response:
+                    if response.status in RETRY_STATUSES:
+                        error = f"HTTP {response.status}"
+                        continue
+                    result = await response.json(content_type=None)
+                if response.status != 200 or result.get('code') != 'Ok':
+                    error = f"HTTP {response.status} {result.get('code')}"
+                    break
+                self.pairs += len(sources) * len(destinations)
+                return result['distances'], result['durations']
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                error = f"{type(e).__name__}: {e}"
+
+        self.failed.append((list(sources), list(destinations), error))
+        return None
+
+    async def run(self, jobs, coordinates, on_result):
+        """
+        Fetch every (sources, destinations) job and call on_result(sources, destinations, distances,
+        durations) with the ones that succeeded. A fixed set of workers pull from the same job
+        iterator, so the jobs never have to be in memory at once.
+        """
+        jobs = iter(jobs)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+
+        async def worker(session):
+            for sources, destinations in jobs:
+                result = await self.fetch(session, sources, destinations, coordinates)
+                if result:
+                    on_result(sources, destinations, *result)
+
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            await asyncio.gather(*[worker(session) for _ in range(self.concurrency)])
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'retried': self.retried,
+            'pairs': self.pairs,
+            'failed_jobs': len(self.failed),
+            'failed_pairs': sum(len(sources) * len(destinations) for sources, destinations, _ in self.failed),
+        }
+
+
+def row_jobs(locations, destinations_per_request):
+    "One origin and up to destinations_per_request of the locations after it per job."
+    return (
+        ([origin], list(range(first, min(first + destinations_per_request, locations))))
+        for origin in range(locations)
+        for first in range(origin + 1, locations, destinations_per_request)
+    )
+
+
+def tile_jobs(locations, max_coordinates):
+    "Square tiles covering every pair of the locations."
+    return (
+        (sources.tolist(), destinations.tolist())
+        for sources, destinations in plan_tiles(locations, tile_size(max_coordinates))
+    )
+
+
+def benchmark(locations=2000, max_coordinates=MAX_TABLE_COORDINATES, concurrency=CONCURRENCY, delay=0,
+              failure_rate=0, rows=False):
+    """
+    Fetch every pair of random locations in Mexico from a local fake OSRM and print the throughput,
+    with tiles or with one origin row per request.
+    """
+    server = start_fake_osrm(delay=delay, failure_rate=failure_rate)
+    coordinates = {
+        location: {'latitude': round(random.uniform(15, 32), 5), 'longitude': round(random.uniform(-117, -87), 5)}
+        for location in range(locations)
+    }
+    jobs = row_jobs(locations, max_coordinates - 1) if rows else tile_jobs(locations, max_coordinates)
+
+    client = OsrmTableClient(table_url(server.server_port), concurrency=concurrency, backoff=0.05)
+    start_time = time()
+    asyncio.run(client.run(jobs, coordinates, lambda *result: None))
+    elapsed = time() - start_time
+    server.shutdown()
+
+    print(f"{client.stats()} in {round(elapsed, 2)} seconds, {int(client.pairs / elapsed)} pairs per second")
+    return client
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-l', '--locations', type=int, help='Random locations of the benchmark', action='store', default=2000)
+    parser.add_argument('-t', '--table_size', type=int, help='Coordinates per request', action='store', default=MAX_TABLE_COORDINATES)
+    parser.add_argument('-r', '--rows', action='store_true', help='Request one origin row per call instead of tiles')
+    parser.add_argument('-c', '--concurrency', type=int, help='Requests in flight', action='store', default=CONCURRENCY)
+    parser.add_argument('-d', '--delay', type=float, help='Seconds the fake server waits before answering', action='store', default=0)
+    parser.add_argument('-f', '--failure_rate', type=float, help='Share of requests the fake server fails', action='store', default=0)
+    args = parser.parse_args()
+
+    benchmark(args.locations, args.table_size, args.concurrency, args.delay, args.failure_rate, args.rows)
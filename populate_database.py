@@ -1,19 +1,25 @@
 import csv
-import psycopg2
 import requests
 import sys
 import traceback
 
+import database
+from locations_database import MissingPairs
+from tile_planner import tile_rows, tile_size, tile_url
+
 API_KEY = '*'
 GEOCODING_URL = 'https://maps.googleapis.com/maps/api/geocode/json?address={address}&region=ar&key={key}'
-DISTANCE_URL = 'http://router.project-osrm.org/table/v1/driving/{locations}?annotations=distance,duration&sources=0'
+DISTANCE_URL = 'http://router.project-osrm.org/table/v1/driving/{locations}?annotations=distance,duration'
 
 print('Connecting to database...')
 
-conn = psycopg2.connect(database='assistcargo', user='*', password='*', host='localhost')
+conn = database.get_pool().getconn()
 
 cur = conn.cursor()
 
+# Distances are copied in batches, the missing pairs are read once before the first request.
+distances_writer = database.BulkWriter('distancias', database.DISTANCE_COLUMNS, database.DISTANCE_KEY_COLUMNS)
+
 def query_geo(ubicacion):
     try:
         address = f"{ubicacion['domicilio']}, {ubicacion['localidad']}"
@@ -34,54 +40,19 @@ def insert_entry(ubicacion_id, domicilio, localidad, latitud, longitud):
     )
     conn.commit()
 
-def batch(iterable, n=1):
-    l = len(iterable)
-    for ndx in range(0, l, n):
-        yield iterable[ndx:min(ndx + n, l)]
-
-def distancias_faltantes(ubicacion_id, list_ubicaciones):
-    cur.execute("SELECT ubicacion_id_destino FROM distancias WHERE ubicacion_id_destino = ANY(%s) AND ubicacion_id_origen = %s;", (list_ubicaciones, ubicacion_id))
-    ubicaciones_existentes = cur.fetchall()
-    cur.execute("SELECT ubicacion_id_origen FROM distancias WHERE ubicacion_id_origen = ANY(%s) AND ubicacion_id_destino = %s;", (list_ubicaciones, ubicacion_id))
-    ubicaciones_existentes_2 = cur.fetchall()
-    ubicaciones_faltantes = set(list_ubicaciones) - set([a[0] for a in ubicaciones_existentes if ubicaciones_existentes]) - set([a[0] for a in ubicaciones_existentes_2 if ubicaciones_existentes_2]) - {ubicacion_id}
-    return list(ubicaciones_faltantes)
-
-def insert_time_distance(origin, destination, distance, time):
+def calcular_distancias(sources, destinations, info_dict, missing_pairs):
+    "Request the table of a tile and store its missing pairs."
     try:
-        cur.execute(
-            "INSERT INTO distancias (ubicacion_id_origen, ubicacion_id_destino, distancia, tiempo) VALUES (%s, %s, %s, %s);",
-            (min([origin, destination]), max([origin, destination]), distance, time),
-        )
-    except Exception:
-        traceback.print_exc()
-    finally:
-        conn.commit()
-
-def guardar_resultados_distancias(ids, distance_results, time_results):
-    origin = ids[0]
-    distance_results = [round(i / 1000, 2) if i else 0 for i in distance_results ]
-    time_results = [int(i / 60) if i else 0 for i in time_results]
-
-    for idx, id in enumerate(ids):
-        if id == origin:
-            continue
-        insert_time_distance(origin, id, distance_results[idx], time_results[idx])
-
-def calcular_distancias(origin, destinations, info_dict):
-    origin_string = f"{info_dict[origin]['longitude']},{info_dict[origin]['latitude']}"
-    destination_strings = ';'.join([f"{info_dict[i]['longitude']},{info_dict[i]['latitude']}" for i in destinations])
-    full_string = f"{origin_string};{destination_strings}"
-    try:
-        formated_url = DISTANCE_URL.format(locations=full_string)
-        result = requests.get(formated_url)
+        result = requests.get(tile_url(DISTANCE_URL, sources, destinations, info_dict))
         result_json = result.json()
-        ids = destinations
-        ids.insert(0, origin)
 
-        guardar_resultados_distancias(ids=ids, distance_results=result_json['distances'][0], time_results=result_json['durations'][0])
+        missing = missing_pairs.missing_between(sources, destinations)
+        distances_writer.add_many(tile_rows(
+            sources, destinations, result_json['distances'], result_json['durations'], missing))
+        return int(missing.sum())
     except Exception:
         traceback.print_exc()
+        distances_writer.close()
         sys.exit(1)
 
 print('Reading csv...')
@@ -121,19 +92,14 @@ print('Getting locations...')
 cur.execute("SELECT * FROM ubicaciones")
 ubicaciones = cur.fetchall()
 
-set_ubicaciones_id = list(set(item[0] for item in ubicaciones))
-
 ubicaciones = {item[0]: {'latitude': str(round(item[3], 5)), 'longitude': str(round(item[4], 5))} for item in ubicaciones}
 
-ubicaciones_remaining = len(ubicaciones)
-
-for ubicacion_id, values in ubicaciones.items():
-    print(f"\n{str(int((len(ubicaciones) - ubicaciones_remaining) * 100 / len(ubicaciones)))}% done. {str(ubicaciones_remaining)} locations remaining...")
-    dist_not_calculated = distancias_faltantes(ubicacion_id, set_ubicaciones_id)
-    total = len(dist_not_calculated)
-    for dist_to_calculate in batch(dist_not_calculated, 100):
-        print(f"    {str(total)} remaining calculations for {str(ubicacion_id)}...")
-        calcular_distancias(ubicacion_id, dist_to_calculate, ubicaciones)
-        total -= 100
-    ubicaciones_remaining -= 1
+missing_pairs = MissingPairs(sorted(ubicaciones.keys()))
+missing_pairs.mark_existing(table='distancias')
+remaining = missing_pairs.missing()
+
+for sources, destinations in missing_pairs.iter_tiles(tile_size()):
+    print(f"{remaining} remaining calculations...")
+    remaining -= calcular_distancias(sources, destinations, ubicaciones, missing_pairs)
+distances_writer.close()
 print("\n\n100% DONE!!")
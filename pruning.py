@@ -0,0 +1,173 @@
+import datetime
+
+import numpy as np
+
+from fleet_state import index_vehicle_states
+
+# Reachable vehicles kept for every pickup, the ones with the shortest empty trip to it.
+PRUNING_CANDIDATES = 8
+# Vehicles that reach the most pickups, always kept so the model has room for other plans.
+PRUNING_FALLBACK = 20
+
+
+def get_reachable(data, vehicle_nodes, pickup_nodes):
+    """
+    Travel time from the start of every vehicle to every pickup and whether the vehicle can get
+    there before the time window of the pickup closes.
+    """
+    locations = data['locations']
+    vehicle_ids = np.array([locations[node]['id'] for node in vehicle_nodes], dtype=np.int64)
+    available = np.array([locations[node]['minutes'] for node in vehicle_nodes], dtype=np.int64)
+    pickup_ids = np.array([locations[node]['id'] for node in pickup_nodes], dtype=np.int64)
+    closes = np.array([1440 + locations[node]['day_delta'] * 1440 for node in pickup_nodes], dtype=np.int64)
+
+    origins, destinations = np.meshgrid(vehicle_ids, pickup_ids, indexing='ij')
+    travel = data['distances'].times(origins, destinations)
+    return travel, available[:, None] + travel <= closes[None, :]
+
+
+def select_vehicles(data, candidates=PRUNING_CANDIDATES, fallback=PRUNING_FALLBACK):
+    """
+    Vehicles worth keeping in the model: the best candidates of every pickup, the units that
+    originally made the trips of the day and the fallback pool. The candidates of a pickup are the
+    units waiting at it, earliest free first, and then the shortest empty trips to it. Vehicles
+    that can't reach any pickup are never kept. Returns the positions of the vehicles to keep and the amount of pickups
+    that no vehicle can reach.
+    """
+    pickup_nodes = [pickup for pickup, _ in data['pickups_deliveries']]
+    travel, reachable = get_reachable(data, data['starts'], pickup_nodes)
+    keep = np.zeros(len(data['starts']), dtype=bool)
+    if not pickup_nodes or not len(data['starts']):
+        return np.nonzero(keep)[0], 0
+
+    score = np.where(reachable, travel, np.inf)
+    starts = dict(enumerate(data['locations'][node] for node in data['starts']))
+    state = index_vehicle_states(list(starts), starts)
+    for column, pickup in enumerate(pickup_nodes):
+        location = data['locations'][pickup]
+        waiting = state.free_at_location(location['id'], location['minutes'])
+        score[waiting, column] = np.arange(len(waiting)) - len(waiting)
+    best = np.argsort(score, axis=0, kind='stable')[:candidates]
+    keep[best[np.take_along_axis(reachable, best, axis=0)]] = True
+
+    original_units = {data['locations'][node]['unidad'] for node in pickup_nodes}
+    keep |= np.array([unit in original_units for unit in data['starts_definition']])
+
+    reach_count = reachable.sum(axis=1)
+    keep[np.argsort(-reach_count, kind='stable')[:fallback]] = True
+
+    keep &= reach_count > 0
+    return np.nonzero(keep)[0], int((~reachable.any(axis=0)).sum())
+
+
+def prune_vehicles(data, candidates=PRUNING_CANDIDATES, fallback=PRUNING_FALLBACK):
+    """
+    Data model without the vehicles select_vehicles drops. The START nodes of the removed vehicles
+    are kept in data['pruned_units'] so they are still written to the free units file, and the
+    amount of removed vehicles is added to the solver report.
+    """
+    kept, unreachable_pickups = select_vehicles(data, candidates, fallback)
+    first_start = min(data['starts'], default=len(data['locations']))
+    locations = {node: location for node, location in data['locations'].items() if node < first_start}
+    starts = []
+    starts_definition = []
+    for position in kept:
+        starts.append(len(locations))
+        starts_definition.append(data['starts_definition'][position])
+        locations[len(locations)] = data['locations'][data['starts'][position]]
+
+    kept_units = set(starts_definition)
+    pruned = {
+        unit: data['locations'][node]
+        for unit, node in zip(data['starts_definition'], data['starts']) if unit not in kept_units
+    }
+    report = (
+        f"Pruned {len(pruned)} of {data['num_vehicles']} vehicles and {len(pruned)} of "
+        f"{len(data['locations'])} nodes, {unreachable_pickups} pickups can't be reached by any vehicle\n\n"
+    )
+    print(report)
+
+    return dict(
+        data,
+        locations=locations,
+        starts=starts,
+        starts_definition=starts_definition,
+        demands=data['demands'][:first_start] + [0 for _ in starts],
+        ends=[0 for _ in starts],
+        num_vehicles=len(starts),
+        pruned_units=pruned,
+        pruning_report=report,
+    )
+
+
+def get_pruned_free_units(data):
+    "Free units entries of the vehicles removed by prune_vehicles, unchanged from the start of the day."
+    return {
+        unit: {
+            'time': data['date'] + datetime.timedelta(minutes=int(location['minutes'])),
+            'location': location['id'],
+        }
+        for unit, location in data.get('pruned_units', {}).items()
+    }
+
+
+def get_time_windows(data, transit_matrix):
+    """
+    Earliest and latest time of every node as set on the time dimension by optimize. A delivery
+    can't be reached before its pickup opens plus the trip, so that bound is used for deliveries.
+    """
+    size = len(data['locations'])
+    earliest = np.zeros(size, dtype=np.int64)
+    latest = np.full(size, np.iinfo(np.int64).max // 2, dtype=np.int64)
+    kinds = np.zeros(size, dtype=np.int8)
+    for node, location in data['locations'].items():
+        if location.get('type') == 'PICKUP':
+            kinds[node] = 1
+            earliest[node] = location['minutes']
+            latest[node] = 1440 + location['day_delta'] * 1440
+        elif location.get('type') == 'START':
+            kinds[node] = 3
+            earliest[node] = location['minutes']
+            latest[node] = location['end_range']
+
+    for pickup, delivery in data['pickups_deliveries']:
+        kinds[delivery] = 2
+        earliest[delivery] = max(
+            data['locations'][delivery]['minutes_start'], earliest[pickup] + transit_matrix[pickup, delivery])
+        latest[delivery] = 9999999
+    return earliest, latest, kinds
+
+
+def get_infeasible_arcs(data, transit_matrix):
+    """
+    Mask of the arcs between nodes that no solution can use. With a capacity of 1 a pickup can
+    only be followed by its own delivery, a delivery can't follow a start or another delivery and
+    can't go back to its own pickup, and no node can be left at its earliest time and reach a
+    pickup after the pickup window closes. Arcs from and to the depot are always kept.
+    """
+    earliest, latest, kinds = get_time_windows(data, transit_matrix)
+    nodes = np.arange(len(kinds))
+    from_nodes = nodes[:, None]
+    to_nodes = nodes[None, :]
+
+    infeasible = earliest[:, None] + transit_matrix > latest[None, :]
+    infeasible |= (kinds[:, None] == 1) & (to_nodes != from_nodes + 1)
+    infeasible |= (kinds[:, None] != 1) & (kinds[None, :] == 2)
+    infeasible |= (kinds[:, None] == 2) & (to_nodes == from_nodes - 1)
+    infeasible &= (kinds[:, None] != 0) & np.isin(kinds, (1, 2))[None, :]
+    infeasible[nodes, nodes] = False
+    return infeasible
+
+
+def remove_infeasible_arcs(data, manager, routing, transit_matrix):
+    """
+    Remove the infeasible arcs from the NextVar domains before the solve. Returns the amount of
+    removed arcs and of arcs from any node to a pickup or delivery.
+    """
+    infeasible = get_infeasible_arcs(data, transit_matrix)
+    for node in np.nonzero(infeasible.any(axis=1))[0].tolist():
+        routing.NextVar(manager.NodeToIndex(node)).RemoveValues(
+            [manager.NodeToIndex(to_node) for to_node in np.nonzero(infeasible[node])[0].tolist()])
+
+    stops = 2 * len(data['pickups_deliveries'])
+    return int(infeasible.sum()), (len(data['locations']) - 1) * stops - stops
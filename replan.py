@@ -0,0 +1,151 @@
+from itertools import takewhile
+
+import numpy as np
+
+from decomposition import build_sub_data, get_travel_times, get_vehicle_states
+from fleet_state import index_vehicle_states
+
+# Minutes between a re-plan and the earliest pickup of a trip that can be added by it.
+REPLAN_NOTICE = 240
+# Share of the trips after the notice that are held back from the initial plan of a simulated
+# re-plan, so the re-plan has new trips to add.
+REPLAN_NEW_SHARE = 0.2
+
+
+def get_known_data(data, cutoff, notice=REPLAN_NOTICE, new_share=REPLAN_NEW_SHARE):
+    """
+    Data model of the day without the trips that are only known at the cutoff, for simulating a
+    re-plan. Every 1 / new_share trip by start time with a pickup at least notice minutes after the
+    cutoff is left out. Returns the data model and the trip ids left out.
+    """
+    late = [
+        pickup for pickup, _ in sorted(data['pickups_deliveries'], key=lambda pair: data['locations'][pair[0]]['minutes'])
+        if data['locations'][pickup]['minutes'] >= cutoff + notice
+    ]
+    new_pickups = set(late[::max(int(round(1 / new_share)), 1)]) if new_share else set()
+    known = build_sub_data(
+        data, [pickup for pickup, _ in data['pickups_deliveries'] if pickup not in new_pickups],
+        data['starts_definition'], get_vehicle_states(data))
+    return known, {data['locations'][pickup]['viaje_id'] for pickup in new_pickups}
+
+
+def get_frozen_trips(plan, cutoff):
+    """
+    Trips of every unit that start before the cutoff, taken from the schedule of the plan in route
+    order. Those trips are already under way and are kept as the fixed prefix of the routes.
+    """
+    return {
+        unit: list(takewhile(lambda trip: trip[1] < cutoff, schedule))
+        for unit, schedule in plan.get('schedule', {}).items()
+    }
+
+
+def get_replan_states(data, frozen, cutoff):
+    """
+    Location and availability of every unit at the cutoff. A unit with frozen trips is free where
+    and when its last frozen trip is delivered, no unit is free before the cutoff.
+    """
+    vehicle_states = get_vehicle_states(data)
+    delivery_ids = {
+        location['viaje_id']: location['id'] for location in data['locations'].values()
+        if location.get('type') == 'DELIVERY'
+    }
+    for unit, state in vehicle_states.items():
+        if frozen.get(unit):
+            trip_id, _, delivery_minute = frozen[unit][-1]
+            state['id'] = delivery_ids[trip_id]
+            state['minutes'] = max(int(delivery_minute), cutoff)
+        else:
+            state['minutes'] = max(int(state['minutes']), cutoff)
+    return vehicle_states
+
+
+def assign_new_trips(data, pickup_nodes, vehicle_states, warm_start_routes):
+    """
+    Add the trips the plan doesn't know to the warm start routes, each to a unit without trips left
+    in the plan. A unit already waiting at the pickup takes it, earliest free first, otherwise the
+    one that reaches the pickup earliest. Trips that no such unit reaches before the pickup closes
+    are left to the unit that originally made them.
+    """
+    idle_units = [unit for unit in vehicle_states if not warm_start_routes.get(unit)]
+    locations = np.array([vehicle_states[unit]['id'] for unit in idle_units], dtype=np.int64)
+    minutes = np.array([vehicle_states[unit]['minutes'] for unit in idle_units], dtype=np.int64)
+    taken = np.zeros(len(idle_units), dtype=bool)
+    state = index_vehicle_states(idle_units, vehicle_states)
+
+    for pickup in sorted(pickup_nodes, key=lambda node: data['locations'][node]['minutes']):
+        location = data['locations'][pickup]
+        waiting = [
+            state.positions[unit] for unit in state.free_at_location(location['id'], location['minutes']).tolist()
+            if not taken[state.positions[unit]]
+        ]
+        if waiting:
+            taken[waiting[0]] = True
+            warm_start_routes[idle_units[waiting[0]]] = [location['viaje_id']]
+            continue
+        arrival = minutes + get_travel_times(data['distances'], locations, [location['id']])[:, 0]
+        arrival[taken | (arrival > 1440 + location['day_delta'] * 1440)] = np.iinfo(np.int64).max
+        if not len(arrival) or taken.all() or arrival.min() == np.iinfo(np.int64).max:
+            continue
+        idx = int(np.argmin(arrival))
+        taken[idx] = True
+        warm_start_routes[idle_units[idx]] = [location['viaje_id']]
+
+
+def build_replan_data(data, plan, cutoff):
+    """
+    Data model of the re-plan of a day at the cutoff: every trip of the day that is not frozen in
+    the plan, including trips the plan doesn't know, with every unit starting from its state at the
+    cutoff. Pickups and deliveries can't start before the cutoff. The plan routes without the frozen
+    trips, with the new trips given to idle units, are set as the warm start. Returns the data
+    model, the frozen trips and the unit states.
+    """
+    frozen = get_frozen_trips(plan, cutoff)
+    frozen_ids = {trip[0] for trips in frozen.values() for trip in trips}
+    planned_ids = {trip_id for trip_ids in plan.get('routes', {}).values() for trip_id in trip_ids}
+    vehicle_states = get_replan_states(data, frozen, cutoff)
+
+    locations = dict(data['locations'])
+    remaining = []
+    for pickup, delivery in data['pickups_deliveries']:
+        if locations[pickup]['viaje_id'] in frozen_ids:
+            continue
+        locations[pickup] = dict(locations[pickup], minutes=max(locations[pickup]['minutes'], cutoff))
+        locations[delivery] = dict(locations[delivery], minutes_start=max(locations[delivery]['minutes_start'], cutoff))
+        remaining.append(pickup)
+
+    replan_data = build_sub_data(dict(data, locations=locations), remaining, data['starts_definition'], vehicle_states)
+    replan_data['warm_start_routes'] = {
+        unit: [trip_id for trip_id in trip_ids if trip_id not in frozen_ids]
+        for unit, trip_ids in plan.get('routes', {}).items()
+    }
+    assign_new_trips(
+        replan_data, [node for node, location in replan_data['locations'].items()
+                      if location.get('type') == 'PICKUP' and location['viaje_id'] not in planned_ids],
+        vehicle_states, replan_data['warm_start_routes'])
+    return replan_data, frozen, vehicle_states
+
+
+def get_frozen_result(plan, frozen):
+    """
+    Part of the plan that is kept as it is: the legs of every unit up to the delivery of its last
+    frozen trip, with their routes and schedule, like the result of a solved cluster.
+    """
+    unit_trips = {}
+    for trip in plan['trips'].values():
+        unit_trips.setdefault(trip['unidad'], []).append(trip)
+
+    trips = {}
+    for unit, frozen_trips in frozen.items():
+        loaded = 0
+        for trip in unit_trips.get(unit, []):
+            if loaded == len(frozen_trips):
+                break
+            trips[len(trips)] = trip
+            loaded += trip['carga']
+
+    return {
+        'trips': trips,
+        'routes': {unit: [trip[0] for trip in frozen_trips] for unit, frozen_trips in frozen.items() if frozen_trips},
+        'schedule': {unit: frozen_trips for unit, frozen_trips in frozen.items() if frozen_trips},
+    }
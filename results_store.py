@@ -0,0 +1,131 @@
+import csv
+import datetime
+import glob
+import os
+import sys
+
+import numpy as np
+
+from location_registry import get_location_registry
+from trips_cache import datetime_to_minutes
+
+RESULTS_DIR = "optimizer_results/results"
+# Columns of a results chunk and their types. Times are minutes since the epoch like in the trips
+# cache, the unit type is kept once per chunk.
+RESULT_COLUMNS = {
+    'origin_id': np.int32,
+    'dest_id': np.int32,
+    'origin_lat': np.float32,
+    'origin_long': np.float32,
+    'dest_lat': np.float32,
+    'dest_long': np.float32,
+    'unidad': np.int32,
+    'real_start': np.int64,
+    'real_end': np.int64,
+    'calculated_minutes': np.float32,
+    'calculated_kms': np.float32,
+    'carga': np.uint8,
+}
+
+
+def result_columns(trips, distances):
+    """
+    Typed columns of the trips of a solution, the rows result.csv gets from save_routes. Trips
+    from a location to itself are skipped the same way.
+    """
+    trips = [trip for trip in trips.values() if trip['origen'] != trip['destino']]
+    origins = np.array([trip['origen'] for trip in trips], dtype=np.int64)
+    destinations = np.array([trip['destino'] for trip in trips], dtype=np.int64)
+    origin_lats, origin_longs = get_location_registry().coordinates(origins)
+    dest_lats, dest_longs = get_location_registry().coordinates(destinations)
+    columns = {
+        'origin_id': origins,
+        'dest_id': destinations,
+        'origin_lat': origin_lats,
+        'origin_long': origin_longs,
+        'dest_lat': dest_lats,
+        'dest_long': dest_longs,
+        'unidad': [trip['unidad'] for trip in trips],
+        'real_start': np.array([trip['inicio_datetime'] for trip in trips], dtype='datetime64[m]'),
+        'real_end': np.array([trip['fin_datetime'] for trip in trips], dtype='datetime64[m]'),
+        'calculated_minutes': distances.times(origins, destinations) if len(trips) else (),
+        'calculated_kms': distances.kms(origins, destinations) if len(trips) else (),
+        'carga': [1 if trip.get('carga') else 0 for trip in trips],
+    }
+    columns['real_start'] = columns['real_start'].astype(np.int64)
+    columns['real_end'] = columns['real_end'].astype(np.int64)
+    return {column: np.asarray(values, dtype=RESULT_COLUMNS[column]) for column, values in columns.items()}
+
+
+def chunk_file(key, date, path=RESULTS_DIR):
+    return os.path.join(path, f"results_{key}_{date:%Y-%m-%d}.npz")
+
+
+def save_results_chunk(columns, key, date, path=RESULTS_DIR):
+    """
+    Write the result columns of a unit type and day as a compressed chunk. A day solved again
+    replaces its chunk instead of adding rows to it.
+    """
+    os.makedirs(path, exist_ok=True)
+    filename = chunk_file(key, date, path)
+    with open(f"{filename}.tmp", "wb") as f:
+        np.savez_compressed(f, tipo_unidad=np.array(key), **columns)
+    os.replace(f"{filename}.tmp", filename)
+
+
+def load_results(path=RESULTS_DIR, key=None, start=None, end=None):
+    """
+    Result columns of the chunks of the unit type (every type when key is None) and days from start
+    to end, concatenated in day order. The unit type of every row is an index into 'unit_types'
+    and 'real_minutes' is taken from the start and end times.
+    """
+    chunks = []
+    for filename in sorted(glob.glob(os.path.join(path, f"results_{key or '*'}_*.npz"))):
+        date = datetime.datetime.strptime(filename[-len("YYYY-MM-DD.npz"):-len(".npz")], "%Y-%m-%d")
+        if (start is None or date >= start) and (end is None or date < end):
+            with np.load(filename) as chunk:
+                chunks.append({name: chunk[name] for name in chunk.files})
+
+    unit_types = sorted({str(chunk['tipo_unidad']) for chunk in chunks})
+    results = {
+        column: np.concatenate([chunk[column] for chunk in chunks]) if chunks else np.zeros(0, dtype=dtype)
+        for column, dtype in RESULT_COLUMNS.items()
+    }
+    results['tipo_unidad'] = np.concatenate([
+        np.full(len(chunk['carga']), unit_types.index(str(chunk['tipo_unidad'])), dtype=np.int16)
+        for chunk in chunks
+    ]) if chunks else np.zeros(0, dtype=np.int16)
+    results['unit_types'] = unit_types
+    results['real_minutes'] = results['real_end'] - results['real_start']
+    return results
+
+
+def convert_results_csv(filename, path=RESULTS_DIR):
+    """
+    Write the rows of a result.csv of an earlier run as chunks, one per unit type and day of the
+    start time. The strings are parsed only once, here.
+    """
+    with open(filename, "r", encoding="ISO-8859-1") as f:
+        rows = list(csv.DictReader(f))
+
+    chunks = {}
+    for row in rows:
+        start = datetime.datetime.strptime(row['real_start'], "%Y-%m-%d %H:%M:%S")
+        chunks.setdefault((row['tipo_unidad'], start.date()), []).append(row)
+
+    for (key, date), chunk_rows in chunks.items():
+        columns = {
+            column: np.array([
+                datetime_to_minutes(datetime.datetime.strptime(row[column], "%Y-%m-%d %H:%M:%S"))
+                if column in ('real_start', 'real_end') else float(row[column] or 'nan')
+                for row in chunk_rows
+            ]).astype(dtype)
+            for column, dtype in RESULT_COLUMNS.items()
+        }
+        save_results_chunk(columns, key, date, path)
+    return len(rows), len(chunks)
+
+
+if __name__ == '__main__':
+    rows, chunks = convert_results_csv(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else RESULTS_DIR)
+    print(f"Wrote {rows} rows in {chunks} chunks")
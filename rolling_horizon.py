@@ -0,0 +1,61 @@
+from decomposition import get_vehicle_states
+from replan import assign_new_trips, get_frozen_result, get_frozen_trips, get_replan_states
+
+
+def get_route_prefix(data, vehicle_state, pickup_nodes):
+    """
+    Longest prefix of a route the unit can make from its START with every pickup before its window
+    closes, going at the earliest time to every location.
+    """
+    location_id, minute = vehicle_state['id'], vehicle_state['minutes']
+    for position, pickup in enumerate(pickup_nodes):
+        pickup_location, delivery_location = data['locations'][pickup], data['locations'][pickup + 1]
+        if location_id != pickup_location['id']:
+            minute += data['distances'].time(location_id, pickup_location['id'])
+        minute = max(minute, pickup_location['minutes'])
+        if minute > 1440 + pickup_location['day_delta'] * 1440:
+            return pickup_nodes[:position]
+        if pickup_location['id'] != delivery_location['id']:
+            minute += data['distances'].time(pickup_location['id'], delivery_location['id'])
+        location_id, minute = delivery_location['id'], max(minute, delivery_location['minutes_start'])
+    return pickup_nodes
+
+
+def get_window_warm_start(data, previous_routes):
+    """
+    Warm start routes of a window: the routes the previous window left for the trips that were not
+    committed, cut where a unit no longer makes a pickup in time from where it starts the window.
+    The trips of the day that just entered the window and the ones that were cut are given to idle
+    units. Returns the routes and the amount of trips carried over from the previous window.
+    """
+    pickup_nodes = {
+        location['viaje_id']: node for node, location in data['locations'].items()
+        if location.get('type') == 'PICKUP'
+    }
+    vehicle_states = get_vehicle_states(data)
+    routes = {}
+    for unit, trip_ids in previous_routes.items():
+        if unit in vehicle_states:
+            route = get_route_prefix(
+                data, vehicle_states[unit], [pickup_nodes[trip_id] for trip_id in trip_ids if trip_id in pickup_nodes])
+            routes[unit] = [data['locations'][node]['viaje_id'] for node in route]
+
+    carried = {trip_id for trip_ids in routes.values() for trip_id in trip_ids}
+    assign_new_trips(
+        data, [node for trip_id, node in pickup_nodes.items() if trip_id not in carried], vehicle_states, routes)
+    return routes, len(carried)
+
+
+def commit_first_day(data, result):
+    """
+    Split the solution of a window in the trips of its first day, which are committed, and the
+    routes of the rest of the window. Returns the committed part like the result of a solved
+    cluster, the unit states after it and the routes left for the next window.
+    """
+    committed = get_frozen_trips(result, 1440)
+    committed_ids = {trip[0] for trips in committed.values() for trip in trips}
+    remaining_routes = {
+        unit: [trip_id for trip_id in trip_ids if trip_id not in committed_ids]
+        for unit, trip_ids in result['routes'].items()
+    }
+    return get_frozen_result(result, committed), get_replan_states(data, committed, 0), remaining_routes
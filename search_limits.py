@@ -0,0 +1,61 @@
+from time import time
+
+# Seconds without a relative improvement of the objective of at least CONVERGENCE_IMPROVEMENT
+# after which an adaptive search stops.
+CONVERGENCE_WINDOW = 30
+CONVERGENCE_IMPROVEMENT = 0.001
+# Minimum and maximum search time of an adaptive search, base seconds plus seconds per node.
+FLOOR_SECONDS = (5, 0.02)
+CEILING_SECONDS = (60, 0.5)
+
+
+def get_time_bounds(nodes):
+    "Floor and ceiling in seconds of an adaptive search over a model with that amount of nodes."
+    floor = FLOOR_SECONDS[0] + FLOOR_SECONDS[1] * nodes
+    ceiling = CEILING_SECONDS[0] + CEILING_SECONDS[1] * nodes
+    return int(floor), int(max(floor, ceiling))
+
+
+class ConvergenceMonitor:
+    """
+    Stops the routing search once the objective stopped improving. on_solution is registered as an
+    at solution callback and should_stop as a custom limit of the solver, which polls it during the
+    search. The search never stops before the floor, stops after the window without an improvement
+    bigger than min_improvement and always stops at the ceiling. Improvements are measured against
+    the objective of the last improvement that counted, so small ones add up.
+    """
+
+    def __init__(self, routing, nodes, window=CONVERGENCE_WINDOW, min_improvement=CONVERGENCE_IMPROVEMENT):
+        self.routing = routing
+        self.floor, self.ceiling = get_time_bounds(nodes)
+        self.window = window
+        self.min_improvement = min_improvement
+        self.start_time = time()
+        self.last_improvement = self.start_time
+        self.best = None
+        self.reference = None
+        self.stop_reason = None
+
+    def start(self):
+        self.start_time = time()
+        self.last_improvement = self.start_time
+
+    def on_solution(self):
+        objective = self.routing.CostVar().Max()
+        if self.reference is None or objective < self.reference * (1 - self.min_improvement):
+            self.reference = objective
+            self.last_improvement = time()
+        if self.best is None or objective < self.best:
+            self.best = objective
+
+    def should_stop(self):
+        now = time()
+        if now - self.start_time >= self.ceiling:
+            self.stop_reason = f"ceiling of {self.ceiling} seconds reached"
+        elif (self.best is not None and now - self.start_time >= self.floor
+              and now - self.last_improvement >= self.window):
+            self.stop_reason = (
+                f"converged, less than {self.min_improvement * 100}% improvement in the last "
+                f"{self.window} seconds"
+            )
+        return self.stop_reason is not None
@@ -0,0 +1,77 @@
+import re
+
+import numpy as np
+
+# Coordinates the OSRM table service accepts per request, the --max-table-size of osrm-routed.
+MAX_TABLE_COORDINATES = 100
+
+
+def tile_size(max_coordinates=MAX_TABLE_COORDINATES):
+    "Side of the square tiles, the sources and destinations of a tile share the coordinate limit."
+    return max(max_coordinates // 2, 1)
+
+
+def plan_tiles(count, size, missing_block=None, worker=0, workers=1):
+    """
+    Cover the upper triangle of count sorted locations with size x size tiles: block i of the
+    sources with every block j >= i of the destinations. missing_block(sources, destinations), when
+    given, returns the mask of the pairs of a tile that are still missing; rows and columns without
+    missing pairs are trimmed and tiles without any are skipped. Yields the source and destination
+    indices of the tiles of one of the workers.
+    """
+    blocks = [np.arange(first, min(first + size, count), dtype=np.int64) for first in range(0, count, size)]
+    tile = -1
+    for first, sources in enumerate(blocks):
+        for destinations in blocks[first:]:
+            tile += 1
+            if tile % workers != worker:
+                continue
+            mask = destinations[None, :] > sources[:, None]
+            if missing_block is not None:
+                mask &= missing_block(sources, destinations)
+            if not mask.any():
+                continue
+            yield sources[mask.any(axis=1)], destinations[mask.any(axis=0)]
+
+
+def tile_coordinates(sources, destinations):
+    """
+    Locations of the tile request and the positions of the sources and destinations among them. A
+    location that is both a source and a destination is sent once.
+    """
+    locations = list(dict.fromkeys(list(sources) + list(destinations)))
+    positions = {location: position for position, location in enumerate(locations)}
+    return locations, [positions[source] for source in sources], [positions[destination] for destination in destinations]
+
+
+def tile_url(url, sources, destinations, coordinates):
+    """
+    Table url of a tile. sources and destinations parameters already in the url template are
+    replaced, so the single row templates with sources=0 still work.
+    """
+    locations, source_positions, destination_positions = tile_coordinates(sources, destinations)
+    url = re.sub(r'([?&])(sources|destinations)=[^&]*&?', r'\1', url).rstrip('&?')
+    separator = '&' if '?' in url else '?'
+    return url.format(locations=';'.join(
+        f"{coordinates[location]['longitude']},{coordinates[location]['latitude']}" for location in locations
+    )) + (
+        f"{separator}sources={';'.join(map(str, source_positions))}"
+        f"&destinations={';'.join(map(str, destination_positions))}"
+    )
+
+
+def tile_rows(sources, destinations, distances, durations, mask):
+    """
+    (origin, destination, kilometers, minutes) rows of the masked pairs of a tile response, smaller
+    location first like distancias_mexico. Meters and seconds without a route are stored as 0.
+    """
+    sources = np.asarray(sources, dtype=np.int64)
+    destinations = np.asarray(destinations, dtype=np.int64)
+    kilometers = np.round(np.nan_to_num(np.array(distances, dtype=np.float64)) / 1000, 2)
+    minutes = np.nan_to_num(np.array(durations, dtype=np.float64)) // 60
+    rows, columns = np.nonzero(mask)
+    origins, ends = sources[rows], destinations[columns]
+    return list(zip(
+        np.minimum(origins, ends).tolist(), np.maximum(origins, ends).tolist(),
+        kilometers[rows, columns].tolist(), minutes[rows, columns].astype(np.int64).tolist(),
+    ))
@@ -0,0 +1,267 @@
+import csv
+import json
+import os
+import threading
+import traceback
+
+import numpy as np
+
+import database
+from distance_store import MISSING_MINUTES, open_distance_store
+from location_registry import get_location_registry
+
+CALIBRATION_FILE = "./csvs/travel_time_calibration.json"
+# Pairs filled with an estimate, to be calculated with OSRM by a later backfill.
+ESTIMATED_PAIRS_CSV = "./csvs/estimated_distances.csv"
+EARTH_RADIUS_KM = 6371
+# Straight line kilometers of the bands fitted separately, like the buckets of distance_analysis.
+DISTANCE_BANDS = (0, 50, 100, 500, 1000, np.inf)
+# Known pairs sampled to fit the bands and pairs a band needs to get its own factors.
+CALIBRATION_SAMPLES = 200000
+MIN_BAND_SAMPLES = 50
+# Road kilometers over straight line kilometers and minutes per road kilometer used when there
+# are no known pairs to fit.
+DEFAULT_CIRCUITY = 1.3
+DEFAULT_MINUTES_PER_KM = 1.0
+
+ESTIMATOR = None
+ESTIMATOR_LOCK = threading.Lock()
+# Pairs in the estimated pairs csv, so every pair is written to it once.
+ESTIMATED_PAIRS = None
+
+
+def haversine_km(latitudes_1, longitudes_1, latitudes_2, longitudes_2):
+    "Straight line kilometers between the points of the arrays."
+    latitudes_1, longitudes_1, latitudes_2, longitudes_2 = map(
+        np.radians, (latitudes_1, longitudes_1, latitudes_2, longitudes_2))
+    a = (
+        np.sin((latitudes_2 - latitudes_1) / 2) ** 2
+        + np.cos(latitudes_1) * np.cos(latitudes_2) * np.sin((longitudes_2 - longitudes_1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+class TravelTimeEstimator:
+    """
+    Road kilometers and minutes between coordinates estimated from the straight line distance. Every
+    distance band has a circuity (road over straight line kilometers) and a pace (minutes per road
+    kilometer) fitted as the median over known pairs of the band, so a few detours don't skew it.
+    """
+
+    def __init__(self, circuity=None, minutes_per_km=None, bands=DISTANCE_BANDS, samples=None):
+        self.bands = np.asarray(bands, dtype=np.float64)
+        size = len(self.bands) - 1
+        self.circuity = np.full(size, DEFAULT_CIRCUITY) if circuity is None else np.asarray(circuity, dtype=np.float64)
+        self.minutes_per_km = (
+            np.full(size, DEFAULT_MINUTES_PER_KM) if minutes_per_km is None
+            else np.asarray(minutes_per_km, dtype=np.float64)
+        )
+        self.samples = [0] * size if samples is None else list(samples)
+
+    def band(self, straight_km):
+        return np.clip(np.searchsorted(self.bands, straight_km, side='right') - 1, 0, len(self.circuity) - 1)
+
+    def estimate_km(self, straight_km):
+        "Road kilometers and minutes for straight line kilometers."
+        straight_km = np.asarray(straight_km, dtype=np.float64)
+        band = self.band(straight_km)
+        kilometers = straight_km * self.circuity[band]
+        return kilometers, kilometers * self.minutes_per_km[band]
+
+    def estimate(self, latitudes_1, longitudes_1, latitudes_2, longitudes_2):
+        "Road kilometers and minutes between the points of the arrays, nan without coordinates."
+        return self.estimate_km(haversine_km(latitudes_1, longitudes_1, latitudes_2, longitudes_2))
+
+    def estimate_pairs(self, origins, destinations, registry=None):
+        "Road kilometers and minutes between location ids, nan for locations without coordinates."
+        registry = registry or get_location_registry()
+        return self.estimate(*registry.coordinates(origins), *registry.coordinates(destinations))
+
+    @classmethod
+    def fit(cls, straight_km, road_km, minutes, bands=DISTANCE_BANDS, min_samples=MIN_BAND_SAMPLES):
+        """
+        Fit the factors of every band from known pairs. Pairs at the same point or without a road
+        distance or time are skipped and bands with fewer than min_samples pairs use the factors of
+        all the pairs.
+        """
+        straight_km = np.asarray(straight_km, dtype=np.float64)
+        road_km = np.asarray(road_km, dtype=np.float64)
+        minutes = np.asarray(minutes, dtype=np.float64)
+        valid = (straight_km > 1) & (road_km >= straight_km) & (minutes > 0) & np.isfinite(road_km)
+        circuity_values = road_km[valid] / straight_km[valid]
+        pace_values = minutes[valid] / road_km[valid]
+
+        estimator = cls(bands=bands)
+        if valid.sum() < min_samples:
+            return estimator
+
+        overall = (np.median(circuity_values), np.median(pace_values))
+        band = estimator.band(straight_km[valid])
+        for idx in range(len(estimator.circuity)):
+            in_band = band == idx
+            estimator.samples[idx] = int(in_band.sum())
+            if in_band.sum() >= min_samples:
+                estimator.circuity[idx] = np.median(circuity_values[in_band])
+                estimator.minutes_per_km[idx] = np.median(pace_values[in_band])
+            else:
+                estimator.circuity[idx], estimator.minutes_per_km[idx] = overall
+        return estimator
+
+    def to_dict(self):
+        return {
+            'bands': [float(edge) if np.isfinite(edge) else None for edge in self.bands],
+            'circuity': self.circuity.round(4).tolist(),
+            'minutes_per_km': self.minutes_per_km.round(4).tolist(),
+            'samples': self.samples,
+        }
+
+    @classmethod
+    def from_dict(cls, values):
+        bands = [np.inf if edge is None else edge for edge in values['bands']]
+        return cls(values['circuity'], values['minutes_per_km'], bands, values.get('samples'))
+
+    def report(self):
+        lines = []
+        for idx, (circuity, pace) in enumerate(zip(self.circuity, self.minutes_per_km)):
+            lines.append(
+                f"{self.bands[idx]:g}-{self.bands[idx + 1]:g} km: circuity {round(circuity, 3)}, "
+                f"{round(pace, 3)} minutes per km, {self.samples[idx]} pairs")
+        return '\n'.join(lines)
+
+
+def store_offset_pairs(offsets):
+    "Index pairs (larger, smaller) of offsets of the triangular distance store."
+    offsets = np.asarray(offsets, dtype=np.int64)
+    upper = ((1 + np.sqrt(1 + 8 * offsets.astype(np.float64))) // 2).astype(np.int64)
+    # Correct the rounding of the square root on large offsets.
+    upper -= upper * (upper - 1) // 2 > offsets
+    upper += (upper + 1) * upper // 2 <= offsets
+    return upper, offsets - upper * (upper - 1) // 2
+
+
+def sample_store_pairs(store, samples=CALIBRATION_SAMPLES, seed=0):
+    "Location ids, minutes and kilometers of random known pairs of the distance store."
+    size = len(store.minutes)
+    if not size:
+        return (np.zeros(0, dtype=np.int64), ) * 2 + (np.zeros(0), ) * 2
+    offsets = np.unique(np.random.default_rng(seed).integers(0, size, min(samples, size)))
+    minutes = np.asarray(store.minutes[offsets])
+    known = minutes != MISSING_MINUTES
+    offsets = offsets[known]
+    upper, lower = store_offset_pairs(offsets)
+    return store.ids[upper].astype(np.int64), store.ids[lower].astype(np.int64), minutes[known], np.asarray(store.km[offsets])
+
+
+def sample_database_pairs(samples=CALIBRATION_SAMPLES):
+    "Location ids, minutes and kilometers of random pairs of distancias_mexico."
+    with database.cursor() as cursor:
+        cursor.execute(
+            """SELECT ubicacion_id_origen, ubicacion_id_destino, tiempo, distancia
+            FROM distancias_mexico TABLESAMPLE SYSTEM (1) LIMIT %s;""",
+            (samples, ))
+        rows = cursor.fetchall()
+    if not rows:
+        return (np.zeros(0, dtype=np.int64), ) * 2 + (np.zeros(0), ) * 2
+    origins, destinations, minutes, kilometers = zip(*rows)
+    return (np.asarray(origins, dtype=np.int64), np.asarray(destinations, dtype=np.int64),
+            np.asarray(minutes, dtype=np.float64), np.asarray(kilometers, dtype=np.float64))
+
+
+def calibrate(samples=CALIBRATION_SAMPLES, registry=None):
+    "Fit an estimator on known pairs of the distance store, or of the database when it wasn't built."
+    registry = registry or get_location_registry()
+    store = open_distance_store()
+    if store is not None:
+        origins, destinations, minutes, kilometers = sample_store_pairs(store, samples)
+    else:
+        origins, destinations, minutes, kilometers = sample_database_pairs(samples)
+
+    straight_km = haversine_km(*registry.coordinates(origins), *registry.coordinates(destinations))
+    return TravelTimeEstimator.fit(straight_km, kilometers, minutes)
+
+
+def save_calibration(estimator, filename=CALIBRATION_FILE):
+    with open(filename, "w") as f:
+        json.dump(estimator.to_dict(), f, indent=2)
+
+
+def get_estimator(filename=CALIBRATION_FILE):
+    """
+    Load the estimator once per process from the calibration file, fitting and saving it when the
+    file doesn't exist. Falls back to the default factors when there are no known pairs to fit.
+    """
+    global ESTIMATOR
+    with ESTIMATOR_LOCK:
+        if ESTIMATOR is None:
+            if os.path.isfile(filename):
+                with open(filename, "r") as f:
+                    ESTIMATOR = TravelTimeEstimator.from_dict(json.load(f))
+            else:
+                try:
+                    ESTIMATOR = calibrate()
+                    if sum(ESTIMATOR.samples):
+                        save_calibration(ESTIMATOR, filename)
+                except Exception:
+                    traceback.print_exc()
+                    print("Using the default travel time factors")
+                    ESTIMATOR = TravelTimeEstimator()
+    return ESTIMATOR
+
+
+def save_estimated_pairs(origins, destinations, minutes, kilometers, filename=ESTIMATED_PAIRS_CSV):
+    """
+    Append the estimated pairs to the estimated pairs csv, smaller id first like distancias_mexico.
+    Pairs that are already in the csv are skipped, the pairs in it are read once per process.
+    """
+    global ESTIMATED_PAIRS
+    if ESTIMATED_PAIRS is None:
+        ESTIMATED_PAIRS = read_estimated_pairs(filename)
+    rows = []
+    for row in zip(
+            np.minimum(origins, destinations).tolist(), np.maximum(origins, destinations).tolist(),
+            np.round(minutes).astype(np.int64).tolist(), np.round(kilometers, 2).tolist()):
+        if row[:2] not in ESTIMATED_PAIRS:
+            ESTIMATED_PAIRS.add(row[:2])
+            rows.append(row)
+    if not rows:
+        return
+    write_header = not os.path.isfile(filename)
+    with open(filename, 'a', newline='') as output_file:
+        writer = csv.writer(output_file)
+        if write_header:
+            writer.writerow(['origin', 'destination', 'minutes', 'km'])
+        writer.writerows(rows)
+
+
+def read_estimated_pairs(filename=ESTIMATED_PAIRS_CSV):
+    "Unique (origin, destination) pairs of the estimated pairs csv."
+    if not os.path.isfile(filename):
+        return set()
+    with open(filename, 'r') as f:
+        return {(int(row['origin']), int(row['destination'])) for row in csv.DictReader(f)}
+
+
+if __name__ == '__main__':
+    registry = get_location_registry()
+    store = open_distance_store()
+    if store is not None:
+        origins, destinations, minutes, kilometers = sample_store_pairs(store, 2 * CALIBRATION_SAMPLES)
+    else:
+        origins, destinations, minutes, kilometers = sample_database_pairs(2 * CALIBRATION_SAMPLES)
+    straight_km = haversine_km(*registry.coordinates(origins), *registry.coordinates(destinations))
+
+    # Fit on half of the pairs and report the error on the other half.
+    fit = np.arange(len(origins)) % 2 == 0
+    estimator = TravelTimeEstimator.fit(straight_km[fit], kilometers[fit], minutes[fit])
+    estimated_km, estimated_minutes = estimator.estimate_km(straight_km[~fit])
+    checked = (minutes[~fit] > 0) & np.isfinite(estimated_minutes)
+    error = np.abs(estimated_minutes[checked] - minutes[~fit][checked]) / minutes[~fit][checked]
+
+    print(estimator.report())
+    if checked.any():
+        print(f"\nMedian relative error of the minutes on {int(checked.sum())} held out pairs: "
+              f"{round(float(np.median(error)) * 100, 2)}%")
+
+    estimator = TravelTimeEstimator.fit(straight_km, kilometers, minutes)
+    save_calibration(estimator)
+    print(f"\nSaved the calibration in {CALIBRATION_FILE}")
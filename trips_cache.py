@@ -0,0 +1,248 @@
+import csv
+import datetime
+import hashlib
+import json
+import os
+import re
+
+import numpy as np
+
+TRIPS_CSV = "./csvs/mexico.csv"
+CACHE_DIR = "./csvs/.mexico_cache"
+HOUR_REGEX = r"\d{1,2}:\d{1,2}:\d{1,2}\s[ap].m."
+EPOCH = datetime.datetime(1970, 1, 1)
+INVALID_MINUTES = -1
+CACHE_VERSION = 3
+
+COLUMNS = {
+    'viaje_id': np.int64,
+    'origen': np.int32,
+    'destino': np.int32,
+    'unidad': np.int32,
+    'tipo_unidad': np.int16,
+    'inicio': np.int64,
+    'fin': np.int64,
+}
+
+
+def datetime_to_minutes(value):
+    "Convert a datetime into minutes since the epoch."
+    delta = value - EPOCH
+    return delta.days * 24 * 60 + delta.seconds // 60
+
+
+def minutes_to_datetime(minutes):
+    "Convert minutes since the epoch back into a datetime."
+    return EPOCH + datetime.timedelta(minutes=int(minutes))
+
+
+def parse_hours(horas):
+    """
+    Parse an array of "h:mm:ss a.m." hours into minutes of the day. There are at most 1440 distinct
+    valid values, so every distinct string is parsed once and mapped back to the rows. Hours that
+    don't have a clear format are INVALID_MINUTES.
+    """
+    values, inverse = np.unique(np.asarray(horas, dtype=str), return_inverse=True)
+    minutes = np.full(len(values), INVALID_MINUTES, dtype=np.int64)
+    for idx, hora in enumerate(values):
+        if not re.fullmatch(HOUR_REGEX, hora):
+            continue
+        try:
+            hora = datetime.datetime.strptime(
+                hora.upper().replace(':', ' ').replace('.', ''), "%I %M %S %p")
+        except ValueError:
+            continue
+        minutes[idx] = hora.hour * 60 + hora.minute
+    return minutes[inverse.reshape(-1)]
+
+
+def parse_dates(fechas):
+    "Parse an array of YYYYMMDD date ids into minutes since the epoch, or INVALID_MINUTES."
+    values, inverse = np.unique(np.asarray(fechas, dtype=str), return_inverse=True)
+    minutes = np.full(len(values), INVALID_MINUTES, dtype=np.int64)
+    for idx, fecha in enumerate(values):
+        try:
+            value = datetime.datetime(
+                int(fecha[:4]), int(fecha[4:6]), int(fecha[6:]))
+        except ValueError:
+            continue
+        minutes[idx] = datetime_to_minutes(value)
+    return minutes[inverse.reshape(-1)]
+
+
+def parse_trip_datetimes(fechas, horas):
+    "Combine date ids and hours into minutes since the epoch, INVALID_MINUTES if either is invalid."
+    dates = parse_dates(fechas)
+    hours = parse_hours(horas)
+    return np.where((dates == INVALID_MINUTES) | (hours == INVALID_MINUTES),
+                    INVALID_MINUTES, dates + hours)
+
+
+def file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def build_trips_cache(source=TRIPS_CSV, cache_dir=CACHE_DIR):
+    """
+    Convert the trips csv into a columnar cache. Every column is stored as a .npy file so it can be
+    memory-mapped, and unit ids and unit types are integer-coded against the vocabularies saved
+    in meta.json.
+    """
+    with open(source, "r", encoding="ISO-8859-1") as f:
+        reader = csv.DictReader(f)
+        trip_list = list(reader)
+
+    trip_list = [
+        trip for trip in trip_list
+        if trip['TIEMPOINICIOREALID'] and trip['TIEMPOFINID'] and trip['HR_COMPLETO'] and trip['HF_COMPLETO']
+    ]
+
+    unidades = {}
+    tipos_unidad = {}
+    columns = {
+        'viaje_id': [int(trip['VIAJEID']) for trip in trip_list],
+        'origen': [int(trip['UBICACIONORIGENID']) for trip in trip_list],
+        'destino': [int(trip['UBICACIONDESTINOID']) for trip in trip_list],
+        'unidad': [unidades.setdefault(trip['UNIDADID'], len(unidades)) for trip in trip_list],
+        'tipo_unidad': [tipos_unidad.setdefault(trip['TIPOUNIDAD'], len(tipos_unidad)) for trip in trip_list],
+        'inicio': parse_trip_datetimes(
+            [trip['TIEMPOINICIOREALID'] for trip in trip_list],
+            [trip['HR_COMPLETO'] for trip in trip_list],
+        ),
+        'fin': parse_trip_datetimes(
+            [trip['TIEMPOFINID'] for trip in trip_list],
+            [trip['HF_COMPLETO'] for trip in trip_list],
+        ),
+    }
+
+    os.makedirs(cache_dir, exist_ok=True)
+    for name, dtype in COLUMNS.items():
+        columns[name] = np.array(columns[name], dtype=dtype)
+        np.save(os.path.join(cache_dir, f"{name}.npy"), columns[name])
+
+    # Rows sorted by unit type and then start time, used by TripIndex for range queries.
+    order = np.lexsort((columns['inicio'], columns['tipo_unidad']))
+    np.save(os.path.join(cache_dir, "order.npy"), order.astype(np.int32))
+
+    meta = {
+        'version': CACHE_VERSION,
+        'source_mtime': os.path.getmtime(source),
+        'source_hash': file_hash(source),
+        'rows': len(columns['viaje_id']),
+        'unidades': list(unidades),
+        'tipos_unidad': list(tipos_unidad),
+    }
+    write_meta(meta, cache_dir)
+    return meta
+
+
+def write_meta(meta, cache_dir=CACHE_DIR):
+    "Write meta.json atomically so a crash never leaves a half written header."
+    path = os.path.join(cache_dir, "meta.json")
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(meta, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def read_meta(cache_dir=CACHE_DIR):
+    try:
+        with open(os.path.join(cache_dir, "meta.json"), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def ensure_trips_cache(source=TRIPS_CSV, cache_dir=CACHE_DIR):
+    """
+    Return the cache metadata, rebuilding the cache only when the source csv changed. The mtime is
+    checked first and the hash only when the mtime moved, so a touched but unchanged file doesn't
+    trigger a rebuild.
+    """
+    meta = read_meta(cache_dir)
+    if meta is None or meta.get('version') != CACHE_VERSION:
+        return build_trips_cache(source, cache_dir)
+
+    mtime = os.path.getmtime(source)
+    if meta['source_mtime'] == mtime:
+        return meta
+
+    if meta['source_hash'] != file_hash(source):
+        return build_trips_cache(source, cache_dir)
+
+    meta['source_mtime'] = mtime
+    write_meta(meta, cache_dir)
+    return meta
+
+
+def load_trips_cache(source=TRIPS_CSV, cache_dir=CACHE_DIR):
+    """
+    Load the trips cache as memory-mapped columns. The returned dictionary looks something like this:
+        {
+            'viaje_id': array([...]),
+            'origen': array([...]),
+            ...
+            'unidades': ['44284', ...], # unidad code -> UNIDADID
+            'tipos_unidad': ['Thorton', ...], # tipo_unidad code -> TIPOUNIDAD
+        }
+    """
+    meta = ensure_trips_cache(source, cache_dir)
+
+    cache = {
+        name: np.load(os.path.join(cache_dir, f"{name}.npy"), mmap_mode='r')
+        for name in COLUMNS
+    }
+    cache['order'] = np.load(os.path.join(cache_dir, "order.npy"), mmap_mode='r')
+    cache['unidades'] = meta['unidades']
+    cache['tipos_unidad'] = meta['tipos_unidad']
+    return cache
+
+
+class TripIndex:
+    """
+    Index of the cached trips by unit type and start time. The rows of every unit type are a
+    contiguous block of the persisted order sorted by start time, so the trips of a day are found
+    with two binary searches instead of a scan over the whole table.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.order = cache['order']
+        self.starts = np.asarray(cache['inicio'])[self.order]
+
+        sorted_types = np.asarray(cache['tipo_unidad'])[self.order]
+        self.type_bounds = {}
+        for code, tipo_unidad in enumerate(cache['tipos_unidad']):
+            self.type_bounds[tipo_unidad] = (
+                int(np.searchsorted(sorted_types, code, 'left')),
+                int(np.searchsorted(sorted_types, code, 'right')),
+            )
+
+    def rows(self, tipo_unidad, start, end):
+        "Cache rows of one unit type starting in [start, end), both in minutes since the epoch."
+        lower, upper = self.type_bounds.get(tipo_unidad, (0, 0))
+        starts = self.starts[lower:upper]
+        first = lower + int(np.searchsorted(starts, start, 'left'))
+        last = lower + int(np.searchsorted(starts, end, 'left'))
+        return self.order[first:last]
+
+    def day_rows(self, start, end):
+        "Rows starting in [start, end) for every unit type that has trips in the range."
+        rows_per_type = {}
+        for tipo_unidad in self.type_bounds:
+            rows = self.rows(tipo_unidad, start, end)
+            if len(rows):
+                rows_per_type[tipo_unidad] = rows
+        return rows_per_type
+
+
+def load_trip_index(source=TRIPS_CSV, cache_dir=CACHE_DIR):
+    return TripIndex(load_trips_cache(source, cache_dir))
+
+
+if __name__ == '__main__':
+    meta = build_trips_cache()
+    print(f"Cached {meta['rows']} trips in {CACHE_DIR}")